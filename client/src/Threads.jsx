@@ -55,6 +55,22 @@ export function Threads(props) {
         // eslint-disable-next-line solid/reactivity
         [activeThread, setActiveThread] = createSignal(threads().length > 0 ? threads().flat()[0].thread_id : null);
 
+  // the server may only send the first page of threads, fetch the rest
+  async function fetchRemainingThreads(cursor) {
+    const query = (new URLSearchParams(window.location.search)).get("query");
+    while(cursor) {
+      props.sp?.(0);
+      const response = await fetch(apiURL(`api/query/?query=${encodeURIComponent(query)}&cursor=${encodeURIComponent(cursor)}`));
+      props.sp?.(1);
+      if(!response.ok) throw new Error(`${response.status}: ${response.statusText}`);
+      const page = await response.json();
+      setThreads([...threads(), ...page.threads]);
+      cursor = page.cursor;
+    }
+  }
+
+  if(data.cursor) fetchRemainingThreads(data.cursor);
+
   function getAffectedThreads() {
     if(threads().length > 0) {
       let tmp = selectedThreads(),
@@ -186,6 +186,30 @@ test("shows thread groups", async () => {
   expect(screen.getAllByText("foobar").length).toBe(1);
 });
 
+test("fetches remaining threads", async () => {
+  vi.stubGlobal('location', {
+    ...window.location,
+    search: '?query=foo'
+  });
+  vi.stubGlobal("data", {"allTags": tags, "cursor": "bar", "threads": [
+    {authors: ["foo@Author"], subject: "test", tags: ["fooTag"], total_messages: 1, newest_date: 1000, oldest_date: 100, thread_id: "foo"}
+  ]});
+  global.fetch.mockResolvedValue({ ok: true, json: () => ({"threads": [
+    {authors: ["test@1"], subject: "foobar", tags: ["unread"], total_messages: 1, newest_date: 1000, oldest_date: 100, thread_id: "bar"}
+  ], "cursor": null, "total": 2}) });
+
+  const { container } = render(() => <Threads Threads={SearchThreads}/>);
+  await vi.waitFor(() => {
+    expect(container.querySelectorAll(".thread").length).toBe(2);
+  });
+
+  expect(screen.getByText("2 thread groups.")).toBeInTheDocument();
+  expect(screen.getAllByText("test").length).toBe(1);
+  expect(screen.getAllByText("foobar").length).toBe(1);
+  expect(global.fetch).toHaveBeenCalledTimes(1);
+  expect(global.fetch).toHaveBeenCalledWith("http://localhost:5000/api/query/?query=foo&cursor=bar");
+});
+
 test("opens thread on enter and click", async () => {
   vi.stubGlobal('location', {
     ...window.location,
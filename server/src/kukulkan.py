@@ -7,24 +7,39 @@ import os
 import subprocess
 import threading
 import queue
+import socket
+import sqlite3
+import types
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+import atexit
+import time
 
 import json
 import re
 import hashlib
 import base64
+import binascii
+import itertools
+import unicodedata
+import collections
+import zipfile
 
 from tempfile import mkstemp, NamedTemporaryFile
 
-from typing import Any, Dict, List, Optional, Tuple, Generator
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Generator
 
 import email
 import email.headerregistry
+import email.parser
 import email.policy
 
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
 
+import click
 import notmuch2
-from flask import Flask, Response, abort, current_app, g, render_template, request, send_file, send_from_directory
+from flask import Flask, Response, abort, current_app, g, render_template, request, send_file, send_from_directory, stream_with_context
 from flask_compress import Compress
 from markupsafe import escape
 from werkzeug.utils import safe_join
@@ -46,7 +61,7 @@ from bs4 import BeautifulSoup
 import lxml
 from lxml_html_clean import Cleaner
 
-from PIL import Image
+from PIL import Image, features
 
 from gnupg import GPG
 
@@ -117,6 +132,17 @@ def get_header(msg: notmuch2.Message, header: str) -> None | str:
         return None
 
 
+def parse_headers(fp: BinaryIO) -> email.message.EmailMessage:
+    """Parses only the headers of a message; nothing after the empty line that
+    ends them is read."""
+    lines = []
+    for line in fp:
+        if line in (b"\n", b"\r\n"):
+            break
+        lines.append(line)
+    return email.parser.BytesHeaderParser(policy=policy).parsebytes(b"".join(lines))  # type: ignore[arg-type, return-value]
+
+
 def split_email_addresses(header: str) -> List[str]:
     """Returns all email addresses (without the names) in a string."""
     addresses = re.findall(r'([^,][^@]*@[^,]+)', header)
@@ -130,19 +156,108 @@ def get_db() -> notmuch2.Database:
     return g.db
 
 
+def get_excluded_tags(query_string: str, db: notmuch2.Database) -> List[str]:
+    """Get the configured tags to exclude that aren't explicitly part of the query."""
+    try:
+        return [tag for tag in db.config["search.exclude_tags"].split(';')
+                if tag != '' and f'tag:{tag}' not in query_string]
+    except KeyError:
+        return []
+
+
 def get_query(query_string: str, sort: Any = notmuch2.Database.SORT.NEWEST_FIRST, db: Optional[notmuch2.Database] = None, exclude: bool = True) -> Generator[notmuch2.Message, None, None]:
     """Get messages matching a query."""
     db = get_db() if db is None else db
-    excluded = []
-    if exclude:
-        try:
-            excluded = [tag for tag in db.config["search.exclude_tags"].split(';')
-                        if tag != '' and f'tag:{tag}' not in query_string]
-        except KeyError:
-            pass
+    excluded = get_excluded_tags(query_string, db) if exclude else []
     return db.messages(query_string, exclude_tags=excluded, sort=sort)
 
 
+def get_thread_query(query_string: str, sort: Any = notmuch2.Database.SORT.NEWEST_FIRST, db: Optional[notmuch2.Database] = None, exclude: bool = True) -> Generator[notmuch2.Thread, None, None]:
+    """Get threads matching a query."""
+    db = get_db() if db is None else db
+    excluded = get_excluded_tags(query_string, db) if exclude else []
+    return db.threads(query_string, exclude_tags=excluded, sort=sort)
+
+
+def client_disconnected() -> bool:
+    """Whether the client of the current request has closed the connection,
+    as far as the WSGI server exposes its socket."""
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        # nothing to read, but still open
+        return False
+    except ValueError:
+        # TLS sockets don't support peeking
+        return False
+    except OSError:
+        return True
+
+
+def within_budget(items: Iterable[Any]) -> Generator[Any, None, None]:
+    """Yields items until the time budget of the current request is used up or
+    the client has disconnected, in which case `g.truncated` is set. The first
+    item is always yielded so that callers make progress."""
+    deadline = g.get("deadline")
+    next_check = time.monotonic() + 0.25
+    for i, item in enumerate(items):
+        if i > 0:
+            now = time.monotonic()
+            if deadline is not None and now > deadline:
+                g.truncated = True
+                return
+            if now > next_check:
+                if client_disconnected():
+                    g.truncated = True
+                    return
+                next_check = now + 0.25
+        yield item
+
+
+def thread_summary(thread: notmuch2.Thread, excluded: Iterable[str] = ()) -> Dict[str, Any]:
+    """Summarises a `notmuch2.Thread` instance for thread lists. Senders, dates
+    and tags are taken from the messages that don't have any of the excluded
+    tags, subject and message count from the thread itself."""
+    # notmuch's list of authors has no addresses and can't be split reliably,
+    # and its tags and dates include excluded messages or cover only matching
+    # ones, so as in the per-message summary, newest first
+    msgs = sorted((msg for msg in thread if not set(excluded).intersection(msg.tags)),
+                  key=lambda msg: msg.date, reverse=True)
+    # ordered by the latest message of each sender, oldest first
+    authors = list({get_header(msg, "from"): 1 for msg in msgs}.keys())[::-1]
+    tags = {tag: 1 for msg in msgs for tag in msg.tags} if msgs else dict.fromkeys(thread.tags, 1)
+    return {
+        "authors": authors,
+        "newest_date": msgs[0].date if msgs else thread.last,
+        "oldest_date": msgs[-1].date if msgs else thread.first,
+        "subject": str(thread.subject) if thread.subject else "(no subject)",
+        "tags": list(tags.keys()),
+        "thread_id": str(thread.threadid),
+        # count all messages, including excluded ones
+        "total_messages": len(thread)
+    }
+
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+    """Encodes the state needed to continue a paginated query as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps(state).encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Decodes a cursor created by `encode_cursor`, raising a `ValueError` if it
+    is malformed."""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(state, dict) or not isinstance(state.get("offset"), int) or not isinstance(state.get("groups"), list):
+        raise ValueError("invalid cursor")
+    return state
+
+
 def get_message(message_id: str | None) -> notmuch2.Message:
     """Get a single message."""
     if message_id is None:
@@ -154,11 +269,27 @@ def get_message(message_id: str | None) -> notmuch2.Message:
     return msg
 
 
+def check_etag(endpoint: str, *parts: Any) -> bool:
+    """Tags the response to a request to the given endpoint with an entity tag
+    made from the given parts and returns whether the client already has that
+    version. Does nothing for internal calls from other endpoints."""
+    if request.endpoint != endpoint:
+        return False
+    g.etag = hashlib.sha256("\0".join(str(part) for part in parts).encode("utf8")).hexdigest()
+    return request.if_none_match.contains_weak(g.etag)
+
+
 # pylint: disable=unused-argument
 def close_db(e: Optional[Any] = None) -> None:
     """Close the Database. Called after every request."""
     if "db" in g and g.db is not None:
         g.db.close()
+    if g.get("message_store") is not None:
+        g.message_store.close()
+        g.message_store = None
+    if g.get("thumbnail_store") is not None:
+        g.thumbnail_store.close()
+        g.thumbnail_store = None
 
 
 def get_globals() -> Dict[str, Any]:
@@ -185,7 +316,7 @@ def email_address_complete(query_string: str | None) -> Dict[str, str]:
     addrs: Dict[str, str] = {}
     i = 0
     msgs = get_query(f"from:{query_string} or to:{query_string}")
-    for msg in msgs:
+    for msg in within_budget(msgs):
         for header in ['from', 'to', 'cc', 'bcc']:
             value = get_header(msg, header)  # type: ignore[arg-type]
             if value is not None and qs in value.casefold():
@@ -231,16 +362,284 @@ def create_app() -> Flask:
     @app.before_request
     def before_request() -> None:
         get_db()
+        # time allowed for iterating over query results
+        try:
+            budget = float(current_app.config.custom["query-time-budget"])  # type: ignore[attr-defined]
+        except KeyError:
+            budget = 10
+        g.deadline = time.monotonic() + budget if budget > 0 else None
+        g.truncated = False
 
     app.teardown_appcontext(close_db)
 
+    def get_query_cache_size() -> int:
+        try:
+            return int(current_app.config.custom["query-cache-size"])  # type: ignore[attr-defined]
+        except KeyError:
+            return 64
+
+    # total number of messages per thread, least recently used first, valid for
+    # the database revision they were counted at
+    thread_counts: Dict[str, Any] = {"lock": threading.Lock(), "revision": None, "counts": collections.OrderedDict()}
+
+    def count_thread_messages(tids: List[str]) -> Dict[str, int]:
+        """Counts all messages, including excluded ones, in the given threads,
+        using a single query for all threads that haven't been counted since
+        the database last changed."""
+        if len(tids) == 0:
+            return {}
+        db = get_db()
+        revision = db.revision()
+        known: Dict[str, int] = {}
+        with thread_counts["lock"]:
+            if thread_counts["revision"] != revision:
+                thread_counts["revision"] = revision
+                thread_counts["counts"] = collections.OrderedDict()
+            counts = thread_counts["counts"]
+            for tid in tids:
+                if tid in counts:
+                    counts.move_to_end(tid)
+                    known[tid] = counts[tid]
+        missing = [tid for tid in tids if tid not in known]
+        if missing:
+            found = {str(thread.threadid): len(thread)
+                     for thread in db.threads(" or ".join(f"thread:{tid}" for tid in missing))}
+            known.update(found)
+            # as many threads as there are in a full query cache of pages
+            # of results
+            size = get_query_cache_size() * 100
+            with thread_counts["lock"]:
+                if thread_counts["revision"] == revision:
+                    counts = thread_counts["counts"]
+                    counts.update(found)
+                    while len(counts) > size:
+                        counts.popitem(last=False)
+        return {tid: known.get(tid, 0) for tid in tids}
+
+    # reply structure of threads, least recently used first, valid for the
+    # database revision it was built at
+    thread_trees: Dict[str, Any] = {"lock": threading.Lock(), "revision": None, "trees": collections.OrderedDict()}
+
+    def get_thread_tree(thread_id: str) -> Dict[str, Any]:
+        """Returns the parent and replies of each message in a thread and the
+        thread's fibers, i.e. all paths from a message without parent to one
+        without replies, from notmuch's thread structure."""
+        db = get_db()
+        revision = db.revision()
+        with thread_trees["lock"]:
+            if thread_trees["revision"] != revision:
+                thread_trees["revision"] = revision
+                thread_trees["trees"] = collections.OrderedDict()
+            tree = thread_trees["trees"].get(thread_id)
+            if tree is not None:
+                thread_trees["trees"].move_to_end(thread_id)
+                return tree
+        parents: Dict[str, Optional[str]] = {}
+        replies: Dict[str, List[str]] = {}
+        fibers: List[List[str]] = []
+        for thread in db.threads(f"thread:{thread_id}"):
+            toplevel = list(thread.toplevel())
+            for msg in toplevel:
+                parents[msg.messageid] = None
+            # depth first without recursion, long threads can be very deep
+            stack: List[Tuple[notmuch2.Message, List[str]]] = [(msg, []) for msg in reversed(toplevel)]
+            while stack:
+                msg, path = stack.pop()
+                path = path + [msg.messageid]
+                children = list(msg.replies())
+                replies[msg.messageid] = [child.messageid for child in children]
+                for child in children:
+                    parents[child.messageid] = msg.messageid
+                if len(children) == 0:
+                    fibers.append(path)
+                stack.extend((child, path) for child in reversed(children))
+        tree = {"parents": parents, "replies": replies, "fibers": fibers}
+        with thread_trees["lock"]:
+            if thread_trees["revision"] == revision:
+                trees = thread_trees["trees"]
+                trees[thread_id] = tree
+                while len(trees) > get_query_cache_size():
+                    trees.popitem(last=False)
+        return tree
+
+    # results of recent queries, least recently used first, valid for the
+    # database revision they were computed at
+    query_cache: Dict[str, Any] = {"lock": threading.Lock(), "revision": None, "results": collections.OrderedDict(),
+                                   "hits": 0, "misses": 0}
+    app.query_cache = query_cache  # type: ignore[attr-defined]
+
+    # parsed messages, least recently used first, with the total size of their
+    # files
+    app.message_cache = {"lock": threading.Lock(), "messages": collections.OrderedDict(), "size": 0}  # type: ignore[attr-defined]
+
+    # worker processes for rendering large threads, started on first use
+    render_pool: Dict[str, Any] = {"lock": threading.Lock(), "pool": None}
+
+    def render_messages(msgs: List[notmuch2.Message]) -> Dict[str, Dict[str, Any]]:
+        """Renders the given messages in parallel in worker processes if
+        enabled and there are enough of them. Returns nothing otherwise, for
+        rendering as needed."""
+        try:
+            processes = int(current_app.config.custom["render-processes"])  # type: ignore[attr-defined]
+        except KeyError:
+            processes = 0
+        try:
+            threshold = int(current_app.config.custom["render-threshold"])  # type: ignore[attr-defined]
+        except KeyError:
+            threshold = 20
+        if processes < 1 or len(msgs) < threshold:
+            return {}
+        with render_pool["lock"]:
+            if render_pool["pool"] is None:
+                # not forking the threads of the server
+                render_pool["pool"] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_render_worker, initargs=(current_app.config.custom,))  # type: ignore[attr-defined, arg-type]
+            pool = render_pool["pool"]
+        rendered = {}
+        futures = {}
+        try:
+            for msg in msgs:
+                stored = load_rendered_message(msg)
+                if stored is None:
+                    futures[msg.messageid] = (msg, pool.submit(render_in_worker, str(msg.path), msg.messageid, get_header(msg, "from")))
+                else:
+                    rendered[msg.messageid] = stored
+            for mid, (msg, future) in futures.items():
+                rendered[mid] = future.result()
+                store_rendered_message(msg, rendered[mid])
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # a worker died, start over with a new pool next time and render
+            # what is missing here
+            current_app.logger.warning(f"Rendering in worker processes failed: {str(e)}")
+            with render_pool["lock"]:
+                if render_pool["pool"] is pool:
+                    render_pool["pool"] = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        return rendered
+
+    def shutdown_render_pool() -> None:
+        with render_pool["lock"]:
+            if render_pool["pool"] is not None:
+                render_pool["pool"].shutdown(wait=False, cancel_futures=True)
+                render_pool["pool"] = None
+
+    atexit.register(shutdown_render_pool)
+
+    # threads tagged todo with their earliest due date, soonest first, valid
+    # for the database revision they were indexed at
+    todo_index: Dict[str, Any] = {"revision": None, "entries": []}
+
+    def earliest_due(thr: Any) -> Optional[datetime.date]:
+        if isinstance(thr, list):
+            dues = [due for due in map(earliest_due, thr) if due is not None]
+        else:
+            dues = []
+            for tag in thr["tags"]:
+                if tag.startswith("due:"):
+                    try:
+                        dues.append(datetime.date.fromisoformat(tag[4:]))
+                    except ValueError:
+                        pass
+        return min(dues, default=None)
+
+    def get_todo_index() -> List[Tuple[Optional[datetime.date], Any]] | Tuple[Dict[str, str], int]:
+        """Returns the threads and thread groups tagged todo with their earliest
+        due date, soonest first and those without due date last. Only re-run
+        when the database has changed."""
+        revision = get_db().revision()
+        if todo_index["revision"] != revision:
+            threads = query("tag:todo")
+            if g.get("truncated"):
+                # ran out of time, use what there is without keeping it
+                revision = None
+            if not isinstance(threads, list):
+                return threads  # type: ignore[return-value]
+            entries = [(earliest_due(thr), thr) for thr in threads]
+            # stable, so threads due on the same day stay newest first
+            entries.sort(key=lambda e: (e[0] is None, e[0] or datetime.date.min))
+            todo_index["revision"] = revision
+            todo_index["entries"] = entries
+            return entries
+        return todo_index["entries"]
+
+    @app.cli.command("warmup")
+    @click.option("--since", type=int, default=None,
+                  help="Database revision to start at instead of where the last run stopped.")
+    @click.option("--processes", type=int, default=2,
+                  help="Number of worker processes, 0 to work in this process.")
+    @click.option("--pause", type=float, default=0.1,
+                  help="Seconds to wait after each message.")
+    def warmup(since: Optional[int], processes: int, pause: float) -> None:
+        """Render messages added or changed since the last run into the
+        message store and thumbnail cache."""
+        if get_message_store() is None and get_thumbnail_store() is None:
+            click.echo("Neither message-store nor thumbnail-cache-size are enabled, nothing to do.")
+            return
+        db = get_db()
+        revision = db.revision()
+        state_path = os.path.join(get_cache_dir(), "warmup.json")
+        if since is None:
+            try:
+                with open(state_path, "r", encoding="utf8") as f:
+                    state = json.load(f)
+                # revisions of a different database aren't comparable
+                if state["uuid"] == str(revision.uuid):
+                    since = state["revision"] + 1
+            except (OSError, ValueError, KeyError):
+                pass
+        count = 0
+        if since is None:
+            click.echo("No previous run, starting from the current revision; use --since 0 to warm up everything.")
+        else:
+            msgs = db.messages(f"lastmod:{since}..{revision.rev}")
+            if processes < 1:
+                for msg in msgs:
+                    try:
+                        warm_up_message(str(msg.path), msg.messageid, get_header(msg, "from"), pause)
+                    except Exception as e:
+                        current_app.logger.warning(f"Warming up {msg.messageid} failed: {str(e)}")
+                    count += 1
+            else:
+                def finished(futures: Set[concurrent.futures.Future]) -> int:
+                    for future in futures:
+                        if future.exception() is not None:
+                            current_app.logger.warning(f"Warming up failed: {str(future.exception())}")
+                    return len(futures)
+
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                        initializer=init_warmup_worker, initargs=(current_app.config.custom,)) as pool:  # type: ignore[attr-defined, arg-type]
+                    # no more messages in flight than workers, so that the
+                    # query doesn't run ahead
+                    pending: Set[concurrent.futures.Future] = set()
+                    for msg in msgs:
+                        if len(pending) >= processes:
+                            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                            count += finished(done)
+                        pending.add(pool.submit(warm_up_message, str(msg.path), msg.messageid, get_header(msg, "from"), pause))
+                    count += finished(concurrent.futures.wait(pending).done)
+        with open(private_file(state_path), "w", encoding="utf8") as f:
+            json.dump({"uuid": str(revision.uuid), "revision": revision.rev}, f)
+        click.echo(f"Warmed up {count} messages up to revision {revision.rev}.")
+
     @app.route("/", methods=['GET', 'POST'])
     def send_index() -> Any:
         globs = get_globals()
-        result = query()
+        try:
+            page_size = int(current_app.config.custom["page-size"])  # type: ignore[attr-defined]
+        except KeyError:
+            page_size = 100
+        # only embed the first page, the client fetches the rest
+        result = query(limit=page_size if page_size > 0 else None)
         if isinstance(result, tuple):
             globs["threads"] = []
             globs["error"] = result[0]["error"]
+        elif isinstance(result, dict):
+            globs["threads"] = result["threads"]
+            globs["cursor"] = result["cursor"]
+            globs["total"] = result["total"]
+            globs["revision"] = result["revision"]
         else:
             globs["threads"] = result
         return render_template("index.html", data=globs)
@@ -252,7 +651,8 @@ def create_app() -> Flask:
             return send_from_directory(app.static_folder or "/", path)
         globs = get_globals()
         if path == "todo":
-            globs["threads"] = query("tag:todo")
+            entries = get_todo_index()
+            globs["threads"] = [thr for _, thr in entries] if isinstance(entries, list) else []
         elif path == "thread":
             globs["thread"] = thread()
         elif path == "message":
@@ -265,6 +665,21 @@ def create_app() -> Flask:
                 globs["baseMessage"] = message()
         return render_template("index.html", data=globs)
 
+    @app.after_request
+    def flag_truncated(response: Response) -> Response:
+        if g.get("truncated"):
+            response.headers["X-Truncated"] = "true"
+        return response
+
+    @app.after_request
+    def set_etag(response: Response) -> Response:
+        etag = g.pop("etag", None)
+        # partial results mustn't be mistaken for complete ones later
+        if etag is not None and response.status_code in (200, 304) and not g.get("truncated"):
+            # weak so that compression doesn't change it
+            response.set_etag(etag, weak=True)
+        return response
+
     @app.after_request
     def security_headers(response: Response) -> Response:
         response.headers["X-Content-Type-Options"] = "nosniff"
@@ -288,17 +703,84 @@ def create_app() -> Flask:
         return response
 
     @app.route("/api/query/")
-    def query(query_string: Optional[str] = None) -> List[Dict[str, Any]] | Tuple[Dict[str, str], int]:
+    def query(query_string: Optional[str] = None, limit: Optional[int] = None,
+              cursor: Optional[str] = None, since: Optional[int] = None) -> List[Any] | Dict[str, Any] | Tuple[Dict[str, str], int] | Response:
         if query_string is None:
             query_string = request.args.get("query")
+        if since is None and request.args.get("since") is not None:
+            since = request.args.get("since", type=int)
+            if since is None or since < 0:
+                return {"error": "invalid since"}, 400
+        if limit is None:
+            limit = request.args.get("limit", type=int)
+        if cursor is None:
+            cursor = request.args.get("cursor")
+        if limit is not None and limit < 1:
+            return {"error": "invalid limit"}, 400
+        stream = request.endpoint == "query" and request.accept_mimetypes.best == "application/x-ndjson"
+        # whether a stream is cut short is only known once it's sent, too late
+        # for the headers, so streams aren't tagged
+        if not stream and check_etag("query", get_db().revision(), request.accept_mimetypes.best):
+            return Response(status=304)
+
+        # pagination state -- number of threads already walked and groups
+        # already shown
+        offset = 0
+        seen_groups: Set[str] = set()
+        if cursor is not None:
+            try:
+                state = decode_cursor(cursor)
+            except ValueError as e:
+                return {"error": str(e)}, 400
+            if state.get("query") != query_string:
+                return {"error": "cursor does not match query"}, 400
+            offset = state["offset"]
+            seen_groups = set(state["groups"])
 
-        def get_threads(q: str | None) -> Dict[str, Any]:
-            if q is None:
-                return {}
+        try:
+            engine = current_app.config.custom["query-engine"]  # type: ignore[attr-defined]
+        except KeyError:
+            engine = "threads"
+
+        db = get_db()
+
+        # cache results by normalised query, excluded tags and pagination until
+        # the database changes
+        cache_key = None
+        cached = None
+        cache_size = get_query_cache_size()
+        if query_string is not None and since is None and cache_size > 0:
+            revision = db.revision()
+            cache_key = (engine, " ".join(query_string.split()),
+                         tuple(get_excluded_tags(query_string, db)), limit, cursor)
+            with query_cache["lock"]:
+                if query_cache["revision"] != revision:
+                    query_cache["revision"] = revision
+                    query_cache["results"].clear()
+                cached = query_cache["results"].get(cache_key)
+                if cached is None:
+                    query_cache["misses"] += 1
+                else:
+                    query_cache["hits"] += 1
+                    query_cache["results"].move_to_end(cache_key)
+
+        def cache_result(result: Dict[str, Any]) -> None:
+            if cache_key is None or g.get("truncated"):
+                return
+            with query_cache["lock"]:
+                if query_cache["revision"] != revision:
+                    # the database changed in the meantime
+                    return
+                results = query_cache["results"]
+                results[cache_key] = result
+                while len(results) > cache_size:
+                    results.popitem(last=False)
+
+        def get_threads_messages(q: str) -> Dict[str, Any]:
             msgs = get_query('thread:"{' + q.replace('"', '""') + '}"')
             # using dicts here to get everything in the order in which it occured
             threads = {}
-            for msg in msgs:
+            for msg in within_budget(msgs):
                 if msg.threadid not in threads:
                     subject = get_header(msg, "subject")
                     threads[msg.threadid] = {
@@ -313,38 +795,224 @@ def create_app() -> Flask:
                     threads[msg.threadid]["tags"][tag] = 1
             return threads
 
+        def iter_threads(q: str, offset: int = 0) -> Iterator[Tuple[str, Dict[str, Any]]]:
+            if engine == "messages":
+                return itertools.islice(get_threads_messages(q).items(), offset, None)
+            excluded = get_excluded_tags(q, db)
+            return ((summary["thread_id"], summary) for summary in
+                    (thread_summary(thread, excluded) for thread in within_budget(itertools.islice(get_thread_query(q), offset, None))))
+
+        def expand_groups(grps: List[str]) -> Dict[str, Dict[str, Any]]:
+            # get the threads of all groups with a single query, sorting them
+            # into their groups in one pass
+            expanded: Dict[str, Dict[str, Any]] = {grp: {} for grp in grps}
+            if len(grps) > 0:
+                for t, thr in iter_threads(" or ".join(f"tag:{grp}" for grp in grps)):
+                    for tag in thr["tags"]:
+                        if tag in expanded:
+                            expanded[tag][t] = thr
+            return expanded
+
         try:
-            threads = get_threads(query_string)
+            matches = iter_threads(query_string, offset) if query_string is not None and cached is None and since is None else iter([])
         except notmuch2.NotmuchError as e:
             return {"error": str(e)}, 400
-        # second pass to create nested group structure
-        nested_threads = {}
-        seen_groups = []
-        for t, thr in threads.items():
-            grps = [tg for tg in thr["tags"].keys() if tg.startswith('grp:')]
-            if len(grps) > 0:
-                if grps[0] in seen_groups:
-                    continue
-                seen_groups.append(grps[0])
-                nested_threads[t] = get_threads(f'tag:{grps[0]}')
-            else:
-                nested_threads[t] = thr
 
-        db = get_db()
+        next_cursor = None
+
+        def cursor_at(position: int) -> str:
+            return encode_cursor({"query": query_string,
+                                  "offset": position,
+                                  "groups": sorted(seen_groups)})
+
+        def walk_threads() -> Generator[Tuple[str, Dict[str, Any], Optional[str], int], None, None]:
+            # walk the threads until the page is full, with the group tag for
+            # threads that stand for a group that hasn't been shown yet and
+            # their position in the result
+            nonlocal next_cursor
+            count = 0
+            position = offset
+            for t, thr in matches:
+                if limit is not None and count >= limit:
+                    next_cursor = cursor_at(position)
+                    return
+                position += 1
+                grp = next((tg for tg in thr["tags"] if tg.startswith('grp:')), None)
+                if grp is not None:
+                    if grp in seen_groups:
+                        continue
+                    seen_groups.add(grp)
+                count += 1
+                yield t, thr, grp, position - 1
+            if g.get("truncated") and engine != "messages":
+                # ran out of time, continue where this stopped
+                next_cursor = cursor_at(position)
+
+        def expand_page(page: List[Tuple[str, Dict[str, Any], Optional[str], int]], first: bool = True) -> List[Tuple[str, Any]]:
+            # create nested group structure; groups cut off by the time budget
+            # may be incomplete, so the page ends before the first of them and
+            # the cursor continues from there, except that the first entry of
+            # a page is always expanded fully so that the cursor moves on
+            nonlocal next_cursor
+            truncated = bool(g.get("truncated"))
+            g.truncated = False
+            groups = expand_groups([grp for _, _, grp, _ in page if grp is not None])
+            if g.truncated:
+                cut = next(i for i, (_, _, grp, _) in enumerate(page) if grp is not None)
+                if cut == 0 and first:
+                    deadline = g.pop("deadline", None)
+                    g.truncated = False
+                    groups = expand_groups([str(page[0][2])])
+                    g.deadline = deadline
+                    cut = 1
+                for _, _, grp, _ in page[cut:]:
+                    seen_groups.discard(str(grp))
+                if cut < len(page):
+                    next_cursor = cursor_at(page[cut][3])
+                    truncated = True
+                page = page[:cut]
+            g.truncated = truncated or bool(g.truncated)
+            return [(t, thr if grp is None else groups[grp]) for t, thr, grp, _ in page]
+
+        def uncounted(t: str, thr: Dict[str, Any]) -> List[str]:
+            if "authors" not in thr.keys():
+                return [tid for gt, gthr in thr.items() for tid in uncounted(gt, gthr)]
+            return [] if "total_messages" in thr.keys() else [t]
+
+        def get_thread_ret(t: str, thr: Dict[str, Any]) -> Any:
+            if "authors" not in thr.keys():
+                return [get_thread_ret(gt, gthr) for gt, gthr in thr.items()]
+            if "thread_id" in thr.keys():
+                # already summarised from thread object
+                return thr
+            return {"authors": list(thr["authors"].keys())[::-1],
+                    "newest_date": thr["newest_date"],
+                    "oldest_date": thr["oldest_date"],
+                    "subject": thr["subject"],
+                    "tags": list(thr["tags"].keys()),
+                    "thread_id": t,
+                    "total_messages": count_thread_messages([t])[t]}
+
+        def get_total() -> int:
+            if query_string is None:
+                return 0
+            return db.count_threads(query_string, exclude_tags=get_excluded_tags(query_string, db))
+
+        if since is not None:
+            # only threads with messages added or retagged after the given
+            # revision, split into those that match and those that don't anymore
+            revision = db.revision().rev
+            if query_string is None:
+                return {"revision": revision, "threads": [], "removed": []}
+            changed = f"lastmod:{since + 1}.."
+            try:
+                # an old revision can mean most of the database
+                tids = {str(thread.threadid) for thread in within_budget(get_thread_query(changed, exclude=False))}
+                matching = list(iter_threads(f"({query_string}) and thread:{{{changed}}}")) if tids else []
+                # changed threads in a group stand for the whole group, as in
+                # the full result
+                delta = []
+                delta_groups: Set[str] = set()
+                for t, thr in matching:
+                    grp = next((tg for tg in thr["tags"] if tg.startswith('grp:')), None)
+                    if grp is not None:
+                        if grp in delta_groups:
+                            continue
+                        delta_groups.add(grp)
+                    delta.append((t, thr, grp))
+                groups = expand_groups([grp for _, _, grp in delta if grp is not None])
+                entries = [(t, thr if grp is None else groups[grp]) for t, thr, grp in delta]
+                count_thread_messages([tid for t, thr in entries for tid in uncounted(t, thr)])
+                threads = [get_thread_ret(t, thr) for t, thr in entries]
+            except notmuch2.NotmuchError as e:
+                return {"error": str(e)}, 400
+            if g.get("truncated"):
+                # threads that weren't reached can't be told apart from
+                # removed ones
+                return {"revision": revision, "threads": threads, "removed": [], "truncated": True}
+            shown = {t for t, _ in matching} | {gt for grp in groups.values() for gt in grp}
+            return {"revision": revision,
+                    "threads": threads,
+                    "removed": sorted(tids - shown)}
+
+        if stream:
+            # one line per thread or group as soon as it's done, and a last
+            # line flagging truncation, as headers are sent before that's
+            # known
+            def generate() -> Generator[str, None, None]:
+                paginated = limit is not None or cursor is not None
+                if cached is not None:
+                    for ret in cached["threads"]:
+                        yield current_app.json.dumps(ret) + "\n"
+                    if paginated:
+                        yield current_app.json.dumps({"cursor": cached["cursor"], "total": cached["total"], "revision": cached["revision"]}) + "\n"
+                    return
+                threads: List[Any] = []
+                try:
+                    for entry in walk_threads():
+                        # expand groups right away to not hold up the stream
+                        expanded = expand_page([entry], first=len(threads) == 0)
+                        if len(expanded) == 0:
+                            break
+                        t, thr = expanded[0]
+                        # count everything in a group at once
+                        count_thread_messages(uncounted(t, thr))
+                        threads.append(get_thread_ret(t, thr))
+                        yield current_app.json.dumps(threads[-1]) + "\n"
+                    total = get_total() if paginated or g.get("truncated") else None
+                    revision = db.revision().rev if paginated or g.get("truncated") else None
+                    if g.get("truncated"):
+                        yield current_app.json.dumps({"cursor": next_cursor, "total": total, "revision": revision, "truncated": True}) + "\n"
+                    elif paginated:
+                        yield current_app.json.dumps({"cursor": next_cursor, "total": total, "revision": revision}) + "\n"
+                except notmuch2.NotmuchError as e:
+                    yield current_app.json.dumps({"error": str(e)}) + "\n"
+                    return
+                cache_result({"threads": threads, "cursor": next_cursor, "total": total, "revision": revision})
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        if cached is not None:
+            if limit is None and cursor is None:
+                return cached["threads"]
+            return {"threads": cached["threads"], "cursor": cached["cursor"], "total": cached["total"], "revision": cached["revision"]}
 
-        def get_threads_ret(threads: Dict[str, Any]):
-            return [get_threads_ret(threads[t])
-                    if "authors" not in threads[t].keys()
-                    else {"authors": list(threads[t]["authors"].keys())[::-1],
-                          "newest_date": threads[t]["newest_date"],
-                          "oldest_date": threads[t]["oldest_date"],
-                          "subject": threads[t]["subject"],
-                          "tags": list(threads[t]["tags"].keys()),
-                          "thread_id": t,
-                          # count all messages, including excluded ones
-                          "total_messages": db.count_messages(f'thread:{t}')}
-                    for t in threads.keys()]
-        return get_threads_ret(nested_threads)
+        try:
+            entries = expand_page(list(walk_threads()))
+            # count messages for the entire page at once
+            count_thread_messages([tid for t, thr in entries for tid in uncounted(t, thr)])
+            threads = [get_thread_ret(t, thr) for t, thr in entries]
+        except notmuch2.NotmuchError as e:
+            return {"error": str(e)}, 400
+        if limit is None and cursor is None:
+            # truncation is flagged in a header only to keep the shape
+            cache_result({"threads": threads, "cursor": None, "total": None, "revision": None})
+            return threads
+        result = {"threads": threads, "cursor": next_cursor, "total": get_total(), "revision": db.revision().rev}
+        if g.get("truncated"):
+            result["truncated"] = True
+        cache_result(result)
+        return result
+
+    @app.route("/api/todo/")
+    def todo() -> Dict[str, Any] | Tuple[Dict[str, str], int]:
+        try:
+            start = datetime.date.fromisoformat(d) if (d := request.args.get("from")) else None
+            end = datetime.date.fromisoformat(d) if (d := request.args.get("to")) else None
+        except ValueError:
+            return {"error": "invalid date"}, 400
+        entries = get_todo_index()
+        if not isinstance(entries, list):
+            return entries
+        if start is None and end is None:
+            threads = [thr for _, thr in entries]
+        else:
+            # only threads due in the given range, inclusive
+            threads = [thr for due, thr in entries
+                       if due is not None and (start is None or due >= start) and (end is None or due <= end)]
+        today = datetime.date.today()
+        return {"threads": threads,
+                "overdue": sum(1 for due, _ in entries if due is not None and due < today),
+                "upcoming": sum(1 for due, _ in entries if due is not None and due >= today)}
 
     @app.route("/api/address/")
     def complete_address() -> List[str]:
@@ -364,7 +1032,7 @@ def create_app() -> Flask:
             msgs = get_query("tag:/grp:.*/")
         else:
             msgs = get_query(f'tag:/grp:.*/ and subject:"{sq}"')
-        for msg in msgs:
+        for msg in within_budget(msgs):
             subject = get_header(msg, "subject")
             grp = [tag for tag in msg.tags if tag.startswith("grp:")][0]
             if grp not in grps:
@@ -376,35 +1044,97 @@ def create_app() -> Flask:
     @app.route("/api/thread/")
     def thread() -> Any:
         thread_id = request.args.get("thread")
-        msgs = get_query(f'thread:{thread_id}',
-                         sort=notmuch2.Database.SORT.OLDEST_FIRST,
-                         exclude=False)
-        return [message_to_json(m) for m in msgs]  # type: ignore[arg-type]
+        if check_etag("thread", get_db().revision()):
+            return Response(status=304)
+        msgs = list(get_query(f'thread:{thread_id}',
+                              sort=notmuch2.Database.SORT.OLDEST_FIRST,
+                              exclude=False))
+        if request.args.get("lazy") == "true":
+            # bodies only for unread and requested messages, the rest can be
+            # fetched through /api/message_bodies/
+            requested = (request.args.get("bodies") or "").split(' ')
+            get_body = ["unread" in m.tags or m.messageid in requested for m in msgs]
+        else:
+            get_body = [True for _ in msgs]
+        rendered = render_messages([m for m, b in zip(msgs, get_body) if b and "deleted" not in m.tags])
+        messages = [message_to_json(m, get_body=b, rendered=rendered.get(m.messageid)) for m, b in zip(msgs, get_body)]
+        if request.args.get("tree") == "true":
+            return {"messages": messages, **get_thread_tree(str(thread_id))}
+        return messages
+
+    @app.route("/api/message_bodies/")
+    def message_bodies() -> Dict[str, Any]:
+        mids = request.args.get("ids")
+        if mids is None:
+            abort(404)
+        bodies = {}
+        for mid in mids.split(' '):
+            res = message_to_json(get_message(mid))
+            bodies[mid] = {"body": res["body"], "signature": res["signature"]}
+        return bodies
 
     @app.route("/api/attachment/")
     def attachment() -> Any:
         message_id = request.args.get("message")
         num = int(request.args.get("num") or -1)
-        scale = int(request.args.get("scale") or 0)
+        scale = float(request.args.get("scale") or 0)
+        width = int(request.args.get("w") or 0)
+        # longest side of scaled images, e.g. twice the default for high-DPI
+        # screens, within limits
+        size = min(width if width > 0 else int(500 * scale), 2000)
+        webp = size > 0 and "image/webp" in (mime for mime, _ in request.accept_mimetypes) and bool(features.check("webp"))
+        # lower quality is less visible at higher density
+        quality = 75 if scale <= 1 else 60
+        if size > 0:
+            key = thumbnail_key(message_id, num, size, quality, webp)
+            thumbnail = load_thumbnail(key)
+            if thumbnail is not None:
+                res = send_file(thumbnail[0], mimetype=thumbnail[1], as_attachment=False,
+                                download_name=thumbnail[2])
+                res.vary.add("Accept")
+                return res
         msg = get_message(message_id)
+        mtime = os.stat(msg.path).st_mtime
+        index = get_attachment_index(msg)
+        if index and num < len(index):
+            part = index[num]
+            # text is sent as UTF-8 and images may be scaled, both need the
+            # decoded attachment, as do parts that aren't encoded
+            maintype = part["content_type"].split('/')[0]
+            if maintype not in ["text", "message"] and (maintype != "image" or size == 0) and part["cte"] in ["base64", "quoted-printable"]:
+                return send_attachment(stream_part(str(msg.path), part["start"], part["end"], part["cte"]),
+                                       get_attachment_size(msg, index, num), part["content_type"],
+                                       (part["filename"] or "unnamed attachment").replace('\n', ''), mtime)
         d = message_attachment(msg, num)
         if not d:
             abort(404)
+        content_type = d["content_type"]
+        filename = d["filename"].replace('\n', '')
         if isinstance(d["content"], str):
-            f = io.BytesIO(io.StringIO(d["content"]).getvalue().encode("utf8"))
+            data = d["content"].encode("utf8")
+        else:
+            if "image" in content_type and size > 0:
+                data, content_type, filename = make_thumbnail(key, d, size, quality, webp)
+                res = send_attachment([data], len(data), content_type, filename, mtime)
+                res.vary.add("Accept")
+                return res
+            data = bytes(d["content"])
+        return send_attachment([data], len(data), content_type, filename, mtime)
+
+    @app.route("/api/attachments/")
+    def attachments_zip() -> Response:
+        message_id = request.args.get("message")
+        thread_id = request.args.get("thread")
+        if message_id:
+            msgs: Iterable[notmuch2.Message] = [get_message(message_id)]
+        elif thread_id:
+            msgs = (m for m in get_query(f'thread:{thread_id}', sort=notmuch2.Database.SORT.OLDEST_FIRST, exclude=False)
+                    if "deleted" not in m.tags)
         else:
-            f = io.BytesIO(bytes(d["content"]))
-            if "image" in d["content_type"] and scale != 0:
-                img = Image.open(f)
-
-                w, h = img.size
-                sf = min(500 / max(w, h), 1)
-                resized_img = img.resize((int(w * sf), int(h * sf)), Image.Resampling.LANCZOS)
-                f = io.BytesIO()
-                resized_img.save(f, format=img.format if img.format else 'JPEG')
-                f.seek(0)
-        return send_file(f, mimetype=d["content_type"], as_attachment=False,
-                         download_name=d["filename"].replace('\n', ''))
+            abort(404)
+        res = Response(stream_with_context(zip_attachments(msgs)), mimetype="application/zip", direct_passthrough=True)
+        res.headers.set("Content-Disposition", "attachment", filename="attachments.zip")
+        return res
 
     @app.route("/api/message_attachment/")
     def attachment_message() -> Any:
@@ -414,18 +1144,22 @@ def create_app() -> Flask:
         d = message_attachment(msg, num)
         if not d:
             abort(404)
-        return eml_to_json(bytes(d["content"]))
+        return eml_to_json(bytes(d["content"]), get_body=request.args.get("body") != "false")
 
     @app.route("/api/message/")
-    def message() -> Dict[str, Any]:
+    def message() -> Dict[str, Any] | Response:
         message_id = request.args.get("message")
         msg = get_message(message_id)
+        if check_etag("message", message_id, os.stat(msg.path).st_mtime_ns, sorted(msg.tags)):
+            return Response(status=304)
         return message_to_json(msg, True)
 
     @app.route("/api/message_html/")
-    def message_html() -> str:
+    def message_html() -> str | Response:
         message_id = request.args.get("message")
         msg = get_message(message_id)
+        if check_etag("message_html", message_id, os.stat(msg.path).st_mtime_ns):
+            return Response(status=304)
         email_msg = email_from_notmuch(msg)
         html, _ = get_nested_body(email_msg, True)
         return html
@@ -795,8 +1529,54 @@ def strip_tags(soup: BeautifulSoup) -> None:
     soup.smooth()
 
 
+def is_attachment_part(content_type: str, disposition: Optional[str]) -> bool:
+    """Whether a part with the given type and disposition is shown as an
+    attachment."""
+    return (disposition in ["attachment", "inline"] or content_type == "text/calendar") and not (disposition == "inline" and content_type == "text/plain")
+
+
+def walk_message(email_msg: email.message.Message) -> Dict[str, List[Any]]:
+    """Walks the MIME tree of an email message once, unwrapping
+    application/pkcs7-mime parts, and sorts the parts by what they are used
+    for: text and HTML bodies, attachments along with the message they are
+    part of, inline content with its Content-ID, and the signed parts of the
+    outermost message."""
+    parts: Dict[str, List[Any]] = {"text/plain": [], "text/html": [], "attachments": [], "inline": [], "signed": []}
+    for part in email_msg.walk():
+        if part.get('Content-Type') and "signed" in part.get('Content-Type'):  # type: ignore[operator]
+            parts["signed"].append(part)
+        if part.get_content_maintype() == "multipart":
+            continue
+
+        content_type = part.get_content_type()
+        disposition = part.get_content_disposition()
+        if content_type in ["text/plain", "text/html"]:
+            parts[content_type].append(part)
+        content_id = part.get("Content-Id") or part.get("Content-ID")
+        # inline is the default without disposition as per RFC 2183
+        if content_id and (disposition == "inline" or disposition is None):
+            parts["inline"].append((content_id.strip('<>'), part))
+        is_attachment = is_attachment_part(content_type, disposition)
+        if is_attachment:
+            parts["attachments"].append((part, email_msg))
+
+        if content_type == "application/pkcs7-mime":
+            # https://stackoverflow.com/questions/58427642/how-to-extract-data-from-application-pkcs7-mime-using-the-email-module-in-pyth
+            content_info = cms.ContentInfo.load(part.get_payload(decode=True))
+            compressed_data = content_info['content']
+            smime = compressed_data['encap_content_info']['content'].native
+            nested = walk_message(email.message_from_bytes(smime, policy=policy))  # type: ignore[arg-type]
+            parts["text/plain"] += nested["text/plain"]
+            parts["text/html"] += nested["text/html"]
+            parts["inline"] += nested["inline"]
+            # "nested" attachments
+            if is_attachment:
+                parts["attachments"] += nested["attachments"]
+    return parts
+
+
 # Copilot
-def get_inline_content(email_msg: email.message.Message) -> Dict[str, Tuple[str, bytes]]:
+def get_inline_content(email_msg: email.message.Message, parts: Optional[Dict[str, List[Any]]] = None) -> Dict[str, Tuple[str, bytes]]:
     """Extracts inline content with Content-ID from email message.
 
     Returns a dictionary mapping Content-ID (with angle brackets stripped) to
@@ -808,53 +1588,32 @@ def get_inline_content(email_msg: email.message.Message) -> Dict[str, Tuple[str,
 
     Args:
         email_msg: The email message to extract inline images from
+        parts: The parts of the message as sorted by `walk_message`, if
+            already done
 
     Returns:
         Dictionary mapping Content-ID strings to (content_type, binary_data) tuples
     """
     inline_content = {}
-    for part in email_msg.walk():
-        if part.get_content_maintype() == "multipart":
-            continue
-        content_id = part.get("Content-Id") or part.get("Content-ID")
-        if content_id:
-            disposition = part.get_content_disposition()
-            # Include parts with inline disposition or no disposition (default is inline per RFC 2183)
-            if disposition == "inline" or disposition is None:
-                # Remove angle brackets if present
-                cid = content_id.strip('<>')
-                content_type = part.get_content_type()
-                try:
-                    # Get the binary content
-                    data = bytes(part.get_payload(decode=True))
-                    if data:
-                        inline_content[cid] = (content_type, data)
-                except Exception:
-                    pass
+    for cid, part in (parts if parts is not None else walk_message(email_msg))["inline"]:
+        content_type = part.get_content_type()
+        try:
+            # Get the binary content
+            data = bytes(part.get_payload(decode=True))
+            if data:
+                inline_content[cid] = (content_type, data)
+        except Exception:
+            pass
     return inline_content
 
 
-def get_nested_body(email_msg: email.message.Message, html: bool = False) -> Tuple[str, bool]:
-    """Gets all, potentially MIME-nested bodies."""
-    has_html = False
-    content = ""
-    for part in email_msg.walk():
-        if part.get_content_type() == "text/plain" and html is False:
-            content += part.get_content()  # type: ignore[attr-defined]
-        elif part.get_content_type() == "text/html":
-            has_html = True
-            if html is True:
-                content += part.get_content()  # type: ignore[attr-defined]
-        elif part.get_content_type() == "application/pkcs7-mime":
-            # https://stackoverflow.com/questions/58427642/how-to-extract-data-from-application-pkcs7-mime-using-the-email-module-in-pyth
-            content_info = cms.ContentInfo.load(part.get_payload(decode=True))
-            compressed_data = content_info['content']
-            smime = compressed_data['encap_content_info']['content'].native
-            tmp = email.message_from_bytes(smime, policy=policy)  # type: ignore[arg-type]
-            tmp_content, tmp_has_html = get_nested_body(tmp, html)
-            content += tmp_content
-            if tmp_has_html:
-                has_html = True
+def get_nested_body(email_msg: email.message.Message, html: bool = False, parts: Optional[Dict[str, List[Any]]] = None) -> Tuple[str, bool]:
+    """Gets all, potentially MIME-nested bodies, optionally from parts already
+    sorted by `walk_message`."""
+    if parts is None:
+        parts = walk_message(email_msg)
+    has_html = len(parts["text/html"]) > 0
+    content = "".join(part.get_content() for part in parts["text/html" if html else "text/plain"])
 
     if html is True and content:
         try:
@@ -877,7 +1636,7 @@ def get_nested_body(email_msg: email.message.Message, html: bool = False) -> Tup
         # Copilot
         # Replace cid: references with data URIs for inline content
         if "cid:" in content.lower():
-            inline_content = get_inline_content(email_msg)
+            inline_content = get_inline_content(email_msg, parts)
             if inline_content:
                 # Replace cid: references in src attributes (with optional whitespace around =)
                 def replace_cid(match):
@@ -898,7 +1657,7 @@ def get_nested_body(email_msg: email.message.Message, html: bool = False) -> Tup
                 strip_tags(soup)
                 content = ''.join(soup.get_text("\n\n", strip=True))
         else:
-            content_html, _ = get_nested_body(email_msg, True)
+            content_html, _ = get_nested_body(email_msg, True, parts)
             soup = BeautifulSoup(content_html, features='html.parser')
             strip_tags(soup)
             content = ''.join(soup.get_text("\n\n", strip=True))
@@ -942,108 +1701,121 @@ def attendee_matches_addr(c: icalendar.vCalAddress, message: email.message.Messa
     return False
 
 
-def get_attachments(email_msg: email.message.Message, content: bool = False) -> List[Dict[str, Any]]:
-    """Returns all attachments for an email message."""
+def estimate_content_size(part: email.message.Message) -> int:
+    """Estimates the decoded size of a part from its encoded payload and
+    transfer encoding, without decoding it."""
+    payload = part.get_payload()
+    if not isinstance(payload, str):  # attached message
+        return len(bytes(part.get_content()))  # type: ignore[attr-defined]
+    cte = str(part.get("Content-Transfer-Encoding", "")).strip().lower()
+    if cte == "base64":
+        tail = payload[-8:].rstrip()
+        padding = len(tail) - len(tail.rstrip("="))
+        chars = len(payload) - payload.count("\n") - payload.count("\r") - payload.count(" ")
+        return max(chars * 3 // 4 - padding, 0)
+    if cte == "quoted-printable":
+        # escapes and soft line breaks both shrink by two characters
+        return len(payload) - 2 * payload.count("=")
+    return len(payload)
+
+
+def get_attachments(email_msg: email.message.Message, content: bool = False, parts: Optional[Dict[str, List[Any]]] = None) -> List[Dict[str, Any]]:
+    """Returns all attachments for an email message, optionally from parts
+    already sorted by `walk_message`. Without content, only calendars are
+    decoded and the size of everything else is estimated."""
     attachments = []
-    for part in email_msg.walk():
-        if part.get_content_maintype() == "multipart":
-            continue
-        if (part.get_content_disposition() in ["attachment", "inline"] or part.get_content_type() == "text/calendar") and not (part.get_content_disposition() == "inline" and part.get_content_type() == "text/plain"):
+    for part, owner in (parts if parts is not None else walk_message(email_msg))["attachments"]:
+        is_calendar = part.get_content_type() == "text/calendar" or part.get_content_type() == "text/x-vcalendar"
+        if content or is_calendar:
             ctnt = part.get_content()  # type: ignore[attr-defined]
-            preview = None
-            if part.get_content_type() == "text/calendar" or part.get_content_type() == "text/x-vcalendar":
-                # create "preview"
-                try:
-                    if "BEGIN:VCALENDAR" in ctnt and "END:VCALENDAR" not in ctnt:
-                        ctnt += "END:VCALENDAR"  # thanks outlook!
-                    gcal = icalendar.Calendar.from_ical(ctnt)
-                    timezone = None
-                    status = None
-                    for component in gcal.walk("VEVENT"):
-                        if component.get("organizer"):
-                            try:
-                                people = [component.get("organizer").params["CN"]]
-                            except KeyError:
-                                people = []
-                        else:
-                            people = []
-                        try:
-                            a = component.get("attendee")
-                            if isinstance(a, list):
-                                for c in a:
-                                    people.append(c.params["CN"])
-                                    if attendee_matches_addr(c, email_msg):
-                                        status = c.params["PARTSTAT"]
-                            elif a:
-                                people.append(a.params["CN"])
-                                if attendee_matches_addr(a, email_msg):
-                                    status = a.params["PARTSTAT"]
-                        except KeyError:
-                            pass
-
-                        dtstart = None
-                        dtend = None
-                        try:
-                            def get_timestamp(dt: datetime.date) -> int:
-                                if isinstance(dt, datetime.datetime):
-                                    return int(dt.timestamp())
-                                # Convert date to datetime at midnight
-                                dt_with_time = datetime.datetime.combine(dt, datetime.datetime.min.time())
-                                return int(dt_with_time.timestamp())
-
-                            dtstart = get_timestamp(component.get("dtstart").dt)
-                            dtend = get_timestamp(component.get("dtend").dt)
-
-                            # this assumes that start and end are the same timezone
-                            timezone = str(component.get("dtstart").dt.tzinfo)
-                        except AttributeError:  # stuff missing
-                            pass
-                        try:
-                            rrule = component.get("rrule").to_ical().decode("utf8")
-                            recur = RecurringEvent().format(rrulestr(component.get("rrule").to_ical().decode("utf8")))
-                        except AttributeError:
-                            rrule = None
-                            recur = ""
+            content_size = len(bytes(ctnt, "utf8")) if isinstance(ctnt, str) else len(bytes(ctnt))
+        else:
+            ctnt = None
+            content_size = estimate_content_size(part)
+        preview = None
+        if is_calendar:
+            # create "preview"
+            try:
+                if "BEGIN:VCALENDAR" in ctnt and "END:VCALENDAR" not in ctnt:
+                    ctnt += "END:VCALENDAR"  # thanks outlook!
+                gcal = icalendar.Calendar.from_ical(ctnt)
+                timezone = None
+                status = None
+                for component in gcal.walk("VEVENT"):
+                    if component.get("organizer"):
                         try:
-                            method = gcal["method"]
+                            people = [component.get("organizer").params["CN"]]
                         except KeyError:
-                            method = None
-                        preview = {
-                            "method": method,
-                            "status": status,
-                            "summary": component.get("summary"),
-                            "location": component.get("location"),
-                            "start": dtstart,
-                            "dtstart": component.get("dtstart").to_ical().decode("utf8") if component.get("dtstart") else None,
-                            "end": dtend,
-                            "dtend": component.get("dtend").to_ical().decode("utf8") if component.get("dtend") else None,
-                            "attendees": ", ".join(people),
-                            "recur": recur,
-                            "rrule": rrule
-                        }
-                except ValueError:
-                    pass
-
-                if preview and timezone:
-                    preview["tz"] = timezone
-
-            attachments.append({
-                "filename": part.get_filename() if part.get_filename() else "unnamed attachment",
-                "content_type": part.get_content_type(),
-                "content_size": len(bytes(ctnt, "utf8")) if isinstance(ctnt, str) else len(bytes(ctnt)),
-                "content": ctnt if content else None,
-                "preview": preview
-            })
+                            people = []
+                    else:
+                        people = []
+                    try:
+                        a = component.get("attendee")
+                        if isinstance(a, list):
+                            for c in a:
+                                people.append(c.params["CN"])
+                                if attendee_matches_addr(c, owner):
+                                    status = c.params["PARTSTAT"]
+                        elif a:
+                            people.append(a.params["CN"])
+                            if attendee_matches_addr(a, owner):
+                                status = a.params["PARTSTAT"]
+                    except KeyError:
+                        pass
 
-            # "nested" attachments
-            if part.get_content_type() == "application/pkcs7-mime":
-                # https://stackoverflow.com/questions/58427642/how-to-extract-data-from-application-pkcs7-mime-using-the-email-module-in-pyth
-                content_info = cms.ContentInfo.load(part.get_payload(decode=True))
-                compressed_data = content_info['content']
-                smime = compressed_data['encap_content_info']['content'].native
-                tmp = email.message_from_bytes(smime, policy=policy)  # type: ignore[arg-type]
-                att_tmp = get_attachments(tmp, content)
-                attachments += att_tmp
+                    dtstart = None
+                    dtend = None
+                    try:
+                        def get_timestamp(dt: datetime.date) -> int:
+                            if isinstance(dt, datetime.datetime):
+                                return int(dt.timestamp())
+                            # Convert date to datetime at midnight
+                            dt_with_time = datetime.datetime.combine(dt, datetime.datetime.min.time())
+                            return int(dt_with_time.timestamp())
+
+                        dtstart = get_timestamp(component.get("dtstart").dt)
+                        dtend = get_timestamp(component.get("dtend").dt)
+
+                        # this assumes that start and end are the same timezone
+                        timezone = str(component.get("dtstart").dt.tzinfo)
+                    except AttributeError:  # stuff missing
+                        pass
+                    try:
+                        rrule = component.get("rrule").to_ical().decode("utf8")
+                        recur = RecurringEvent().format(rrulestr(component.get("rrule").to_ical().decode("utf8")))
+                    except AttributeError:
+                        rrule = None
+                        recur = ""
+                    try:
+                        method = gcal["method"]
+                    except KeyError:
+                        method = None
+                    preview = {
+                        "method": method,
+                        "status": status,
+                        "summary": component.get("summary"),
+                        "location": component.get("location"),
+                        "start": dtstart,
+                        "dtstart": component.get("dtstart").to_ical().decode("utf8") if component.get("dtstart") else None,
+                        "end": dtend,
+                        "dtend": component.get("dtend").to_ical().decode("utf8") if component.get("dtend") else None,
+                        "attendees": ", ".join(people),
+                        "recur": recur,
+                        "rrule": rrule
+                    }
+            except ValueError:
+                pass
+
+            if preview and timezone:
+                preview["tz"] = timezone
+
+        attachments.append({
+            "filename": part.get_filename() if part.get_filename() else "unnamed attachment",
+            "content_type": part.get_content_type(),
+            "content_size": content_size,
+            "content": ctnt if content else None,
+            "preview": preview
+        })
     return attachments
 
 
@@ -1180,10 +1952,14 @@ def smime_verify(part: email.message.Message, accts: List[Dict[str, Any]]) -> Di
         return {"valid": False, "message": f"An internal error has occurred: {str(e)}"}
 
 
-def eml_to_json(message_bytes: bytes) -> Dict[str, Any]:
-    """Converts an eml attachment (represented as bytes) to a JSON object."""
-    email_msg = email.message_from_bytes(message_bytes, policy=policy)  # type: ignore[arg-type]
-    body, has_html = get_nested_body(email_msg)
+def eml_to_json(message_bytes: bytes, get_body: bool = True) -> Dict[str, Any]:
+    """Converts an eml attachment (represented as bytes) to a JSON object.
+    Without body, only the headers are parsed."""
+    if get_body:
+        email_msg = email.message_from_bytes(message_bytes, policy=policy)  # type: ignore[arg-type]
+        body, has_html = get_nested_body(email_msg)
+    else:
+        email_msg = parse_headers(io.BytesIO(message_bytes))
     res = {
         "from": email_msg["from"].strip().replace('\t', ' ') if "from" in email_msg else "",
         "to": split_email_addresses(email_msg["to"]) if "to" in email_msg else [],
@@ -1199,7 +1975,7 @@ def eml_to_json(message_bytes: bytes) -> Dict[str, Any]:
         "body": {
             "text/plain": body,
             "text/html": has_html
-        },
+        } if get_body else None,
         "attachments": [],
         "notmuch_id": None,
         "tags": [],
@@ -1208,78 +1984,328 @@ def eml_to_json(message_bytes: bytes) -> Dict[str, Any]:
     return res
 
 
-def message_to_json(msg: notmuch2.Message, get_deleted_body: bool = False) -> Dict[str, Any]:
-    """Converts a `notmuch2.Message` instance to a JSON object."""
+def get_cache_dir() -> str:
+    """Get the cache directory of kukulkan, creating it if necessary. Only the
+    user has access, as it holds the content of messages."""
+    cache_path = (
+        os.getenv("XDG_CACHE_HOME")
+        if os.getenv("XDG_CACHE_HOME")
+        else os.path.join(os.getenv("HOME", ""), ".cache")
+    )
+    cache_dir = os.path.join(cache_path, "kukulkan")  # type: ignore[arg-type]
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    # created before with the default permissions otherwise
+    os.chmod(cache_dir, 0o700)
+    return cache_dir
+
+
+def private_file(path: str) -> str:
+    """Creates a file only the user can read and write, unless it exists
+    already, and returns its path."""
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    return path
+
+
+def get_message_store() -> Optional[sqlite3.Connection]:
+    """Get the store of rendered messages in the cache directory if enabled.
+    Cached on first call."""
+    if current_app.config.custom.get("message-store") != "true":  # type: ignore[attr-defined]
+        return None
+    if g.get("message_store") is None:
+        g.message_store = sqlite3.connect(private_file(os.path.join(get_cache_dir(), "messages.sqlite")), timeout=5)
+        # by message id rather than file, which is renamed when flags change
+        g.message_store.execute("CREATE TABLE IF NOT EXISTS rendered (id TEXT PRIMARY KEY, mtime INTEGER, config TEXT, rendered TEXT, size INTEGER, used REAL)")
+        g.message_store.execute("CREATE TABLE IF NOT EXISTS attachments (id TEXT PRIMARY KEY, mtime INTEGER, attachments TEXT)")
+    return g.message_store
+
+
+def get_message_store_size() -> int:
+    """Get the configured total size of rendered messages in the message
+    store in bytes."""
+    try:
+        return int(current_app.config.custom["message-store-size"]) * 1024 * 1024  # type: ignore[attr-defined]
+    except KeyError:
+        return 256 * 1024 * 1024
+
+
+def rendering_config_hash() -> str:
+    """Hash of everything besides the message file that rendering depends on,
+    i.e. the relevant configuration and this code."""
+    conf = {key: current_app.config.custom.get(key) for key in ["filter", "accounts", "ca-bundle"]}  # type: ignore[attr-defined]
+    conf["code"] = os.stat(__file__).st_mtime_ns
+    return hashlib.sha256(json.dumps(conf, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def load_rendered_message(msg: notmuch2.Message) -> Optional[Dict[str, Any]]:
+    """Returns the rendered body, attachments and signature of a
+    `notmuch2.Message` instance from the message store if there and
+    up-to-date."""
+    try:
+        store = get_message_store()
+        if store is None:
+            return None
+        key = (msg.messageid, os.stat(msg.path).st_mtime_ns, rendering_config_hash())
+        row = store.execute("SELECT rendered FROM rendered WHERE id = ? AND mtime = ? AND config = ?", key).fetchone()
+        if row is None:
+            return None
+        with store:
+            store.execute("UPDATE rendered SET used = ? WHERE id = ?", (time.time(), msg.messageid))
+    except (sqlite3.Error, OSError) as e:
+        current_app.logger.warning(f"Message store unavailable: {str(e)}")
+        return None
+    return json.loads(row[0])
+
+
+def store_rendered_message(msg: notmuch2.Message, rendered: Dict[str, Any]) -> None:
+    """Keeps the rendered body, attachments and signature of a
+    `notmuch2.Message` instance in the message store if enabled, removing the
+    least recently used ones beyond the configured total size."""
+    # failed verification may succeed later, e.g. with a new key
+    if rendered["signature"] is not None and not rendered["signature"]["valid"]:
+        return
+    try:
+        store = get_message_store()
+        if store is None:
+            return
+        key = (msg.messageid, os.stat(msg.path).st_mtime_ns, rendering_config_hash())
+        data = current_app.json.dumps(rendered)
+        with store:
+            store.execute("INSERT OR REPLACE INTO rendered VALUES (?, ?, ?, ?, ?, ?)",
+                          key + (data, len(data), time.time()))
+            total = store.execute("SELECT SUM(size) FROM rendered").fetchone()[0]
+            limit = get_message_store_size()
+            if total > limit:
+                for old_id, size in store.execute("SELECT id, size FROM rendered ORDER BY used").fetchall():
+                    if total <= limit:
+                        break
+                    store.execute("DELETE FROM rendered WHERE id = ?", (old_id,))
+                    store.execute("DELETE FROM attachments WHERE id = ?", (old_id,))
+                    total -= size
+    except (sqlite3.Error, OSError) as e:
+        current_app.logger.warning(f"Message store unavailable: {str(e)}")
+
+
+def get_rendered_message(msg: notmuch2.Message, from_addr: Optional[str]) -> Dict[str, Any]:
+    """Returns the rendered body, attachments and signature of a
+    `notmuch2.Message` instance, from the message store if there and
+    up-to-date."""
+    rendered = load_rendered_message(msg)
+    if rendered is None:
+        rendered = render_message(msg, from_addr)
+        store_rendered_message(msg, rendered)
+    return rendered
+
+
+def get_thumbnail_cache_size() -> int:
+    """Get the configured total size of cached thumbnails in bytes."""
+    try:
+        return int(current_app.config.custom["thumbnail-cache-size"]) * 1024 * 1024  # type: ignore[attr-defined]
+    except KeyError:
+        return 0
+
+
+def get_thumbnail_store() -> Optional[sqlite3.Connection]:
+    """Get the index of cached thumbnails in the cache directory if enabled.
+    Cached on first call."""
+    if get_thumbnail_cache_size() <= 0:
+        return None
+    if g.get("thumbnail_store") is None:
+        os.makedirs(os.path.join(get_cache_dir(), "thumbnails"), mode=0o700, exist_ok=True)
+        g.thumbnail_store = sqlite3.connect(private_file(os.path.join(get_cache_dir(), "thumbnails.sqlite")), timeout=5)
+        g.thumbnail_store.execute("CREATE TABLE IF NOT EXISTS thumbnails (key TEXT PRIMARY KEY, content_type TEXT, filename TEXT, size INTEGER, used REAL)")
+    return g.thumbnail_store
+
+
+def thumbnail_key(*parts: Any) -> str:
+    """Key of the thumbnail described by the given parts, e.g. message id,
+    attachment number and size."""
+    return hashlib.sha256(json.dumps(parts).encode("utf8")).hexdigest()
+
+
+def load_thumbnail(key: str) -> Optional[Tuple[str, str, str]]:
+    """Returns the file, content type and filename of a cached thumbnail if
+    there, marking it as recently used."""
+    try:
+        store = get_thumbnail_store()
+        if store is None:
+            return None
+        row = store.execute("SELECT content_type, filename FROM thumbnails WHERE key = ?", (key,)).fetchone()
+        path = os.path.join(get_cache_dir(), "thumbnails", key)
+        if row is None or not os.path.exists(path):
+            return None
+        with store:
+            store.execute("UPDATE thumbnails SET used = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error as e:
+        current_app.logger.warning(f"Thumbnail cache unavailable: {str(e)}")
+        return None
+    return path, row[0], row[1]
+
+
+def store_thumbnail(key: str, data: bytes, content_type: str, filename: str) -> None:
+    """Keeps a thumbnail in the cache if enabled, removing the least recently
+    used ones beyond the configured total size."""
+    try:
+        store = get_thumbnail_store()
+        if store is None:
+            return
+        directory = os.path.join(get_cache_dir(), "thumbnails")
+        fd, tmp = mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(directory, key))
+        with store:
+            store.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?)",
+                          (key, content_type, filename, len(data), time.time()))
+            total = store.execute("SELECT SUM(size) FROM thumbnails").fetchone()[0]
+            limit = get_thumbnail_cache_size()
+            for old_key, size in store.execute("SELECT key, size FROM thumbnails ORDER BY used").fetchall():
+                if total <= limit:
+                    break
+                store.execute("DELETE FROM thumbnails WHERE key = ?", (old_key,))
+                try:
+                    os.unlink(os.path.join(directory, old_key))
+                except FileNotFoundError:
+                    pass
+                total -= size
+    except (sqlite3.Error, OSError) as e:
+        current_app.logger.warning(f"Thumbnail cache unavailable: {str(e)}")
+
+
+def init_render_worker(custom: Dict[str, Any]) -> None:
+    """Sets up an application context with the given configuration for
+    rendering messages in a worker process."""
+    app = Flask(__name__)
+    app.config.custom = custom  # type: ignore[attr-defined]
+    app.message_cache = {"lock": threading.Lock(), "messages": collections.OrderedDict(), "size": 0}  # type: ignore[attr-defined]
+    app.app_context().push()
+
+
+def render_in_worker(path: str, messageid: str, from_addr: Optional[str]) -> Dict[str, Any]:
+    """Renders the message in the given file in a worker process."""
+    return render_message(types.SimpleNamespace(path=path, messageid=messageid), from_addr)  # type: ignore[arg-type]
+
+
+def init_warmup_worker(custom: Dict[str, Any]) -> None:
+    """Sets up a worker process for warming up caches at the lowest priority,
+    so that it doesn't slow down the server."""
+    os.nice(19)
+    init_render_worker(custom)
+
+
+def warm_up_message(path: str, messageid: str, from_addr: Optional[str], pause: float = 0) -> None:
+    """Renders the message in the given file into the message store, locates
+    its attachments and scales its images into the thumbnail cache, as far as
+    enabled. Waits for the given number of seconds afterwards."""
+    msg = types.SimpleNamespace(path=path, messageid=messageid)
+    rendered = get_rendered_message(msg, from_addr)  # type: ignore[arg-type]
+    index = get_attachment_index(msg)  # type: ignore[arg-type]
+    for num in range(len(index or [])):
+        get_attachment_size(msg, index, num)  # type: ignore[arg-type]
+    if get_thumbnail_store() is not None:
+        # as requested by browsers for the message view
+        webp = bool(features.check("webp"))
+        for num, att in enumerate(rendered["attachments"]):
+            key = thumbnail_key(messageid, num, 500, 75, webp)
+            if "image" in att["content_type"] and load_thumbnail(key) is None:
+                d = message_attachment(msg, num)  # type: ignore[arg-type]
+                if d is not None:
+                    make_thumbnail(key, d, 500, 75, webp)
+    time.sleep(pause)
+
+
+def render_message(msg: notmuch2.Message, from_addr: Optional[str]) -> Dict[str, Any]:
+    """Renders body, attachments and signature of a `notmuch2.Message` instance
+    from its file."""
+    email_msg = email_from_notmuch(msg)
+
+    parts = walk_message(email_msg)
+    attachments = get_attachments(email_msg, parts=parts)
+    body, has_html = get_nested_body(email_msg, parts=parts)
+
+    signature = None
+    # signature verification
+    # https://gist.github.com/russau/c0123ef934ef88808050462a8638a410
+    for part in parts["signed"]:
+        if "pkcs7-signature" in part.get('Content-Type') or "pkcs7-mime" in part.get('Content-Type'):  # type: ignore[operator]
+            try:
+                accounts = current_app.config.custom["accounts"]  # type: ignore[attr-defined]
+                accts = [acct for acct in accounts if from_addr and acct["email"] in from_addr]
+            except KeyError:
+                accts = []
+            signature = smime_verify(part, accts)
+        elif "pgp-signature" in part.get('Content-Type'):  # type: ignore[operator]
+            signed_content = bytes(part.get_payload()[0])  # type: ignore[arg-type, index]
+            sig = bytes(part.get_payload()[1])  # type: ignore[arg-type, index]
+            gpg = GPG()
+            public_keys = gpg.list_keys()
+            addr = None
+            try:
+                if from_addr is not None:
+                    [_, address] = from_addr.split('<')
+                    addr = address.split('>')[0]
+                else:
+                    addr = from_addr  # type: ignore[assignment]
+            except ValueError:
+                pass
+
+            if addr is None:
+                signature = {"valid": False, "message": "No from address!"}
+            else:
+                found = False
+                for pkey in public_keys:
+                    for uid in pkey.get('uids'):
+                        if addr in uid:
+                            found = True
+                if not found and 'gpg-keyserver' in current_app.config.custom:  # type: ignore[attr-defined]
+                    current_app.logger.info(f"Key for {addr} not found, attempting to download...")
+                    # TODO: handle case where server is unreachable
+                    keys = gpg.search_keys(addr, current_app.config.custom['gpg-keyserver'])  # type: ignore[attr-defined]
+                    if len(keys) > 0:
+                        for key in keys:
+                            current_app.logger.info(f"Getting key {key.get('keyid')}")
+                            gpg.recv_keys(current_app.config.custom['gpg-keyserver'], key.get('keyid'))  # type: ignore[attr-defined]
+                osfile, path = mkstemp()
+                try:
+                    with os.fdopen(osfile, 'wb') as fd:
+                        fd.write(sig)
+                        fd.close()
+                        verified = gpg.verify_data(path, signed_content)  # type: ignore[attr-defined]
+                        if verified.valid:
+                            signature = {"valid": True}
+                        else:
+                            signature = {"valid": False, "message": f"{verified.status}, {verified.problems[0]['status']}"}
+                except Exception as e:
+                    current_app.logger.error(f"Exception in gpg_verify: {str(e)}")
+                    signature = {"valid": False, "message": "An internal error has occurred."}
+                finally:
+                    os.unlink(path)
+
+    return {"attachments": attachments, "body": body, "has_html": has_html, "signature": signature}
+
+
+def message_to_json(msg: notmuch2.Message, get_deleted_body: bool = False, get_body: bool = True,
+                    rendered: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Converts a `notmuch2.Message` instance to a JSON object. Without body,
+    only attachment metadata is taken from the message file. Uses the rendered
+    body, attachments and signature if given."""
     from_addr = get_header(msg, "from")
     if "deleted" in msg.tags and get_deleted_body is False:
         attachments = []
         body = "(deleted message)"
         has_html = False
         signature = None
-    else:
-        email_msg = email_from_notmuch(msg)
-
-        attachments = get_attachments(email_msg)
-        body, has_html = get_nested_body(email_msg)
-
+    elif not get_body:
+        attachments = get_attachments(email_from_notmuch(msg))
+        body = None
+        has_html = False
         signature = None
-        # signature verification
-        # https://gist.github.com/russau/c0123ef934ef88808050462a8638a410
-        for part in email_msg.walk():
-            if part.get('Content-Type') and "signed" in part.get('Content-Type'):  # type: ignore[operator]
-                if "pkcs7-signature" in part.get('Content-Type') or "pkcs7-mime" in part.get('Content-Type'):  # type: ignore[operator]
-                    try:
-                        accounts = current_app.config.custom["accounts"]  # type: ignore[attr-defined]
-                        accts = [acct for acct in accounts if from_addr and acct["email"] in from_addr]
-                    except KeyError:
-                        accts = []
-                    signature = smime_verify(part, accts)
-                elif "pgp-signature" in part.get('Content-Type'):  # type: ignore[operator]
-                    signed_content = bytes(part.get_payload()[0])  # type: ignore[arg-type, index]
-                    sig = bytes(part.get_payload()[1])  # type: ignore[arg-type, index]
-                    gpg = GPG()
-                    public_keys = gpg.list_keys()
-                    addr = None
-                    try:
-                        if from_addr is not None:
-                            [_, address] = from_addr.split('<')
-                            addr = address.split('>')[0]
-                        else:
-                            addr = from_addr  # type: ignore[assignment]
-                    except ValueError:
-                        pass
-
-                    if addr is None:
-                        signature = {"valid": False, "message": "No from address!"}
-                    else:
-                        found = False
-                        for pkey in public_keys:
-                            for uid in pkey.get('uids'):
-                                if addr in uid:
-                                    found = True
-                        if not found and 'gpg-keyserver' in current_app.config.custom:  # type: ignore[attr-defined]
-                            current_app.logger.info(f"Key for {addr} not found, attempting to download...")
-                            # TODO: handle case where server is unreachable
-                            keys = gpg.search_keys(addr, current_app.config.custom['gpg-keyserver'])  # type: ignore[attr-defined]
-                            if len(keys) > 0:
-                                for key in keys:
-                                    current_app.logger.info(f"Getting key {key.get('keyid')}")
-                                    gpg.recv_keys(current_app.config.custom['gpg-keyserver'], key.get('keyid'))  # type: ignore[attr-defined]
-                        osfile, path = mkstemp()
-                        try:
-                            with os.fdopen(osfile, 'wb') as fd:
-                                fd.write(sig)
-                                fd.close()
-                                verified = gpg.verify_data(path, signed_content)  # type: ignore[attr-defined]
-                                if verified.valid:
-                                    signature = {"valid": True}
-                                else:
-                                    signature = {"valid": False, "message": f"{verified.status}, {verified.problems[0]['status']}"}
-                        except Exception as e:
-                            current_app.logger.error(f"Exception in gpg_verify: {str(e)}")
-                            signature = {"valid": False, "message": "An internal error has occurred."}
-                        finally:
-                            os.unlink(path)
+    else:
+        if rendered is None:
+            rendered = get_rendered_message(msg, from_addr)
+        attachments = rendered["attachments"]
+        body = rendered["body"]
+        has_html = rendered["has_html"]
+        signature = rendered["signature"]
 
     res = {
         "from": from_addr,
@@ -1296,7 +2322,7 @@ def message_to_json(msg: notmuch2.Message, get_deleted_body: bool = False) -> Di
         "body": {
             "text/plain": body,
             "text/html": has_html
-        },
+        } if body is not None else None,
         "attachments": attachments,
         "notmuch_id": msg.messageid,
         "tags": list(msg.tags),
@@ -1308,6 +2334,229 @@ def message_to_json(msg: notmuch2.Message, get_deleted_body: bool = False) -> Di
     return res
 
 
+def index_mime_parts(fp: BinaryIO) -> List[Dict[str, Any]]:
+    """Returns type, disposition, filename, transfer encoding and the byte range
+    of the body of every part of a message that isn't multipart, in the order
+    of `walk()`. The file is read line by line rather than parsed as a
+    whole."""
+    parts: List[Dict[str, Any]] = []
+    # delimiters of the enclosing multiparts, innermost last
+    boundaries: List[bytes] = []
+    # parts whose body hasn't ended yet, with the number of enclosing multiparts
+    open_parts: List[Tuple[int, Dict[str, Any]]] = []
+    header_lines: Optional[List[bytes]] = []
+    offset = 0
+    # the line break before a delimiter belongs to the delimiter
+    prev_eol = 0
+
+    def close(depth: int, end: int) -> None:
+        while open_parts and open_parts[-1][0] >= depth:
+            part = open_parts.pop()[1]
+            part["end"] = max(end, part["start"])
+
+    for line in fp:
+        start = offset
+        offset += len(line)
+        if header_lines is not None:
+            if line not in (b"\n", b"\r\n"):
+                header_lines.append(line)
+                continue
+            headers = email.parser.BytesHeaderParser(policy=policy).parsebytes(b"".join(header_lines))  # type: ignore[arg-type]
+            header_lines = None
+            prev_eol = len(line)
+            boundary = headers.get_param("boundary")
+            if headers.get_content_maintype() == "multipart" and isinstance(boundary, str):
+                boundaries.append(b"--" + boundary.encode("utf8"))
+                continue
+            part = {
+                "content_type": headers.get_content_type(),
+                "disposition": headers.get_content_disposition(),
+                "filename": headers.get_filename(),
+                "cte": str(headers.get("Content-Transfer-Encoding", "7bit")).strip().lower(),
+                "start": offset,
+                "end": offset
+            }
+            parts.append(part)
+            open_parts.append((len(boundaries), part))
+            if part["content_type"] == "message/rfc822":
+                # headers of the attached message follow directly
+                header_lines = []
+            continue
+
+        if line.startswith(b"--"):
+            delimiter = line.rstrip()
+            for depth in range(len(boundaries) - 1, -1, -1):
+                if delimiter in (boundaries[depth], boundaries[depth] + b"--"):
+                    close(depth + 1, start - prev_eol)
+                    del boundaries[depth + 1:]
+                    if delimiter == boundaries[depth]:
+                        header_lines = []
+                    else:
+                        # epilogue, part of the enclosing multipart
+                        boundaries.pop()
+                    break
+        prev_eol = len(line) - len(line.rstrip(b"\r\n"))
+    close(0, offset)
+    return parts
+
+
+def get_attachment_index(message: notmuch2.Message) -> Optional[List[Dict[str, Any]]]:
+    """Returns the type, filename, transfer encoding and byte range in the file
+    of every attachment of a `notmuch2.Message` instance. Built on first access
+    and kept in the message store; None if the store is disabled or the
+    attachments can't be located in the file, e.g. inside S/MIME."""
+    try:
+        store = get_message_store()
+        if store is None:
+            return None
+        key = (message.messageid, os.stat(message.path).st_mtime_ns)
+        row = store.execute("SELECT attachments FROM attachments WHERE id = ? AND mtime = ?", key).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+        with open(message.path, "rb") as f:
+            parts = [part for part in index_mime_parts(f) if is_attachment_part(part["content_type"], part["disposition"])]
+        # must be the same attachments as when parsing the whole message, and
+        # those nested in S/MIME can't be located
+        expected = [(part.get_content_type(), part.get_filename(), str(part.get("Content-Transfer-Encoding", "7bit")).strip().lower())
+                    for part, _ in walk_message(email_from_notmuch(message))["attachments"]]
+        found = [(part["content_type"], part["filename"], part["cte"]) for part in parts]
+        pkcs7 = any(part["content_type"] == "application/pkcs7-mime" for part in parts)
+        attachments = parts if found == expected and not pkcs7 else None
+        with store:
+            store.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)", key + (json.dumps(attachments),))
+        return attachments
+    except (sqlite3.Error, OSError) as e:
+        current_app.logger.warning(f"Message store unavailable: {str(e)}")
+        return None
+
+
+def get_attachment_size(message: notmuch2.Message, attachments: List[Dict[str, Any]], num: int) -> int:
+    """Returns the decoded size of attachment no. `num` in the attachment index
+    of a `notmuch2.Message` instance, for serving byte ranges. Measured on
+    first access and kept in the index."""
+    part = attachments[num]
+    if part.get("size") is None:
+        part["size"] = sum(len(chunk) for chunk in stream_part(str(message.path), part["start"], part["end"], part["cte"]))
+        try:
+            store = get_message_store()
+            if store is not None:
+                key = (message.messageid, os.stat(message.path).st_mtime_ns)
+                with store:
+                    store.execute("UPDATE attachments SET attachments = ? WHERE id = ? AND mtime = ?", (json.dumps(attachments),) + key)
+        except (sqlite3.Error, OSError) as e:
+            current_app.logger.warning(f"Message store unavailable: {str(e)}")
+    return part["size"]
+
+
+# everything but the base64 alphabet, ignored when decoding
+BASE64_IGNORED = bytes(c for c in range(256)
+                       if c not in b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+
+
+def stream_part(path: str, start: int, end: int, cte: str, chunk_size: int = 65536) -> Generator[bytes, None, None]:
+    """Reads a byte range of a file in chunks, decoding base64 or
+    quoted-printable on the way. Line breaks are converted the same way as
+    when parsing the whole message, which would alter binary content in any
+    other transfer encoding."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        rest = b""
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            remaining = remaining - len(data) if data else 0
+            if cte == "base64":
+                # only whole groups of four characters can be decoded
+                data = rest + data.translate(None, BASE64_IGNORED)
+                cut = len(data) - len(data) % 4 if remaining > 0 else len(data)
+                rest = data[cut:]
+                try:
+                    data = binascii.a2b_base64(data[:cut])
+                except binascii.Error:  # incomplete at the end
+                    data = b""
+            else:
+                # a carriage return at the end may be followed by a newline
+                data = rest + data
+                cut = len(data) - 1 if remaining > 0 and data.endswith(b"\r") else len(data)
+                rest = data[cut:]
+                data = data[:cut].replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+                if cte == "quoted-printable":
+                    # only whole lines can be decoded
+                    cut = data.rfind(b"\n") + 1 if remaining > 0 else len(data)
+                    rest = data[cut:] + rest
+                    data = binascii.a2b_qp(data[:cut])
+            if data:
+                yield data
+
+
+def scale_image(data: bytes, size: int, quality: int = 75, fmt: Optional[str] = None) -> bytes:
+    """Scales an image down to fit into a square of the given size and encodes
+    it in the given format, or its own. JPEGs are decoded at reduced size
+    right away, and large reductions start by cheaply reducing by an integer
+    factor and use a cheaper filter."""
+    img = Image.open(io.BytesIO(data))
+    fmt = fmt or img.format or "JPEG"
+    w, h = img.size
+    sf = min(size / max(w, h), 1)
+    target = (max(int(w * sf), 1), max(int(h * sf), 1))
+    img.draft(img.mode, target)
+    resample = Image.Resampling.LANCZOS if sf >= 0.25 else Image.Resampling.BICUBIC
+    resized_img = img.resize(target, resample, reducing_gap=2.0)
+    if fmt == "WEBP" and resized_img.mode not in ["RGB", "RGBA"]:
+        resized_img = resized_img.convert("RGBA")
+    f = io.BytesIO()
+    if fmt in ["JPEG", "WEBP"]:
+        resized_img.save(f, format=fmt, quality=quality)
+    else:
+        resized_img.save(f, format=fmt)
+    return f.getvalue()
+
+
+def make_thumbnail(key: str, attachment: Dict[str, Any], size: int, quality: int, webp: bool) -> Tuple[bytes, str, str]:
+    """Scales an image attachment and keeps it in the thumbnail cache. Returns
+    the scaled image with its content type and filename."""
+    content_type = attachment["content_type"]
+    filename = attachment["filename"].replace('\n', '')
+    data = scale_image(bytes(attachment["content"]), size, quality=quality, fmt="WEBP" if webp else None)
+    if webp:
+        content_type = "image/webp"
+        filename = os.path.splitext(filename)[0] + ".webp"
+    store_thumbnail(key, data, content_type, filename)
+    return data, content_type, filename
+
+
+def set_inline_disposition(response: Response, filename: str) -> None:
+    """Sets the Content-Disposition of a response to show a file inline, the
+    same way as `send_file`."""
+    try:
+        filename.encode("ascii")
+        names = {"filename": filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        names = {"filename": simple, "filename*": f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    response.headers.set("Content-Disposition", "inline", **names)
+
+
+def send_attachment(chunks: Iterable[bytes], size: int, content_type: str, filename: str,
+                    last_modified: Optional[float] = None) -> Response:
+    """Returns a response that sends an attachment of the given size inline
+    chunk by chunk, or only the byte range requested. Downloads can be resumed
+    as long as the file it is from hasn't been modified."""
+    res = Response(chunks, mimetype=content_type, direct_passthrough=True)
+    set_inline_disposition(res, filename)
+    res.content_length = size
+    # as for files sent with send_file
+    res.cache_control.public = True
+    max_age = current_app.get_send_file_max_age(filename)
+    if max_age is not None:
+        res.cache_control.max_age = max_age
+    if last_modified is not None:
+        res.last_modified = datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc)
+    res.make_conditional(request, accept_ranges=True, complete_length=size)
+    return res
+
+
 def message_attachments(message: notmuch2.Message) -> List[Dict[str, Any]]:
     """Returns all attachments of a `notmuch2.Message` instance."""
     email_msg = email_from_notmuch(message)
@@ -1315,15 +2564,106 @@ def message_attachments(message: notmuch2.Message) -> List[Dict[str, Any]]:
 
 
 def message_attachment(message: notmuch2.Message, num: int = -1) -> Optional[Dict[str, Any]]:
-    """Returns attachment no. `num` of a `notmuch2.Message` instance."""
-    attachments = message_attachments(message)
-    if not attachments or num > len(attachments) - 1:
+    """Returns attachment no. `num` of a `notmuch2.Message` instance. Only that
+    attachment is decoded."""
+    email_msg = email_from_notmuch(message)
+    parts = walk_message(email_msg)["attachments"]
+    if not parts or num > len(parts) - 1:
         return None
-    return attachments[num]
+    return get_attachments(email_msg, True, {"attachments": [parts[num]]})[0]
+
+
+def zip_attachments(messages: Iterable[notmuch2.Message]) -> Generator[bytes, None, None]:
+    """Yields a ZIP file of the attachments of `notmuch2.Message` instances as
+    it is written. Attachments are added one at a time, streamed from their
+    location in the message file where possible and decoded from the parsed
+    message otherwise. Attachments are saved as they were sent, without
+    converting text to UTF-8."""
+    chunks: List[bytes] = []
+
+    def write(data: bytes) -> int:
+        chunks.append(bytes(data))
+        return len(data)
+
+    def decode_part(part: email.message.Message) -> Tuple[str, str, int, Iterable[bytes]]:
+        # attached messages have no payload of their own
+        data: bytes = bytes(part.get_content()) if part.is_multipart() else part.get_payload(decode=True)  # type: ignore[attr-defined, assignment]
+        return part.get_filename() or "unnamed attachment", part.get_content_type(), len(data), [data]
+
+    names: Set[str] = set()
+    # not seekable, so sizes are written after each entry
+    with zipfile.ZipFile(types.SimpleNamespace(write=write, flush=lambda: None), "w") as zf:  # type: ignore[call-overload]
+        for msg in messages:
+            index = get_attachment_index(msg)
+            if index is not None:
+                entries: Iterable[Tuple[str, str, int, Iterable[bytes]]] = (
+                    (part["filename"] or "unnamed attachment", part["content_type"], get_attachment_size(msg, index, num),
+                     stream_part(str(msg.path), part["start"], part["end"], part["cte"]))
+                    if part["cte"] in ["base64", "quoted-printable"] else
+                    decode_part(walk_message(email_from_notmuch(msg))["attachments"][num][0])
+                    for num, part in enumerate(index))
+            else:
+                entries = (decode_part(part) for part, _ in walk_message(email_from_notmuch(msg))["attachments"])
+
+            for filename, content_type, size, content in entries:
+                name = os.path.basename(filename.replace('\n', '').replace('\\', '/')) or "unnamed attachment"
+                base, ext = os.path.splitext(name)
+                i = 1
+                while name in names:
+                    i += 1
+                    name = f"{base} ({i}){ext}"
+                names.add(name)
+
+                # ZIP dates start in 1980
+                info = zipfile.ZipInfo(name, max(time.localtime(msg.date)[:6], (1980, 1, 1, 0, 0, 0)))
+                # most other types are compressed already
+                if content_type.split('/')[0] in ["text", "message"]:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                # decides whether ZIP64 is needed
+                info.file_size = size
+                with zf.open(info, "w") as f:
+                    for chunk in content:
+                        f.write(chunk)
+                        yield from chunks
+                        chunks.clear()
+                yield from chunks
+                chunks.clear()
+    yield from chunks
 
 
 def email_from_notmuch(message: notmuch2.Message) -> email.message.EmailMessage:
-    """Returns the email message corresponding to a `notmuch2Message` instance."""
+    """Returns the email message corresponding to a `notmuch2Message` instance.
+    Parsed messages are kept until their file changes, up to a configured total
+    size of the files."""
+    try:
+        stat = os.stat(message.path)
+    except OSError:
+        stat = None
+    cache = current_app.message_cache  # type: ignore[attr-defined]
+    key = str(message.path)
+    version = (stat.st_ino, stat.st_mtime_ns) if stat is not None else None
+    if version is not None:
+        with cache["lock"]:
+            entry = cache["messages"].get(key)
+            if entry is not None and entry[0] == version:
+                cache["messages"].move_to_end(key)
+                return entry[2]
+
     with open(message.path, "rb") as f:
         email_msg = email.message_from_binary_file(f, policy=policy)  # type: ignore[arg-type]
-        return email_msg
+
+    try:
+        budget = int(current_app.config.custom["message-cache-size"]) * 1024 * 1024  # type: ignore[attr-defined]
+    except KeyError:
+        budget = 64 * 1024 * 1024
+    if stat is not None and stat.st_size <= budget:
+        with cache["lock"]:
+            old = cache["messages"].pop(key, None)
+            if old is not None:
+                cache["size"] -= old[1]
+            cache["messages"][key] = (version, stat.st_size, email_msg)
+            cache["size"] += stat.st_size
+            while cache["size"] > budget:
+                _, (_, size, _) = cache["messages"].popitem(last=False)
+                cache["size"] -= size
+    return email_msg  # type: ignore[return-value]
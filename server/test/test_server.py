@@ -5,6 +5,10 @@ import os
 import email
 import time
 import re
+import stat
+import sqlite3
+import zipfile
+import concurrent.futures.process
 from unittest.mock import MagicMock, mock_open, patch, call, ANY
 
 import notmuch2
@@ -55,11 +59,60 @@ def test_get_inline_content():
     assert data == b'R0lGODlhAQABAIAAAP///////yH5BAEAAAAALAAAAAABAAEAAAIBRAA7\n'
 
 
+def test_walk_message():
+    with open("test/mails/cid-edge-cases.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+
+    parts = k.walk_message(email_msg)
+    assert [part.get_content_type() for part in parts["text/html"]] == ["text/html"]
+    assert sorted(cid for cid, _ in parts["inline"]) == ["image1@test", "image2@test"]
+    assert parts["signed"] == []
+
+    with open("test/mails/signed-attachment.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+
+    parts = k.walk_message(email_msg)
+    # unwrapped from application/pkcs7-mime
+    assert len(parts["text/plain"]) == 1
+    assert len(parts["text/html"]) == 1
+    assert parts["attachments"][0][0].get_content_type() == "application/pkcs7-mime"
+    assert parts["attachments"][0][1] is email_msg
+    assert parts["signed"] == [email_msg]
+
+
+def test_estimate_content_size():
+    for data in [b"", b"a", b"ab", b"abc", bytes(range(256)) * 40]:
+        part = email.message.EmailMessage()
+        part.set_content(data, maintype="application", subtype="octet-stream", cte="base64")
+        assert k.estimate_content_size(part) == len(data)
+
+    part = email.message.EmailMessage()
+    part.set_content("caf\u00e9 = " + "x" * 100 + "\n", cte="quoted-printable")
+    assert k.estimate_content_size(part) == len(part.get_content().encode("utf8"))
+
+    part = email.message.EmailMessage()
+    part.set_content("foo bar\n", cte="7bit")
+    assert k.estimate_content_size(part) == len(b"foo bar\n")
+
+
+def test_get_attachments_not_decoded():
+    with open("test/mails/attachments.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+
+    decoded = k.get_attachments(email_msg, True)
+    with patch("email.message.MIMEPart.get_content") as gc:
+        attachments = k.get_attachments(email_msg)
+        gc.assert_not_called()
+    assert [a["content_size"] for a in attachments] == [a["content_size"] for a in decoded]
+    assert [a["content"] for a in attachments] == [None, None, None]
+
+
 @pytest.fixture
 def setup():
     flask_app = k.create_app()
     db = lambda: None
     db.close = MagicMock()
+    db.revision = MagicMock(return_value=MagicMock(rev=0))
     with flask_app.app_context() as c:
         c.g.db = db
         yield flask_app, db
@@ -83,8 +136,21 @@ def test_globals(setup):
     assert ["foo", "bar"] == globs["allTags"]
 
 
+def mock_thread(thread_id, tags, total=1, subject="foosubject", authors="foo bar"):
+    mt = MagicMock()
+    mt.threadid = thread_id
+    mt.authors = authors
+    mt.subject = subject
+    mt.first = 0
+    mt.last = 1
+    mt.tags = tags
+    mt.__len__.return_value = total
+    return mt
+
+
 def test_query(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     mm1 = lambda: None
     mm1.tags = ["footag"]
@@ -108,7 +174,8 @@ def test_query(setup):
     db.config = {}
     db.messages = MagicMock()
     db.messages.side_effect = [iter([mm1, mm2, mm3])]
-    db.count_messages = MagicMock(return_value=3)
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock(return_value=iter([mock_thread("id", [], total=3)]))
 
     with app.test_client() as test_client:
         response = test_client.get('/api/query/?query=foo')
@@ -126,7 +193,7 @@ def test_query(setup):
     assert db.messages.mock_calls == [
         call('thread:"{foo}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
     ]
-    db.count_messages.assert_called_once_with("thread:id")
+    db.threads.assert_called_once_with("thread:id")
 
     mm1.header.assert_has_calls([call("subject"), call("from")])
     mm2.header.assert_has_calls([call("from")])
@@ -135,6 +202,7 @@ def test_query(setup):
 
 def test_query_empty(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     mm1 = lambda: None
     mm1.tags = ["footag"]
@@ -146,7 +214,8 @@ def test_query_empty(setup):
     db.config = {}
     db.messages = MagicMock()
     db.messages.side_effect = [iter([mm1])]
-    db.count_messages = MagicMock(return_value=1)
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock(return_value=iter([mock_thread("id", [], total=1)]))
 
     with app.test_client() as test_client:
         response = test_client.get('/api/query/?query=foo')
@@ -163,13 +232,14 @@ def test_query_empty(setup):
     assert db.messages.mock_calls == [
         call('thread:"{foo}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
     ]
-    db.count_messages.assert_called_once_with("thread:id")
+    db.threads.assert_called_once_with("thread:id")
 
     mm1.header.assert_has_calls([call("subject"), call("from")])
 
 
 def test_query_none(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     db.config = {}
     db.messages = MagicMock(return_value=iter([]))
@@ -185,6 +255,7 @@ def test_query_none(setup):
 
 def test_query_escaped_quotes(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     db.config = {}
     db.messages = MagicMock(return_value=iter([]))
@@ -200,6 +271,7 @@ def test_query_escaped_quotes(setup):
 
 def test_query_exclude_tags(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     db.config = {"search.exclude_tags": "foo;bar"}
     db.messages = MagicMock(return_value=iter([]))
@@ -215,6 +287,7 @@ def test_query_exclude_tags(setup):
 
 def test_query_malformed(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     db.config = {}
     db.messages = MagicMock(side_effect=notmuch2.NotmuchError(message="bad query syntax"))
@@ -228,6 +301,7 @@ def test_query_malformed(setup):
 
 def test_index_malformed_query(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     db.config = {}
     db.tags = []
@@ -244,6 +318,7 @@ def test_index_malformed_query(setup):
 
 def test_query_group(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     mm1 = lambda: None
     mm1.tags = ["grp:0"]
@@ -270,7 +345,9 @@ def test_query_group(setup):
     db.config = {}
     db.messages = MagicMock()
     db.messages.side_effect = [iter([mm1, mm2, mm3]), iter([mm1, mm2])]
-    db.count_messages = MagicMock(return_value=1)
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock(return_value=iter([mock_thread("id1", []), mock_thread("id2", []),
+                                              mock_thread("id3", [])]))
 
     with app.test_client() as test_client:
         response = test_client.get('/api/query/?query=foo')
@@ -304,11 +381,7 @@ def test_query_group(setup):
         call('thread:"{foo}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
         call('thread:"{tag:grp:0}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
     ]
-    assert db.count_messages.mock_calls == [
-        call('thread:id1'),
-        call('thread:id2'),
-        call('thread:id3')
-    ]
+    db.threads.assert_called_once_with('thread:id1 or thread:id2 or thread:id3')
 
     mm1.header.assert_has_calls([call("subject"), call("from"), call("subject"),
                                  call("from")])
@@ -319,6 +392,7 @@ def test_query_group(setup):
 
 def test_query_group_multiple_in_thread(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     mm0 = lambda: None
     mm0.tags = ["bartag"]
@@ -352,7 +426,9 @@ def test_query_group_multiple_in_thread(setup):
     db.config = {}
     db.messages = MagicMock()
     db.messages.side_effect = [iter([mm0, mm1, mm2, mm3]), iter([mm0, mm1, mm2])]
-    db.count_messages = MagicMock(return_value=1)
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock(return_value=iter([mock_thread("id1", []), mock_thread("id2", []),
+                                              mock_thread("id3", [])]))
 
     with app.test_client() as test_client:
         response = test_client.get('/api/query/?query=foo')
@@ -386,11 +462,7 @@ def test_query_group_multiple_in_thread(setup):
         call('thread:"{foo}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
         call('thread:"{tag:grp:0}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
     ]
-    assert db.count_messages.mock_calls == [
-        call('thread:id1'),
-        call('thread:id2'),
-        call('thread:id3')
-    ]
+    db.threads.assert_called_once_with('thread:id1 or thread:id2 or thread:id3')
 
     mm0.header.assert_has_calls([call("subject"), call("from"), call("subject"),
                                  call("from")])
@@ -402,6 +474,7 @@ def test_query_group_multiple_in_thread(setup):
 
 def test_query_group_multiple_threads(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
     mm1 = lambda: None
     mm1.tags = ["foobartag"]
@@ -429,7 +502,8 @@ def test_query_group_multiple_threads(setup):
     db.config = {}
     db.messages = MagicMock()
     db.messages.side_effect = [iter([mm1, mm2, mm3]), iter([mm1, mm2, mm3])]
-    db.count_messages = MagicMock(return_value=1)
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock(return_value=iter([mock_thread("id1", []), mock_thread("id2", [])]))
 
     with app.test_client() as test_client:
         response = test_client.get('/api/query/?query=foo')
@@ -457,10 +531,7 @@ def test_query_group_multiple_threads(setup):
         call('thread:"{foo}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
         call('thread:"{tag:grp:0}"', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
     ]
-    assert db.count_messages.mock_calls == [
-        call('thread:id1'),
-        call('thread:id2')
-    ]
+    db.threads.assert_called_once_with('thread:id1 or thread:id2')
 
     mm1.header.assert_has_calls([call("subject"), call("from"), call("subject"),
                                  call("from")])
@@ -469,702 +540,2276 @@ def test_query_group_multiple_threads(setup):
     mm3.header.assert_has_calls([call("from"), call("from")])
 
 
-def test_complete_address(setup):
+def test_query_count_cached(setup):
     app, db = setup
+    app.config.custom["query-engine"] = "messages"
 
-    mf = lambda: None
-    mf.header = MagicMock()
-    mf.header.side_effect = ["foo@bar.com", "\"bar foo\" bar@foo.com", "bar@foo.com", None]
-    mf.tags = ["foo", "bar"]
+    def mock_message():
+        mm = lambda: None
+        mm.tags = ["footag"]
+        mm.date = 0
+        mm.threadid = "id"
+        mm.header = MagicMock(return_value="foo")
+        return mm
 
     db.config = {}
-    db.messages = MagicMock(return_value=iter([mf]))
+    db.messages = MagicMock()
+    db.messages.side_effect = [iter([mock_message()]), iter([mock_message()]), iter([mock_message()])]
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id", [], total=2)]), iter([mock_thread("id", [], total=3)])]
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/address/?query=foo')
+        response = test_client.get('/api/query/?query=foo')
         assert response.status_code == 200
-        addrs = json.loads(response.data.decode())
-        assert len(addrs) == 2
-        assert addrs[0] == "foo@bar.com"
-        assert addrs[1] == "\"bar foo\" bar@foo.com"
+        assert json.loads(response.data.decode())[0]["total_messages"] == 2
 
-    mf.header.assert_has_calls([call("from"), call("to"), call("cc"), call("bcc")])
-    db.messages.assert_called_once_with("from:foo or to:foo", exclude_tags=[],
-                                       sort=notmuch2.Database.SORT.NEWEST_FIRST)
+        # different query, same thread
+        response = test_client.get('/api/query/?query=bar')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())[0]["total_messages"] == 2
 
+        # database changed
+        db.revision.return_value = 2
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())[0]["total_messages"] == 3
 
-def test_complete_email(setup):
-    app, db = setup
+    assert db.threads.mock_calls == [
+        call('thread:id'),
+        call('thread:id')
+    ]
 
-    mf = lambda: None
-    mf.header = MagicMock()
-    mf.header.side_effect = ["foo@bar.com", "\"bar foo\" bar@foo.com", "bar@foo.com", None]
-    mf.tags = ["foo", "bar"]
 
-    db.config = {}
-    db.messages = MagicMock(return_value=iter([mf]))
+def test_query_threads(setup):
+    app, db = setup
+
+    def mock_message(date, author, tags=[]):
+        mm = lambda: None
+        mm.date = date
+        mm.tags = tags
+        mm.header = MagicMock(return_value=author)
+        return mm
+
+    mt = MagicMock()
+    mt.threadid = "id"
+    mt.authors = "Doe, John, bar foo| foo bar2"
+    mt.__iter__.return_value = iter([mock_message(0, "Doe, John <john@doe.com>", ["foobartag"]),
+                                     mock_message(1, "bar foo <bar@foo.com>", ["bartag", "footag"]),
+                                     mock_message(2, "Doe, John <john@doe.com>", ["footag"]),
+                                     mock_message(3, "deleted <deleted@foo.com>", ["deleted"]),
+                                     mock_message(1, "foo bar2 <bar2@foo.com>")])
+    mt.subject = "foosubject"
+    mt.first = 0
+    mt.last = 3
+    mt.tags = ["bartag", "deleted", "foobartag", "footag"]
+    mt.__len__.return_value = 5
+
+    db.config = {"search.exclude_tags": "deleted"}
+    db.messages = MagicMock()
+    db.count_messages = MagicMock()
+    db.threads = MagicMock(return_value=iter([mt]))
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/email/?query=foo')
+        response = test_client.get('/api/query/?query=foo')
         assert response.status_code == 200
-        addrs = json.loads(response.data.decode())
-        assert len(addrs) == 2
-        assert addrs[0] == "foo@bar.com"
-        assert addrs[1] == "bar@foo.com"
+        thrds = json.loads(response.data.decode())
+        assert len(thrds) == 1
+        assert thrds[0]["authors"] == ["foo bar2 <bar2@foo.com>", "bar foo <bar@foo.com>",
+                                       "Doe, John <john@doe.com>"]
+        assert thrds[0]["newest_date"] == 2
+        assert thrds[0]["oldest_date"] == 0
+        assert thrds[0]["subject"] == "foosubject"
+        # in the order of the messages, newest first
+        assert thrds[0]["tags"] == ["footag", "bartag", "foobartag"]
+        assert thrds[0]["thread_id"] == "id"
+        assert thrds[0]["total_messages"] == 5
 
-    mf.header.assert_has_calls([call("from"), call("to"), call("cc"), call("bcc")])
-    db.messages.assert_called_once_with("from:foo or to:foo", exclude_tags=[],
+    db.threads.assert_called_once_with('foo', exclude_tags=["deleted"],
                                        sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    db.messages.assert_not_called()
+    db.count_messages.assert_not_called()
 
 
-def test_complete_groups(setup):
+def test_query_threads_excluded(setup):
     app, db = setup
 
-    mf1 = lambda: None
-    mf1.header = MagicMock()
-    mf1.header.side_effect = ["subj1"]
-    mf1.tags = ["grp:0", "bar"]
+    def mock_message(date, tags):
+        mm = lambda: None
+        mm.date = date
+        mm.tags = tags
+        mm.header = MagicMock(return_value="foo bar <foo@bar.com>")
+        return mm
+
+    # the newest message is excluded, the oldest one doesn't match
+    mt = MagicMock()
+    mt.threadid = "id"
+    mt.__iter__.return_value = iter([mock_message(1, ["sent"]),
+                                     mock_message(2, ["inbox"]),
+                                     mock_message(3, ["spam", "unread"])])
+    mt.subject = "foosubject"
+    mt.first = 2
+    mt.last = 3
+    mt.tags = ["inbox", "sent", "spam", "unread"]
+    mt.__len__.return_value = 3
+
+    db.config = {"search.exclude_tags": "spam"}
+    db.threads = MagicMock(return_value=iter([mt]))
 
-    mf2 = lambda: None
-    mf2.header = MagicMock()
-    mf2.header.side_effect = ["subj2"]
-    mf2.tags = ["grp:0", "bar"]
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=tag:inbox')
+        assert response.status_code == 200
+        thrds = json.loads(response.data.decode())
+        assert thrds[0]["tags"] == ["inbox", "sent"]
+        assert thrds[0]["newest_date"] == 2
+        assert thrds[0]["oldest_date"] == 1
+        assert thrds[0]["total_messages"] == 3
 
-    mf3 = lambda: None
-    mf3.header = MagicMock()
-    mf3.header.side_effect = ["subj3"]
-    mf3.tags = ["grp:1", "bar"]
+
+def test_query_threads_empty(setup):
+    app, db = setup
+
+    mt = MagicMock()
+    mt.threadid = "id"
+    mt.authors = ""
+    mt.subject = ""
+    mt.first = 0
+    mt.last = 0
+    mt.tags = ["footag"]
+    mt.__len__.return_value = 1
 
     db.config = {}
-    db.messages = MagicMock(return_value=iter([mf1, mf2, mf3]))
+    db.threads = MagicMock(return_value=iter([mt]))
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/group_complete/')
+        response = test_client.get('/api/query/?query=foo')
         assert response.status_code == 200
-        grps = json.loads(response.data.decode())
-        assert len(grps) == 2
-        assert "subj1" in grps
-        assert "subj3" in grps
-        assert grps["subj1"] == "grp:0"
-        assert grps["subj3"] == "grp:1"
+        thrds = json.loads(response.data.decode())
+        assert thrds[0]["authors"] == []
+        assert thrds[0]["subject"] == "(no subject)"
+        assert thrds[0]["tags"] == ["footag"]
+        assert thrds[0]["total_messages"] == 1
 
-    mf1.header.assert_called_once_with("subject")
-    mf2.header.assert_called_once_with("subject")
-    mf3.header.assert_called_once_with("subject")
-    db.messages.assert_called_once_with("tag:/grp:.*/", exclude_tags=[],
+    db.threads.assert_called_once_with('foo', exclude_tags=[],
                                        sort=notmuch2.Database.SORT.NEWEST_FIRST)
 
 
-def test_complete_groups_subject(setup):
+def test_query_threads_exclude_tags(setup):
     app, db = setup
 
-    mf1 = lambda: None
-    mf1.header = MagicMock()
-    mf1.header.side_effect = ["subj1"]
-    mf1.tags = ["grp:0", "bar"]
-
-    mf2 = lambda: None
-    mf2.header = MagicMock()
-    mf2.header.side_effect = ["subj2"]
-    mf2.tags = ["grp:0", "bar"]
-
-    mf3 = lambda: None
-    mf3.header = MagicMock()
-    mf3.header.side_effect = ["subj3"]
-    mf3.tags = ["grp:1", "bar"]
-
-    db.config = {}
-    db.messages = MagicMock(return_value=iter([mf1, mf2, mf3]))
+    db.config = {"search.exclude_tags": "foo;bar"}
+    db.threads = MagicMock(return_value=iter([]))
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/group_complete/?query=subj')
+        response = test_client.get('/api/query/?query=foo and tag:bar')
         assert response.status_code == 200
-        grps = json.loads(response.data.decode())
-        assert len(grps) == 2
-        assert "subj1" in grps
-        assert "subj3" in grps
-        assert grps["subj1"] == "grp:0"
-        assert grps["subj3"] == "grp:1"
+        assert b'[]\n' == response.data
 
-    mf1.header.assert_called_once_with("subject")
-    mf2.header.assert_called_once_with("subject")
-    mf3.header.assert_called_once_with("subject")
-    db.messages.assert_called_once_with('tag:/grp:.*/ and subject:"subj"', exclude_tags=[],
+    db.threads.assert_called_once_with('foo and tag:bar', exclude_tags=["foo"],
                                        sort=notmuch2.Database.SORT.NEWEST_FIRST)
 
 
-def test_get_message_none(setup):
+def test_query_threads_malformed(setup):
     app, db = setup
 
     db.config = {}
-    db.find = MagicMock()
-    db.find.side_effect = LookupError("foo")
+    db.tags = []
+    db.threads = MagicMock(side_effect=notmuch2.NotmuchError(message="bad query syntax"))
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/message/?message=foo')
-        assert response.status_code == 404
-    db.find.assert_called_once_with("foo")
+        response = test_client.get('/api/query/?query=date:bad..')
+        assert response.status_code == 400
+        data = json.loads(response.data.decode())
+        assert data["error"] == "bad query syntax"
 
 
-def test_raw_message(setup):
+def test_query_threads_group(setup):
     app, db = setup
 
-    mf = lambda: None
-    mf.path = "foofile"
+    mt1 = MagicMock()
+    mt1.threadid = "id1"
+    mt1.authors = "foo bar"
+    mt1.subject = "foosubject"
+    mt1.first = 0
+    mt1.last = 0
+    mt1.tags = ["grp:0"]
+    mt1.__len__.return_value = 1
+    mt2 = MagicMock()
+    mt2.threadid = "id2"
+    mt2.authors = "bar foo"
+    mt2.subject = "barsubject"
+    mt2.first = 1
+    mt2.last = 1
+    mt2.tags = ["bartag", "grp:0"]
+    mt2.__len__.return_value = 2
+    mt3 = MagicMock()
+    mt3.threadid = "id3"
+    mt3.authors = "bar foo"
+    mt3.subject = "foobarsubject"
+    mt3.first = 2
+    mt3.last = 2
+    mt3.tags = ["foobartag"]
+    mt3.__len__.return_value = 3
 
     db.config = {}
-    db.find = MagicMock(return_value=mf)
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3]), iter([mt1, mt2])]
 
-    with patch("builtins.open", mock_open(read_data="This is a test.")) as o:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/message_raw/?message=foo')
-            assert response.status_code == 200
-            assert b'This is a test.' == response.data
-        o.assert_called_once_with("foofile", "r", encoding="utf8")
-    db.find.assert_called_once_with("foo")
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        thrds = json.loads(response.data.decode())
+        assert len(thrds) == 2
+        assert len(thrds[0]) == 2
 
+        assert thrds[0][0]["thread_id"] == "id1"
+        assert thrds[0][0]["subject"] == "foosubject"
+        assert thrds[0][0]["tags"] == ["grp:0"]
+        assert thrds[0][0]["total_messages"] == 1
 
-def test_tag_add_message(setup):
-    app, db = setup
+        assert thrds[0][1]["thread_id"] == "id2"
+        assert thrds[0][1]["subject"] == "barsubject"
+        assert thrds[0][1]["tags"] == ["bartag", "grp:0"]
+        assert thrds[0][1]["total_messages"] == 2
 
-    mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.add = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+        assert thrds[1]["thread_id"] == "id3"
+        assert thrds[1]["subject"] == "foobarsubject"
+        assert thrds[1]["tags"] == ["foobartag"]
+        assert thrds[1]["total_messages"] == 3
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock(return_value=iter([mf]))
-    dbw.config = {}
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('tag:grp:0', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/tag/?op=add&type=message&id=foo&tag=bar')
-            assert response.status_code == 200
-            assert b'bar' == response.data
-        nmdb.assert_called_once()
-    dbw.messages.assert_called_once_with("id:foo and not tag:bar", exclude_tags=[], sort=ANY)
 
-    mf.tags.add.assert_called_once_with("bar")
-    mf.frozen.assert_called_once()
+def test_query_threads_multiple_groups(setup):
+    app, db = setup
 
-    dbw.close.assert_called_once()
+    mt1 = mock_thread("id1", ["grp:0"])
+    mt2 = mock_thread("id2", ["bartag", "grp:1"])
+    mt3 = mock_thread("id3", ["grp:0"])
+    mt4 = mock_thread("id4", ["foobartag"])
+    mt5 = mock_thread("id5", ["grp:1"])
 
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3, mt4]), iter([mt1, mt2, mt3, mt5])]
 
-def test_tag_add_thread(setup):
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        thrds = json.loads(response.data.decode())
+        assert len(thrds) == 3
+        assert [t["thread_id"] for t in thrds[0]] == ["id1", "id3"]
+        assert [t["thread_id"] for t in thrds[1]] == ["id2", "id5"]
+        assert thrds[2]["thread_id"] == "id4"
+
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('tag:grp:0 or tag:grp:1', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+
+
+def test_query_paginated(setup):
     app, db = setup
 
-    mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.add = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+    mt1 = mock_thread("id1", ["footag"])
+    mt2 = mock_thread("id2", ["bartag"])
+    mt3 = mock_thread("id3", ["foobartag"])
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock(return_value=iter([mf]))
-    dbw.config = {}
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3]), iter([mt1, mt2, mt3])]
+    db.count_threads = MagicMock(return_value=3)
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/tag/?op=add&type=thread&id=foo&tag=bar')
-            assert response.status_code == 200
-            assert b'bar' == response.data
-        nmdb.assert_called_once()
-    dbw.messages.assert_called_once_with("thread:foo and not tag:bar", exclude_tags=[], sort=ANY)
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&limit=2')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert [t["thread_id"] for t in page["threads"]] == ["id1", "id2"]
+        assert page["total"] == 3
+        assert page["cursor"] is not None
+        assert page["revision"] == 0
 
-    mf.tags.add.assert_called_once_with("bar")
-    mf.tags.to_maildir_flags.assert_called_once()
-    mf.frozen.assert_called_once()
+        response = test_client.get(f'/api/query/?query=foo&limit=2&cursor={page["cursor"]}')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert [t["thread_id"] for t in page["threads"]] == ["id3"]
+        assert page["total"] == 3
+        assert page["cursor"] is None
 
-    dbw.close.assert_called_once()
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+    assert db.count_threads.mock_calls == [
+        call('foo', exclude_tags=[]),
+        call('foo', exclude_tags=[])
+    ]
 
 
-def test_tag_remove_message(setup):
+def test_query_paginated_rest(setup):
     app, db = setup
 
-    mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.discard = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+    mt1 = mock_thread("id1", ["footag"])
+    mt2 = mock_thread("id2", ["bartag"])
+    mt3 = mock_thread("id3", ["foobartag"])
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock(return_value=iter([mf]))
-    dbw.config = {}
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3]), iter([mt1, mt2, mt3])]
+    db.count_threads = MagicMock(return_value=3)
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/tag/?op=remove&type=message&id=foo&tag=bar')
-            assert response.status_code == 200
-            assert b'bar' == response.data
-        nmdb.assert_called_once()
-    dbw.messages.assert_called_once_with("id:foo and tag:bar", exclude_tags=[], sort=ANY)
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&limit=1')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert [t["thread_id"] for t in page["threads"]] == ["id1"]
+
+        # no limit, get everything that's left
+        response = test_client.get(f'/api/query/?query=foo&cursor={page["cursor"]}')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert [t["thread_id"] for t in page["threads"]] == ["id2", "id3"]
+        assert page["total"] == 3
+        assert page["cursor"] is None
+
+
+def test_query_paginated_group(setup):
+    app, db = setup
+
+    mt1 = mock_thread("id1", ["grp:0"])
+    mt2 = mock_thread("id2", ["bartag"])
+    mt3 = mock_thread("id3", ["grp:0"])
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3]), iter([mt1, mt3]),
+                              iter([mt1, mt2, mt3]), iter([mt1, mt2, mt3])]
+    db.count_threads = MagicMock(return_value=3)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&limit=1')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert len(page["threads"]) == 1
+        assert [t["thread_id"] for t in page["threads"][0]] == ["id1", "id3"]
+
+        response = test_client.get(f'/api/query/?query=foo&limit=1&cursor={page["cursor"]}')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert [t["thread_id"] for t in page["threads"]] == ["id2"]
+
+        # group has been shown on first page already
+        response = test_client.get(f'/api/query/?query=foo&limit=1&cursor={page["cursor"]}')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert page["threads"] == []
+        assert page["cursor"] is None
+
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('tag:grp:0', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+
+
+def test_query_paginated_invalid(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock(return_value=iter([mock_thread("id1", ["footag"]), mock_thread("id2", ["footag"])]))
+    db.count_threads = MagicMock(return_value=2)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&limit=0')
+        assert response.status_code == 400
+        assert json.loads(response.data.decode())["error"] == "invalid limit"
+
+        response = test_client.get('/api/query/?query=foo&cursor=foo')
+        assert response.status_code == 400
+        assert json.loads(response.data.decode())["error"] == "invalid cursor"
+
+        response = test_client.get('/api/query/?query=foo&limit=1')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+
+        response = test_client.get(f'/api/query/?query=bar&limit=1&cursor={page["cursor"]}')
+        assert response.status_code == 400
+        assert json.loads(response.data.decode())["error"] == "cursor does not match query"
+
+    db.threads.assert_called_once()
+
+
+def test_index_first_page(setup):
+    app, db = setup
+
+    app.config.custom["page-size"] = "1"
+    db.config = {}
+    db.tags = []
+    db.threads = MagicMock(return_value=iter([mock_thread("id1", ["footag"]), mock_thread("id2", ["footag"])]))
+    db.count_threads = MagicMock(return_value=2)
+
+    with patch('src.kukulkan.render_template') as mock_render:
+        mock_render.return_value = ''
+        with app.test_client() as test_client:
+            test_client.get('/?query=foo')
+        args, kwargs = mock_render.call_args
+        assert [t["thread_id"] for t in kwargs['data']['threads']] == ["id1"]
+        assert kwargs['data']['cursor'] is not None
+        assert kwargs['data']['total'] == 2
+
+
+def test_query_since(setup):
+    app, db = setup
+
+    db.config = {"search.exclude_tags": "deleted"}
+    db.revision = MagicMock(return_value=MagicMock(rev=7))
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", []), mock_thread("id2", []), mock_thread("id3", [])]),
+                              iter([mock_thread("id2", ["footag"])])]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=tag:footag&since=5')
+        assert response.status_code == 200
+        delta = json.loads(response.data.decode())
+        assert delta["revision"] == 7
+        assert [t["thread_id"] for t in delta["threads"]] == ["id2"]
+        assert delta["threads"][0]["tags"] == ["footag"]
+        assert delta["removed"] == ["id1", "id3"]
+
+    assert db.threads.mock_calls == [
+        call('lastmod:6..', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('(tag:footag) and thread:{lastmod:6..}', exclude_tags=["deleted"], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+
+
+def test_query_since_group(setup):
+    app, db = setup
+
+    db.config = {}
+    db.revision = MagicMock(return_value=MagicMock(rev=7))
+    db.threads = MagicMock()
+    # id1 changed and is grouped with the unchanged id3
+    db.threads.side_effect = [iter([mock_thread("id1", []), mock_thread("id2", [])]),
+                              iter([mock_thread("id1", ["footag", "grp:0"])]),
+                              iter([mock_thread("id1", ["footag", "grp:0"]), mock_thread("id3", ["grp:0"])])]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=tag:footag&since=5')
+        assert response.status_code == 200
+        delta = json.loads(response.data.decode())
+        assert [[t["thread_id"] for t in grp] for grp in delta["threads"]] == [["id1", "id3"]]
+        assert delta["removed"] == ["id2"]
+
+    assert db.threads.mock_calls[2] == call('tag:grp:0', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_query_since_time_budget(setup):
+    app, db = setup
+    app.config.custom["query-time-budget"] = "1e-9"
+
+    db.config = {}
+    db.revision = MagicMock(return_value=MagicMock(rev=7))
+    db.threads = MagicMock()
+    # none of the changed threads match anymore
+    db.threads.side_effect = [iter([mock_thread("id1", []), mock_thread("id2", []), mock_thread("id3", [])]),
+                              iter([])]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=tag:footag&since=0')
+        assert response.status_code == 200
+        assert response.headers["X-Truncated"] == "true"
+        delta = json.loads(response.data.decode())
+        assert delta["truncated"] is True
+        assert delta["threads"] == []
+        # changed threads that weren't reached aren't reported as removed
+        assert delta["removed"] == []
+
+
+def test_query_since_invalid(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock()
+
+    with app.test_client() as test_client:
+        for since in ["foo", "-1", ""]:
+            response = test_client.get(f'/api/query/?query=foo&since={since}')
+            assert response.status_code == 400
+            assert json.loads(response.data.decode())["error"] == "invalid since"
+
+    db.threads.assert_not_called()
+
+
+def test_query_since_unchanged(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock(return_value=iter([]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&since=0')
+        assert response.status_code == 200
+        delta = json.loads(response.data.decode())
+        assert delta == {"revision": 0, "threads": [], "removed": []}
+
+    db.threads.assert_called_once_with('lastmod:1..', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_query_since_malformed(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock(side_effect=[iter([mock_thread("id1", [])]), notmuch2.NotmuchError(message="bad query syntax")])
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=date:bad..&since=0')
+        assert response.status_code == 400
+        assert json.loads(response.data.decode())["error"] == "bad query syntax"
+
+
+def test_query_stream(setup):
+    app, db = setup
+
+    mt1 = mock_thread("id1", ["grp:0"])
+    mt2 = mock_thread("id2", ["bartag"])
+    mt3 = mock_thread("id3", ["grp:0"])
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3]), iter([mt1, mt3])]
+    db.count_threads = MagicMock()
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo', headers={"Accept": "application/x-ndjson"})
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        assert "ETag" not in response.headers
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert len(lines) == 2
+        assert [t["thread_id"] for t in lines[0]] == ["id1", "id3"]
+        assert lines[1]["thread_id"] == "id2"
+        assert lines[1]["tags"] == ["bartag"]
+
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('tag:grp:0', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+    db.count_threads.assert_not_called()
+
+
+def test_query_stream_paginated(setup):
+    app, db = setup
+
+    mt1 = mock_thread("id1", ["footag"])
+    mt2 = mock_thread("id2", ["bartag"])
+
+    db.config = {}
+    db.threads = MagicMock(return_value=iter([mt1, mt2]))
+    db.count_threads = MagicMock(return_value=2)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&limit=1', headers={"Accept": "application/x-ndjson"})
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert len(lines) == 2
+        assert lines[0]["thread_id"] == "id1"
+        assert lines[1]["cursor"] is not None
+        assert lines[1]["total"] == 2
+
+    db.count_threads.assert_called_once_with('foo', exclude_tags=[])
+
+
+def test_query_stream_malformed(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock(side_effect=notmuch2.NotmuchError(message="bad query syntax"))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=date:bad..', headers={"Accept": "application/x-ndjson"})
+        assert response.status_code == 400
+        data = json.loads(response.data.decode())
+        assert data["error"] == "bad query syntax"
+
+
+def test_query_cached(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", ["footag"])]), iter([mock_thread("id2", ["footag"])])]
+    db.revision = MagicMock(return_value=1)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())[0]["thread_id"] == "id1"
+
+        # same query up to whitespace
+        response = test_client.get('/api/query/?query= foo ')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())[0]["thread_id"] == "id1"
+
+        # database changed
+        db.revision.return_value = 2
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())[0]["thread_id"] == "id2"
+
+    assert app.query_cache["hits"] == 1
+    assert app.query_cache["misses"] == 2
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+
+
+def test_query_cached_evict(setup):
+    app, db = setup
+    app.config.custom["query-cache-size"] = "1"
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", ["footag"])]), iter([mock_thread("id2", ["bartag"])]),
+                              iter([mock_thread("id1", ["footag"])])]
+
+    with app.test_client() as test_client:
+        for q in ["foo", "bar", "bar", "foo"]:
+            response = test_client.get(f'/api/query/?query={q}')
+            assert response.status_code == 200
+
+    assert app.query_cache["hits"] == 1
+    assert app.query_cache["misses"] == 3
+    assert db.threads.mock_calls == [
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('bar', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+
+
+def test_query_stream_cached(setup):
+    app, db = setup
+
+    db.config = {}
+    db.threads = MagicMock(return_value=iter([mock_thread("id1", ["footag"])]))
+
+    with app.test_client() as test_client:
+        for _ in range(2):
+            response = test_client.get('/api/query/?query=foo', headers={"Accept": "application/x-ndjson"})
+            assert response.status_code == 200
+            lines = response.data.decode().splitlines()
+            assert [json.loads(line)["thread_id"] for line in lines] == ["id1"]
+
+    assert app.query_cache["hits"] == 1
+    db.threads.assert_called_once_with('foo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_query_etag(setup):
+    app, db = setup
+    app.config.custom["query-cache-size"] = "0"
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", ["footag"])]), iter([mock_thread("id1", ["footag"])])]
+    db.revision = MagicMock()
+    db.revision.side_effect = [1, 1, 2]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert etag.startswith('W/')
+
+        response = test_client.get('/api/query/?query=foo', headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        # database changed
+        response = test_client.get('/api/query/?query=foo', headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    assert db.threads.call_count == 2
+
+
+def test_todo(setup):
+    app, db = setup
+
+    mt1 = mock_thread("id1", ["todo"])
+    mt2 = mock_thread("id2", ["todo", "due:2999-01-01"])
+    mt3 = mock_thread("id3", ["todo", "due:2000-01-01"])
+    mt4 = mock_thread("id4", ["todo", "due:2999-01-01", "grp:0"])
+    mt5 = mock_thread("id5", ["due:2100-01-01", "grp:0"])
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mt1, mt2, mt3, mt4]), iter([mt4, mt5])]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/todo/')
+        assert response.status_code == 200
+        todo = json.loads(response.data.decode())
+        assert todo["threads"][0]["thread_id"] == "id3"
+        assert [t["thread_id"] for t in todo["threads"][1]] == ["id4", "id5"]
+        assert todo["threads"][2]["thread_id"] == "id2"
+        assert todo["threads"][3]["thread_id"] == "id1"
+        assert todo["overdue"] == 1
+        assert todo["upcoming"] == 2
+
+        response = test_client.get('/api/todo/?from=2001-01-01&to=2999-01-01')
+        assert response.status_code == 200
+        todo = json.loads(response.data.decode())
+        assert len(todo["threads"]) == 2
+        assert todo["threads"][1]["thread_id"] == "id2"
+        assert todo["overdue"] == 1
+        assert todo["upcoming"] == 2
+
+        response = test_client.get('/api/todo/?to=2000-01-01')
+        assert response.status_code == 200
+        todo = json.loads(response.data.decode())
+        assert [t["thread_id"] for t in todo["threads"]] == ["id3"]
+
+    assert db.threads.mock_calls == [
+        call('tag:todo', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST),
+        call('tag:grp:0', exclude_tags=[], sort=notmuch2.Database.SORT.NEWEST_FIRST)
+    ]
+
+
+def test_todo_invalidated(setup):
+    app, db = setup
+
+    db.config = {}
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", ["todo"])]), iter([])]
+
+    with app.test_client() as test_client:
+        for _ in range(2):
+            response = test_client.get('/api/todo/')
+            assert response.status_code == 200
+            assert len(json.loads(response.data.decode())["threads"]) == 1
+
+        # database changed
+        db.revision.return_value = 2
+        response = test_client.get('/api/todo/')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())["threads"] == []
+
+    assert db.threads.call_count == 2
+
+
+def test_todo_time_budget(setup):
+    app, db = setup
+    app.config.custom["query-time-budget"] = "1e-9"
+
+    db.config = {}
+    db.revision = MagicMock(return_value=1)
+    db.threads = MagicMock()
+    db.threads.side_effect = lambda *args, **kwargs: iter([mock_thread("id1", ["todo"]), mock_thread("id2", ["todo"])])
+
+    with app.test_client() as test_client:
+        # partial lists aren't kept
+        for _ in range(2):
+            response = test_client.get('/api/todo/')
+            assert response.status_code == 200
+            assert response.headers["X-Truncated"] == "true"
+            assert [t["thread_id"] for t in json.loads(response.data.decode())["threads"]] == ["id1"]
+
+        app.config.custom["query-time-budget"] = "0"
+        response = test_client.get('/api/todo/')
+        assert response.status_code == 200
+        assert "X-Truncated" not in response.headers
+        assert [t["thread_id"] for t in json.loads(response.data.decode())["threads"]] == ["id1", "id2"]
+
+    assert db.threads.call_count == 3
+
+
+def test_todo_invalid_date(setup):
+    app, db = setup
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/todo/?from=foo')
+        assert response.status_code == 400
+        assert json.loads(response.data.decode())["error"] == "invalid date"
+
+
+def test_query_time_budget(setup):
+    app, db = setup
+    app.config.custom["query-time-budget"] = "1e-9"
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = lambda *args, **kwargs: iter([mock_thread("id1", ["footag"]), mock_thread("id2", ["footag"]),
+                                                           mock_thread("id3", ["footag"])])
+    db.count_threads = MagicMock(return_value=3)
+
+    with app.test_client() as test_client:
+        # same shape as complete results
+        response = test_client.get('/api/query/?query=foo')
+        assert response.status_code == 200
+        assert response.headers["X-Truncated"] == "true"
+        assert [t["thread_id"] for t in json.loads(response.data.decode())] == ["id1"]
+
+        response = test_client.get('/api/query/?query=foo&limit=10')
+        assert response.status_code == 200
+        assert response.headers["X-Truncated"] == "true"
+        assert "ETag" not in response.headers
+        page = json.loads(response.data.decode())
+        assert page["truncated"] is True
+        assert [t["thread_id"] for t in page["threads"]] == ["id1"]
+        assert page["cursor"] is not None
+
+        app.config.custom["query-time-budget"] = "0"
+        response = test_client.get(f'/api/query/?query=foo&cursor={page["cursor"]}')
+        assert response.status_code == 200
+        assert "X-Truncated" not in response.headers
+        page = json.loads(response.data.decode())
+        assert "truncated" not in page
+        assert [t["thread_id"] for t in page["threads"]] == ["id2", "id3"]
+        assert page["cursor"] is None
+
+    # only the complete second page is cached
+    assert len(app.query_cache["results"]) == 1
+    assert db.threads.call_count == 3
+
+
+def test_query_time_budget_group(setup):
+    app, db = setup
+
+    clock = {"now": 0}
+
+    def group_threads(complete):
+        yield mock_thread("id2", ["grp:0"])
+        if not complete:
+            # out of time
+            clock["now"] = 100
+        yield mock_thread("id3", ["grp:0"])
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", []), mock_thread("id2", ["grp:0"]), mock_thread("id4", [])]),
+                              group_threads(False),
+                              iter([mock_thread("id1", []), mock_thread("id2", ["grp:0"]), mock_thread("id4", [])]),
+                              group_threads(True)]
+    db.count_threads = MagicMock(return_value=3)
+
+    with patch("src.kukulkan.time.monotonic", side_effect=lambda: clock["now"]):
+        with app.test_client() as test_client:
+            response = test_client.get('/api/query/?query=foo&limit=10')
+            assert response.status_code == 200
+            page = json.loads(response.data.decode())
+            assert page["truncated"] is True
+            # ends before the group that was cut off
+            assert [t["thread_id"] for t in page["threads"]] == ["id1"]
+
+            clock["now"] = 0
+            response = test_client.get(f'/api/query/?query=foo&limit=10&cursor={page["cursor"]}')
+            assert response.status_code == 200
+            page = json.loads(response.data.decode())
+            assert "truncated" not in page
+            assert [t["thread_id"] for t in page["threads"][0]] == ["id2", "id3"]
+            assert page["threads"][1]["thread_id"] == "id4"
+
+
+def test_query_time_budget_group_stream(setup):
+    app, db = setup
+
+    clock = {"now": 0}
+
+    def group_threads():
+        yield mock_thread("id2", ["grp:0"])
+        clock["now"] = 100
+        yield mock_thread("id3", ["grp:0"])
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id1", []), mock_thread("id2", ["grp:0"]), mock_thread("id4", [])]),
+                              group_threads()]
+    db.count_threads = MagicMock(return_value=3)
+
+    with patch("src.kukulkan.time.monotonic", side_effect=lambda: clock["now"]):
+        with app.test_client() as test_client:
+            response = test_client.get('/api/query/?query=foo&limit=10', headers={"Accept": "application/x-ndjson"})
+            assert response.status_code == 200
+            # headers are sent before the time runs out
+            assert "ETag" not in response.headers
+            lines = [json.loads(line) for line in response.data.decode().splitlines()]
+            assert len(lines) == 2
+            assert lines[0]["thread_id"] == "id1"
+            assert lines[1]["truncated"] is True
+            state = k.decode_cursor(lines[1]["cursor"])
+            assert state["offset"] == 1
+            assert state["groups"] == []
+
+
+def test_query_time_budget_group_first(setup):
+    app, db = setup
+    app.config.custom["query-time-budget"] = "1e-9"
+
+    db.config = {}
+    db.threads = MagicMock()
+    db.threads.side_effect = [iter([mock_thread("id2", ["grp:0"]), mock_thread("id4", [])]),
+                              iter([mock_thread("id2", ["grp:0"]), mock_thread("id3", ["grp:0"])]),
+                              iter([mock_thread("id2", ["grp:0"]), mock_thread("id3", ["grp:0"])])]
+    db.count_threads = MagicMock(return_value=2)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=foo&limit=10')
+        assert response.status_code == 200
+        page = json.loads(response.data.decode())
+        assert page["truncated"] is True
+        # expanded in full regardless
+        assert [t["thread_id"] for t in page["threads"][0]] == ["id2", "id3"]
+        assert len(page["threads"]) == 1
+        assert page["cursor"] is not None
+
+
+def test_within_budget_disconnected(setup):
+    app, db = setup
+
+    sock = MagicMock()
+    sock.recv.return_value = b""
+
+    with app.test_request_context(environ_base={"werkzeug.socket": sock}):
+        with patch('src.kukulkan.time.monotonic', side_effect=[0, 1]):
+            assert list(k.within_budget([1, 2, 3])) == [1]
+            assert k.g.truncated is True
+
+    sock.recv.assert_called_once()
+
+
+def test_complete_address(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.header = MagicMock()
+    mf.header.side_effect = ["foo@bar.com", "\"bar foo\" bar@foo.com", "bar@foo.com", None]
+    mf.tags = ["foo", "bar"]
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/address/?query=foo')
+        assert response.status_code == 200
+        addrs = json.loads(response.data.decode())
+        assert len(addrs) == 2
+        assert addrs[0] == "foo@bar.com"
+        assert addrs[1] == "\"bar foo\" bar@foo.com"
+
+    mf.header.assert_has_calls([call("from"), call("to"), call("cc"), call("bcc")])
+    db.messages.assert_called_once_with("from:foo or to:foo", exclude_tags=[],
+                                       sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_complete_address_time_budget(setup):
+    app, db = setup
+    app.config.custom["query-time-budget"] = "1e-9"
+
+    mf1 = lambda: None
+    mf1.header = MagicMock(side_effect=["foo@bar.com", None, None, None])
+    mf2 = lambda: None
+    mf2.header = MagicMock(side_effect=["foo@foo.com", None, None, None])
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf1, mf2]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/address/?query=foo')
+        assert response.status_code == 200
+        assert response.headers["X-Truncated"] == "true"
+        assert json.loads(response.data.decode()) == ["foo@bar.com"]
+
+    mf2.header.assert_not_called()
+
+
+def test_complete_email(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.header = MagicMock()
+    mf.header.side_effect = ["foo@bar.com", "\"bar foo\" bar@foo.com", "bar@foo.com", None]
+    mf.tags = ["foo", "bar"]
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/email/?query=foo')
+        assert response.status_code == 200
+        addrs = json.loads(response.data.decode())
+        assert len(addrs) == 2
+        assert addrs[0] == "foo@bar.com"
+        assert addrs[1] == "bar@foo.com"
+
+    mf.header.assert_has_calls([call("from"), call("to"), call("cc"), call("bcc")])
+    db.messages.assert_called_once_with("from:foo or to:foo", exclude_tags=[],
+                                       sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_complete_groups(setup):
+    app, db = setup
+
+    mf1 = lambda: None
+    mf1.header = MagicMock()
+    mf1.header.side_effect = ["subj1"]
+    mf1.tags = ["grp:0", "bar"]
+
+    mf2 = lambda: None
+    mf2.header = MagicMock()
+    mf2.header.side_effect = ["subj2"]
+    mf2.tags = ["grp:0", "bar"]
+
+    mf3 = lambda: None
+    mf3.header = MagicMock()
+    mf3.header.side_effect = ["subj3"]
+    mf3.tags = ["grp:1", "bar"]
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf1, mf2, mf3]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/group_complete/')
+        assert response.status_code == 200
+        grps = json.loads(response.data.decode())
+        assert len(grps) == 2
+        assert "subj1" in grps
+        assert "subj3" in grps
+        assert grps["subj1"] == "grp:0"
+        assert grps["subj3"] == "grp:1"
+
+    mf1.header.assert_called_once_with("subject")
+    mf2.header.assert_called_once_with("subject")
+    mf3.header.assert_called_once_with("subject")
+    db.messages.assert_called_once_with("tag:/grp:.*/", exclude_tags=[],
+                                       sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_complete_groups_subject(setup):
+    app, db = setup
+
+    mf1 = lambda: None
+    mf1.header = MagicMock()
+    mf1.header.side_effect = ["subj1"]
+    mf1.tags = ["grp:0", "bar"]
+
+    mf2 = lambda: None
+    mf2.header = MagicMock()
+    mf2.header.side_effect = ["subj2"]
+    mf2.tags = ["grp:0", "bar"]
+
+    mf3 = lambda: None
+    mf3.header = MagicMock()
+    mf3.header.side_effect = ["subj3"]
+    mf3.tags = ["grp:1", "bar"]
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf1, mf2, mf3]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/group_complete/?query=subj')
+        assert response.status_code == 200
+        grps = json.loads(response.data.decode())
+        assert len(grps) == 2
+        assert "subj1" in grps
+        assert "subj3" in grps
+        assert grps["subj1"] == "grp:0"
+        assert grps["subj3"] == "grp:1"
+
+    mf1.header.assert_called_once_with("subject")
+    mf2.header.assert_called_once_with("subject")
+    mf3.header.assert_called_once_with("subject")
+    db.messages.assert_called_once_with('tag:/grp:.*/ and subject:"subj"', exclude_tags=[],
+                                       sort=notmuch2.Database.SORT.NEWEST_FIRST)
+
+
+def test_get_message_none(setup):
+    app, db = setup
+
+    db.config = {}
+    db.find = MagicMock()
+    db.find.side_effect = LookupError("foo")
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/message/?message=foo')
+        assert response.status_code == 404
+    db.find.assert_called_once_with("foo")
+
+
+def test_raw_message(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "foofile"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with patch("builtins.open", mock_open(read_data="This is a test.")) as o:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/message_raw/?message=foo')
+            assert response.status_code == 200
+            assert b'This is a test.' == response.data
+        o.assert_called_once_with("foofile", "r", encoding="utf8")
+    db.find.assert_called_once_with("foo")
+
+
+def test_tag_add_message(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.add = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock(return_value=iter([mf]))
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag/?op=add&type=message&id=foo&tag=bar')
+            assert response.status_code == 200
+            assert b'bar' == response.data
+        nmdb.assert_called_once()
+    dbw.messages.assert_called_once_with("id:foo and not tag:bar", exclude_tags=[], sort=ANY)
+
+    mf.tags.add.assert_called_once_with("bar")
+    mf.frozen.assert_called_once()
+
+    dbw.close.assert_called_once()
+
+
+def test_tag_add_thread(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.add = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock(return_value=iter([mf]))
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag/?op=add&type=thread&id=foo&tag=bar')
+            assert response.status_code == 200
+            assert b'bar' == response.data
+        nmdb.assert_called_once()
+    dbw.messages.assert_called_once_with("thread:foo and not tag:bar", exclude_tags=[], sort=ANY)
+
+    mf.tags.add.assert_called_once_with("bar")
+    mf.tags.to_maildir_flags.assert_called_once()
+    mf.frozen.assert_called_once()
+
+    dbw.close.assert_called_once()
+
+
+def test_tag_remove_message(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.discard = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock(return_value=iter([mf]))
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag/?op=remove&type=message&id=foo&tag=bar')
+            assert response.status_code == 200
+            assert b'bar' == response.data
+        nmdb.assert_called_once()
+    dbw.messages.assert_called_once_with("id:foo and tag:bar", exclude_tags=[], sort=ANY)
+
+    mf.tags.discard.assert_called_once_with("bar")
+    mf.tags.to_maildir_flags.assert_called_once()
+    mf.frozen.assert_called_once()
+
+    dbw.close.assert_called_once()
+
+
+def test_tag_remove_thread(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.discard = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock(return_value=iter([mf]))
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag/?op=remove&type=thread&id=foo&tag=bar')
+            assert response.status_code == 200
+            assert b'bar' == response.data
+        nmdb.assert_called_once()
+    dbw.messages.assert_called_once_with("thread:foo and tag:bar", exclude_tags=[], sort=ANY)
+
+    mf.tags.discard.assert_called_once_with("bar")
+    mf.tags.to_maildir_flags.assert_called_once()
+    mf.frozen.assert_called_once()
+
+    dbw.close.assert_called_once()
+
+
+def test_tags_change_message_batch(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.add = MagicMock()
+    mf.tags.discard = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock()
+    dbw.messages.side_effect = [iter([mf]), iter([mf]), iter([mf]), iter([mf])]
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag_batch/?type=message&ids=foo1%20foo2&tags=bar1%20-bar2')
+            assert response.status_code == 200
+            assert b'foo1 foo2/bar1 -bar2' == response.data
+        assert nmdb.call_count == 1
+
+    assert dbw.messages.mock_calls == [
+        call('id:foo1 and not tag:bar1', exclude_tags=[], sort=ANY),
+        call('id:foo1 and tag:bar2', exclude_tags=[], sort=ANY),
+        call('id:foo2 and not tag:bar1', exclude_tags=[], sort=ANY),
+        call('id:foo2 and tag:bar2', exclude_tags=[], sort=ANY)
+    ]
+    assert dbw.close.call_count == 1
+
+    assert mf.tags.add.mock_calls == [
+        call('bar1'),
+        call('bar1')
+    ]
+    assert mf.tags.discard.mock_calls == [
+        call('bar2'),
+        call('bar2')
+    ]
+    assert mf.tags.to_maildir_flags.call_count == 4
+    assert mf.frozen.call_count == 4
+
+
+def test_tags_change_message_batch_slash(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.add = MagicMock()
+    mf.tags.discard = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock()
+    dbw.messages.side_effect = [iter([mf]), iter([mf]), iter([mf]), iter([mf])]
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag_batch/?type=message&ids=fo%2Fo1%20foo2&tags=bar1%20-bar2')
+            assert response.status_code == 200
+            assert b'fo/o1 foo2/bar1 -bar2' == response.data
+        assert nmdb.call_count == 1
+
+    assert dbw.messages.mock_calls == [
+        call('id:fo/o1 and not tag:bar1', exclude_tags=[], sort=ANY),
+        call('id:fo/o1 and tag:bar2', exclude_tags=[], sort=ANY),
+        call('id:foo2 and not tag:bar1', exclude_tags=[], sort=ANY),
+        call('id:foo2 and tag:bar2', exclude_tags=[], sort=ANY)
+    ]
+    assert dbw.close.call_count == 1
+
+    assert mf.tags.add.mock_calls == [
+        call('bar1'),
+        call('bar1')
+    ]
+    assert mf.tags.discard.mock_calls == [
+        call('bar2'),
+        call('bar2')
+    ]
+    assert mf.tags.to_maildir_flags.call_count == 4
+    assert mf.frozen.call_count == 4
+
+
+def test_tags_add_thread_batch(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = lambda: None
+    mf.tags.add = MagicMock()
+    mf.tags.discard = MagicMock()
+    mf.tags.to_maildir_flags = MagicMock()
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.messages = MagicMock()
+    dbw.messages.side_effect = [iter([mf]), iter([mf]), iter([mf]), iter([mf])]
+    dbw.config = {}
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/tag_batch/?type=thread&ids=foo1%20foo2&tags=bar1%20-bar2')
+            assert response.status_code == 200
+            assert b'foo1 foo2/bar1 -bar2' == response.data
+        assert nmdb.call_count == 1
+
+    assert dbw.messages.mock_calls == [
+        call('thread:foo1 and not tag:bar1', exclude_tags=[], sort=ANY),
+        call('thread:foo1 and tag:bar2', exclude_tags=[], sort=ANY),
+        call('thread:foo2 and not tag:bar1', exclude_tags=[], sort=ANY),
+        call('thread:foo2 and tag:bar2', exclude_tags=[], sort=ANY)
+    ]
+    assert dbw.close.call_count == 1
+
+    assert mf.tags.add.mock_calls == [
+        call('bar1'),
+        call('bar1')
+    ]
+    assert mf.tags.discard.mock_calls == [
+        call('bar2'),
+        call('bar2')
+    ]
+    assert mf.tags.to_maildir_flags.call_count == 4
+    assert mf.frozen.call_count == 4
+
+
+def test_group_new_initial(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = MagicMock()
+    mf.tags.add = MagicMock()
+
+    mt = lambda: None
+    mt.tags = MagicMock()
+    mt.toplevel = MagicMock(return_value=iter([mf]))
+
+    db.threads = MagicMock(return_value=iter([mt]))
+    db.tags = ['foo', 'bar']
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.threads = MagicMock(return_value=iter([mt]))
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/group/?threads=foo1')
+            assert response.status_code == 200
+            assert b'grp:0' == response.data
+        assert nmdb.call_count == 1
+
+    assert db.threads.mock_calls == [
+        call('thread:foo1')
+    ]
+    assert dbw.threads.mock_calls == [
+        call('thread:foo1')
+    ]
+    assert dbw.close.call_count == 1
+
+    mt.toplevel.assert_called_once()
+
+    assert mf.tags.add.mock_calls == [
+        call('grp:0')
+    ]
+    assert mf.frozen.call_count == 1
+
+
+def test_group_new_subsequent(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = MagicMock()
+    mf.tags.add = MagicMock()
+
+    mt = lambda: None
+    mt.tags = MagicMock()
+    mt.toplevel = MagicMock(return_value=iter([mf]))
+
+    db.threads = MagicMock(return_value=iter([mt]))
+    db.tags = ['foo', 'bar', 'grp:10', 'grp:f']
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.threads = MagicMock(return_value=iter([mt]))
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/group/?threads=foo1')
+            assert response.status_code == 200
+            assert b'grp:11' == response.data
+        assert nmdb.call_count == 1
+
+    assert db.threads.mock_calls == [
+        call('thread:foo1')
+    ]
+    assert dbw.threads.mock_calls == [
+        call('thread:foo1')
+    ]
+    assert dbw.close.call_count == 1
+
+    mt.toplevel.assert_called_once()
+
+    assert mf.tags.add.mock_calls == [
+        call('grp:11')
+    ]
+    assert mf.frozen.call_count == 1
+
+
+def test_group_existing(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.frozen = MagicMock()
+    mf.tags = MagicMock(spec=list)
+    mf.tags.__iter__.return_value = iter(['grp:ae'])
+    mf.tags.add = MagicMock()
+
+    mf1 = lambda: None
+    mf1.frozen = MagicMock()
+    mf1.tags = MagicMock()
+    mf1.tags.add = MagicMock()
+
+    mt = lambda: None
+    mt.tags = ['grp:ae']
+    mt.toplevel = MagicMock(return_value=iter([mf, mf1]))
+
+    db.threads = MagicMock(return_value=iter([mt]))
+
+    dbw = lambda: None
+    dbw.close = MagicMock()
+    dbw.threads = MagicMock(return_value=iter([mt]))
+
+    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/group/?threads=foo1')
+            assert response.status_code == 200
+            assert b'grp:ae' == response.data
+        assert nmdb.call_count == 1
+
+    assert db.threads.mock_calls == [
+        call('thread:foo1')
+    ]
+    assert dbw.threads.mock_calls == [
+        call('thread:foo1')
+    ]
+    assert dbw.close.call_count == 1
+
+    mt.toplevel.assert_called_once()
+
+    assert mf.tags.add.mock_calls == [
+        call('grp:ae')
+    ]
+    assert mf.frozen.call_count == 1
+    assert mf1.tags.add.mock_calls == [
+        call('grp:ae')
+    ]
+    assert mf1.frozen.call_count == 1
+
+
+def test_attachment_no_attachment(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/simple.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=0')
+        assert response.status_code == 404
+
+    db.find.assert_called_once_with("foo")
+
+
+def test_attachment_invalid_index(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/attachment.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=1')
+        assert response.status_code == 404
+
+    db.find.assert_called_once_with("foo")
+
+
+def test_attachment_single(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/attachment.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=0')
+        assert response.status_code == 200
+        assert 5368 == len(response.data)
+        assert type(response.data) is bytes
+        assert "application/x-gtar-compressed" == response.mimetype
+        assert "inline; filename=zendesk-email-loop2.tgz" == response.headers['Content-Disposition']
+
+    db.find.assert_called_once_with("foo")
+
+
+def test_attachment_multiple(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/attachments.eml"
+
+    db.config = {}
+    db.find = MagicMock()
+    db.find.side_effect = [mf, mf, mf]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=0')
+        assert response.status_code == 200
+        assert 445 == len(response.data)
+        assert type(response.data) is bytes
+        assert "text/plain" == response.mimetype
+        assert "inline; filename=text.txt" == response.headers['Content-Disposition']
+
+        response = test_client.get('/api/attachment/?message=foo&num=1')
+        assert response.status_code == 200
+        assert 7392 == len(response.data)
+        assert type(response.data) is bytes
+        assert "application/pdf" == response.mimetype
+        assert "inline; filename=document.pdf" == response.headers['Content-Disposition']
 
-    mf.tags.discard.assert_called_once_with("bar")
-    mf.tags.to_maildir_flags.assert_called_once()
-    mf.frozen.assert_called_once()
+        response = test_client.get('/api/attachment/?message=foo&num=2')
+        assert response.status_code == 200
+        assert 2391 == len(response.data)
+        assert type(response.data) is bytes
+        assert "text/plain" == response.mimetype
+        assert "inline; filename=test.csv" == response.headers['Content-Disposition']
 
-    dbw.close.assert_called_once()
+    assert db.find.mock_calls == [
+        call('foo'),
+        call('foo'),
+        call('foo')
+    ]
 
 
-def test_tag_remove_thread(setup):
+def test_attachment_decodes_one(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.discard = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+    mf.path = "test/mails/attachments.eml"
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock(return_value=iter([mf]))
-    dbw.config = {}
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+    with patch.object(email.message.MIMEPart, "get_content", autospec=True,
+                      side_effect=email.message.MIMEPart.get_content) as gc:
         with app.test_client() as test_client:
-            response = test_client.get('/api/tag/?op=remove&type=thread&id=foo&tag=bar')
+            response = test_client.get('/api/attachment/?message=foo&num=1')
             assert response.status_code == 200
-            assert b'bar' == response.data
-        nmdb.assert_called_once()
-    dbw.messages.assert_called_once_with("thread:foo and tag:bar", exclude_tags=[], sort=ANY)
+            assert 7392 == len(response.data)
+            assert "inline; filename=document.pdf" == response.headers['Content-Disposition']
+        gc.assert_called_once()
+        assert gc.call_args.args[0].get_filename() == "document.pdf"
 
-    mf.tags.discard.assert_called_once_with("bar")
-    mf.tags.to_maildir_flags.assert_called_once()
-    mf.frozen.assert_called_once()
 
-    dbw.close.assert_called_once()
+def test_attachment_streamed(setup, tmp_path):
+    app, db = setup
+    app.config.custom["message-store"] = "true"
+
+    mf = lambda: None
+    mf.path = "test/mails/attachments.eml"
+    mf.messageid = "foo"
 
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-def test_tags_change_message_batch(setup):
+    with open("test/mails/attachments.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+    pdf = k.get_attachments(email_msg, True)[1]["content"]
+
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("src.kukulkan.email_from_notmuch", wraps=k.email_from_notmuch) as efn:
+            with patch("src.kukulkan.stream_part", wraps=k.stream_part) as sp:
+                with app.test_client() as test_client:
+                    response = test_client.get('/api/attachment/?message=foo&num=1')
+                    assert response.status_code == 200
+                    assert response.data == pdf
+                    assert "application/pdf" == response.mimetype
+                    assert "inline; filename=document.pdf" == response.headers['Content-Disposition']
+                    assert efn.call_count == 1
+
+                    # location of attachments kept
+                    response = test_client.get('/api/attachment/?message=foo&num=1')
+                    assert response.status_code == 200
+                    assert response.data == pdf
+                    assert efn.call_count == 1
+                    # once to get the size on first access, and once per
+                    # request
+                    assert sp.call_count == 1 + 2
+
+                    # text is decoded
+                    response = test_client.get('/api/attachment/?message=foo&num=0')
+                    assert response.status_code == 200
+                    assert 445 == len(response.data)
+                    assert efn.call_count == 2
+
+
+def test_attachment_range(setup, tmp_path):
     app, db = setup
 
     mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.add = MagicMock()
-    mf.tags.discard = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+    mf.path = "test/mails/attachments.eml"
+    mf.messageid = "foo"
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock()
-    dbw.messages.side_effect = [iter([mf]), iter([mf]), iter([mf]), iter([mf])]
-    dbw.config = {}
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/tag_batch/?type=message&ids=foo1%20foo2&tags=bar1%20-bar2')
-            assert response.status_code == 200
-            assert b'foo1 foo2/bar1 -bar2' == response.data
-        assert nmdb.call_count == 1
+    with open("test/mails/attachments.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+    pdf = k.get_attachments(email_msg, True)[1]["content"]
 
-    assert dbw.messages.mock_calls == [
-        call('id:foo1 and not tag:bar1', exclude_tags=[], sort=ANY),
-        call('id:foo1 and tag:bar2', exclude_tags=[], sort=ANY),
-        call('id:foo2 and not tag:bar1', exclude_tags=[], sort=ANY),
-        call('id:foo2 and tag:bar2', exclude_tags=[], sort=ANY)
-    ]
-    assert dbw.close.call_count == 1
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        for store in ["false", "true"]:
+            app.config.custom["message-store"] = store
+            with app.test_client() as test_client:
+                response = test_client.get('/api/attachment/?message=foo&num=1')
+                assert response.status_code == 200
+                assert response.data == pdf
+                assert response.content_length == len(pdf)
+                assert response.accept_ranges == "bytes"
+                assert response.last_modified is not None
+                assert response.headers["Cache-Control"] == "public, max-age=900"
+
+                response = test_client.get('/api/attachment/?message=foo&num=1',
+                                           headers={"Range": "bytes=100-199"})
+                assert response.status_code == 206
+                assert response.data == pdf[100:200]
+                assert response.content_length == 100
+                assert response.content_range.to_header() == f"bytes 100-199/{len(pdf)}"
+
+                # resuming
+                response = test_client.get('/api/attachment/?message=foo&num=1',
+                                           headers={"Range": "bytes=1000-",
+                                                    "If-Range": response.headers["Last-Modified"]})
+                assert response.status_code == 206
+                assert response.data == pdf[1000:]
+
+                response = test_client.get('/api/attachment/?message=foo&num=1',
+                                           headers={"Range": f"bytes={len(pdf)}-"})
+                assert response.status_code == 416
+
+                # text isn't compressed when only a part is requested
+                app.config["COMPRESS_MIN_SIZE"] = 0
+                response = test_client.get('/api/attachment/?message=foo&num=0',
+                                           headers={"Range": "bytes=0-99", "Accept-Encoding": "gzip"})
+                assert response.status_code == 206
+                assert response.data == k.get_attachments(email_msg, True)[0]["content"].encode("utf8")[:100]
+
+
+def test_attachments_zip(setup, tmp_path):
+    app, db = setup
 
-    assert mf.tags.add.mock_calls == [
-        call('bar1'),
-        call('bar1')
-    ]
-    assert mf.tags.discard.mock_calls == [
-        call('bar2'),
-        call('bar2')
-    ]
-    assert mf.tags.to_maildir_flags.call_count == 4
-    assert mf.frozen.call_count == 4
+    mf = lambda: None
+    mf.path = "test/mails/attachments.eml"
+    mf.messageid = "foo"
+    mf.date = 1
+    mf.tags = []
 
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-def test_tags_change_message_batch_slash(setup):
+    with open("test/mails/attachments.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+    contents = [part.get_payload(decode=True) for part, _ in k.walk_message(email_msg)["attachments"]]
+
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        for store in ["false", "true"]:
+            app.config.custom["message-store"] = store
+            with patch("src.kukulkan.email_from_notmuch", wraps=k.email_from_notmuch) as efn:
+                with app.test_client() as test_client:
+                    response = test_client.get('/api/attachments/?message=foo')
+                    assert response.status_code == 200
+                    assert "application/zip" == response.mimetype
+                    assert "attachment; filename=attachments.zip" == response.headers['Content-Disposition']
+                    assert efn.call_count == 1
+                    zf = zipfile.ZipFile(io.BytesIO(response.data))
+                    assert zf.namelist() == ["text.txt", "document.pdf", "test.csv"]
+                    assert [zf.read(name) for name in zf.namelist()] == contents
+                    assert zf.getinfo("text.txt").compress_type == zipfile.ZIP_DEFLATED
+                    assert zf.getinfo("document.pdf").compress_type == zipfile.ZIP_STORED
+                    assert zf.getinfo("text.txt").date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_attachments_zip_thread(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.add = MagicMock()
-    mf.tags.discard = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+    mf.path = "test/mails/attachments.eml"
+    mf.date = 1700000000
+    mf.tags = []
+    mf1 = lambda: None
+    mf1.path = "test/mails/attachment-image.eml"
+    mf1.date = 1700000000
+    mf1.tags = []
+    mf2 = lambda: None
+    mf2.path = "test/mails/attachments.eml"
+    mf2.date = 1700000000
+    mf2.tags = ["deleted"]
+    mf3 = lambda: None
+    mf3.path = "test/mails/mail_nested.eml"
+    mf3.date = 1700000000
+    mf3.tags = []
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock()
-    dbw.messages.side_effect = [iter([mf]), iter([mf]), iter([mf]), iter([mf])]
-    dbw.config = {}
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf, mf1, mf2, mf, mf3]))
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/tag_batch/?type=message&ids=fo%2Fo1%20foo2&tags=bar1%20-bar2')
-            assert response.status_code == 200
-            assert b'fo/o1 foo2/bar1 -bar2' == response.data
-        assert nmdb.call_count == 1
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachments/?thread=foo')
+        assert response.status_code == 200
+        db.messages.assert_called_once_with("thread:foo", exclude_tags=[], sort=notmuch2.Database.SORT.OLDEST_FIRST)
+        zf = zipfile.ZipFile(io.BytesIO(response.data))
+        assert zf.namelist() == ["text.txt", "document.pdf", "test.csv", "filename.png",
+                                 "text (2).txt", "document (2).pdf", "test (2).csv",
+                                 "postbank.eml", "unnamed attachment"]
+        assert zf.read("text.txt") == zf.read("text (2).txt")
+        # attached message as sent
+        assert zf.read("postbank.eml").startswith(b"Return-Path: <gxnwgddl@carcarry.de>")
 
-    assert dbw.messages.mock_calls == [
-        call('id:fo/o1 and not tag:bar1', exclude_tags=[], sort=ANY),
-        call('id:fo/o1 and tag:bar2', exclude_tags=[], sort=ANY),
-        call('id:foo2 and not tag:bar1', exclude_tags=[], sort=ANY),
-        call('id:foo2 and tag:bar2', exclude_tags=[], sort=ANY)
-    ]
-    assert dbw.close.call_count == 1
 
-    assert mf.tags.add.mock_calls == [
-        call('bar1'),
-        call('bar1')
-    ]
-    assert mf.tags.discard.mock_calls == [
-        call('bar2'),
-        call('bar2')
-    ]
-    assert mf.tags.to_maildir_flags.call_count == 4
-    assert mf.frozen.call_count == 4
+def test_attachments_zip_none(setup):
+    app, db = setup
 
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachments/')
+        assert response.status_code == 404
 
-def test_tags_add_thread_batch(setup):
+
+def test_attachment_not_streamed_smime(setup, tmp_path):
     app, db = setup
+    app.config.custom["message-store"] = "true"
 
     mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = lambda: None
-    mf.tags.add = MagicMock()
-    mf.tags.discard = MagicMock()
-    mf.tags.to_maildir_flags = MagicMock()
+    mf.path = "test/mails/signed-attachment.eml"
+    mf.messageid = "foo"
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.messages = MagicMock()
-    dbw.messages.side_effect = [iter([mf]), iter([mf]), iter([mf]), iter([mf])]
-    dbw.config = {}
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/tag_batch/?type=thread&ids=foo1%20foo2&tags=bar1%20-bar2')
-            assert response.status_code == 200
-            assert b'foo1 foo2/bar1 -bar2' == response.data
-        assert nmdb.call_count == 1
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("src.kukulkan.stream_part") as sp:
+            with app.test_client() as test_client:
+                assert k.get_attachment_index(mf) is None
+                response = test_client.get('/api/attachment/?message=foo&num=0')
+                assert response.status_code == 200
+            sp.assert_not_called()
+
+
+def test_stream_part():
+    with open("test/mails/calendar.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+    with open("test/mails/calendar.eml", "rb") as f:
+        parts = k.index_mime_parts(f)
+    attachments = [part for part in parts if k.is_attachment_part(part["content_type"], part["disposition"])]
+    assert [part["content_type"] for part in attachments] == ["text/calendar", "application/ics"]
+
+    ics = attachments[1]
+    assert ics["cte"] == "quoted-printable"
+    expected = k.walk_message(email_msg)["attachments"][1][0].get_content()
+    for chunk_size in [1, 3, 64, 65536]:
+        assert b"".join(k.stream_part("test/mails/calendar.eml", ics["start"], ics["end"], ics["cte"], chunk_size)) == expected
+
+
+def test_attachment_not_streamed_line_breaks(setup, tmp_path):
+    app, db = setup
+    app.config.custom["message-store"] = "true"
+
+    mf = lambda: None
+    mf.path = "test/mails/attachments-crlf.eml"
+    mf.messageid = "foo"
+    mf.date = 1590581733
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with open("test/mails/attachments-crlf.eml", "rb") as f:
+        email_msg = email.message_from_binary_file(f, policy=k.policy)
+    expected = [part.get_content() for part, _ in k.walk_message(email_msg)["attachments"]]
+
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("src.kukulkan.stream_part", wraps=k.stream_part) as sp:
+            with app.test_client() as test_client:
+                for num, content in enumerate(expected):
+                    response = test_client.get(f'/api/attachment/?message=foo&num={num}')
+                    assert response.status_code == 200
+                    assert response.data == content
+
+                response = test_client.get('/api/attachments/?message=foo')
+                assert response.status_code == 200
+                with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+                    assert [zf.read(name) for name in ["lines.csv", "data.bin", "lines.txt"]] == expected
+        # only the quoted-printable attachment, measured once and streamed for
+        # the request and the ZIP file, as 8bit and binary ones would have
+        # their line breaks changed
+        assert [c.args[3] for c in sp.call_args_list] == ["quoted-printable"] * 3
+
+
+def test_attachment_image_resize(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/attachment-image.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
+        assert response.status_code == 200
+        assert 25053 == len(response.data)
+        assert type(response.data) is bytes
+        assert "image/png" == response.mimetype
+        assert "inline; filename=filename.png" == response.headers['Content-Disposition']
+        img = Image.open(io.BytesIO(response.data))
+        assert (499, 402) == img.size
+
+    db.find.assert_called_once_with("foo")
+
+
+def test_attachment_image_resize_width(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/attachment-image.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=0&scale=2')
+        assert response.status_code == 200
+        assert "image/png" == response.mimetype
+        assert max(Image.open(io.BytesIO(response.data)).size) in [999, 1000]
+
+        response = test_client.get('/api/attachment/?message=foo&num=0&w=300')
+        assert response.status_code == 200
+        assert max(Image.open(io.BytesIO(response.data)).size) in [299, 300]
+
+
+def test_attachment_image_resize_webp(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/attachment-image.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/attachment/?message=foo&num=0&scale=1',
+                                   headers={"Accept": "image/avif,image/webp,*/*"})
+        assert response.status_code == 200
+        assert "image/webp" == response.mimetype
+        assert "inline; filename=filename.webp" == response.headers['Content-Disposition']
+        assert "Accept" in response.headers["Vary"]
+        img = Image.open(io.BytesIO(response.data))
+        assert img.format == "WEBP"
+        assert (499, 402) == img.size
+
+        # not without asking for it
+        response = test_client.get('/api/attachment/?message=foo&num=0&scale=1',
+                                   headers={"Accept": "*/*"})
+        assert response.status_code == 200
+        assert "image/png" == response.mimetype
 
-    assert dbw.messages.mock_calls == [
-        call('thread:foo1 and not tag:bar1', exclude_tags=[], sort=ANY),
-        call('thread:foo1 and tag:bar2', exclude_tags=[], sort=ANY),
-        call('thread:foo2 and not tag:bar1', exclude_tags=[], sort=ANY),
-        call('thread:foo2 and tag:bar2', exclude_tags=[], sort=ANY)
-    ]
-    assert dbw.close.call_count == 1
 
-    assert mf.tags.add.mock_calls == [
-        call('bar1'),
-        call('bar1')
-    ]
-    assert mf.tags.discard.mock_calls == [
-        call('bar2'),
-        call('bar2')
-    ]
-    assert mf.tags.to_maildir_flags.call_count == 4
-    assert mf.frozen.call_count == 4
+def test_scale_image_draft():
+    f = io.BytesIO()
+    Image.new("RGB", (4000, 3000), "red").save(f, format="JPEG")
 
+    with patch.object(Image.Image, "resize", autospec=True, side_effect=Image.Image.resize) as resize:
+        img = Image.open(io.BytesIO(k.scale_image(f.getvalue(), 500)))
+        # decoded at an eighth of the size already
+        assert resize.call_args.args[0].size == (500, 375)
+    assert img.format == "JPEG"
+    assert img.size == (500, 375)
 
-def test_group_new_initial(setup):
+
+def test_attachment_image_resize_cached(setup, tmp_path):
     app, db = setup
+    app.config.custom["thumbnail-cache-size"] = "1"
 
     mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = MagicMock()
-    mf.tags.add = MagicMock()
-
-    mt = lambda: None
-    mt.tags = MagicMock()
-    mt.toplevel = MagicMock(return_value=iter([mf]))
-
-    db.threads = MagicMock(return_value=iter([mt]))
-    db.tags = ['foo', 'bar']
+    mf.path = "test/mails/attachment-image.eml"
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.threads = MagicMock(return_value=iter([mt]))
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
         with app.test_client() as test_client:
-            response = test_client.get('/api/group/?threads=foo1')
+            response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
             assert response.status_code == 200
-            assert b'grp:0' == response.data
-        assert nmdb.call_count == 1
+            first = response.data
 
-    assert db.threads.mock_calls == [
-        call('thread:foo1')
-    ]
-    assert dbw.threads.mock_calls == [
-        call('thread:foo1')
-    ]
-    assert dbw.close.call_count == 1
-
-    mt.toplevel.assert_called_once()
+            response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
+            assert response.status_code == 200
+            assert response.data == first
+            assert "image/png" == response.mimetype
+            assert "inline; filename=filename.png" == response.headers['Content-Disposition']
 
-    assert mf.tags.add.mock_calls == [
-        call('grp:0')
-    ]
-    assert mf.frozen.call_count == 1
+    db.find.assert_called_once_with("foo")
+    assert len(os.listdir(tmp_path / "kukulkan" / "thumbnails")) == 1
 
 
-def test_group_new_subsequent(setup):
+def test_attachment_image_resize_cached_quality(setup, tmp_path):
     app, db = setup
+    app.config.custom["thumbnail-cache-size"] = "1"
 
     mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = MagicMock()
-    mf.tags.add = MagicMock()
+    mf.path = "test/mails/attachment-image.eml"
 
-    mt = lambda: None
-    mt.tags = MagicMock()
-    mt.toplevel = MagicMock(return_value=iter([mf]))
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-    db.threads = MagicMock(return_value=iter([mt]))
-    db.tags = ['foo', 'bar', 'grp:10', 'grp:f']
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with app.test_client() as test_client:
+            with patch("src.kukulkan.scale_image", wraps=k.scale_image) as si:
+                # same size, at different quality
+                response = test_client.get('/api/attachment/?message=foo&num=0&w=1000')
+                assert response.status_code == 200
+                response = test_client.get('/api/attachment/?message=foo&num=0&scale=2')
+                assert response.status_code == 200
+                assert [c.kwargs["quality"] for c in si.call_args_list] == [75, 60]
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.threads = MagicMock(return_value=iter([mt]))
+    assert db.find.call_count == 2
+    assert len(os.listdir(tmp_path / "kukulkan" / "thumbnails")) == 2
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/group/?threads=foo1')
-            assert response.status_code == 200
-            assert b'grp:11' == response.data
-        assert nmdb.call_count == 1
 
-    assert db.threads.mock_calls == [
-        call('thread:foo1')
-    ]
-    assert dbw.threads.mock_calls == [
-        call('thread:foo1')
-    ]
-    assert dbw.close.call_count == 1
+def test_cache_private(setup, tmp_path):
+    app, db = setup
+    app.config.custom["message-store"] = "true"
+    app.config.custom["thumbnail-cache-size"] = "1"
 
-    mt.toplevel.assert_called_once()
+    mf = lambda: None
+    mf.path = "test/mails/attachment-image.eml"
+    mf.messageid = "foo"
 
-    assert mf.tags.add.mock_calls == [
-        call('grp:11')
-    ]
-    assert mf.frozen.call_count == 1
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
+    # created before with the default permissions
+    os.makedirs(tmp_path / "kukulkan", mode=0o755)
 
-def test_group_existing(setup):
-    app, db = setup
+    umask = os.umask(0o022)
+    try:
+        with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+            with app.test_client() as test_client:
+                response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
+                assert response.status_code == 200
+    finally:
+        os.umask(umask)
 
-    mf = lambda: None
-    mf.frozen = MagicMock()
-    mf.tags = MagicMock(spec=list)
-    mf.tags.__iter__.return_value = iter(['grp:ae'])
-    mf.tags.add = MagicMock()
+    def mode(path):
+        return stat.S_IMODE(os.stat(path).st_mode)
 
-    mf1 = lambda: None
-    mf1.frozen = MagicMock()
-    mf1.tags = MagicMock()
-    mf1.tags.add = MagicMock()
+    cache_dir = tmp_path / "kukulkan"
+    assert mode(cache_dir) == 0o700
+    assert mode(cache_dir / "thumbnails") == 0o700
+    assert mode(cache_dir / "messages.sqlite") == 0o600
+    assert mode(cache_dir / "thumbnails.sqlite") == 0o600
+    assert [mode(cache_dir / "thumbnails" / f) for f in os.listdir(cache_dir / "thumbnails")] == [0o600]
 
-    mt = lambda: None
-    mt.tags = ['grp:ae']
-    mt.toplevel = MagicMock(return_value=iter([mf, mf1]))
 
-    db.threads = MagicMock(return_value=iter([mt]))
+def test_attachment_image_resize_cache_evicted(setup, tmp_path):
+    app, db = setup
 
-    dbw = lambda: None
-    dbw.close = MagicMock()
-    dbw.threads = MagicMock(return_value=iter([mt]))
+    mf = lambda: None
+    mf.path = "test/mails/attachment-image.eml"
 
-    with patch("notmuch2.Database", return_value=dbw) as nmdb:
-        with app.test_client() as test_client:
-            response = test_client.get('/api/group/?threads=foo1')
-            assert response.status_code == 200
-            assert b'grp:ae' == response.data
-        assert nmdb.call_count == 1
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
 
-    assert db.threads.mock_calls == [
-        call('thread:foo1')
-    ]
-    assert dbw.threads.mock_calls == [
-        call('thread:foo1')
-    ]
-    assert dbw.close.call_count == 1
+    # room for one thumbnail
+    with patch("src.kukulkan.get_thumbnail_cache_size", return_value=30000):
+        with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+            with app.test_client() as test_client:
+                response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
+                assert response.status_code == 200
+                response = test_client.get('/api/attachment/?message=bar&num=0&scale=1')
+                assert response.status_code == 200
+                assert db.find.call_count == 2
 
-    mt.toplevel.assert_called_once()
+                # newer one kept
+                response = test_client.get('/api/attachment/?message=bar&num=0&scale=1')
+                assert response.status_code == 200
+                assert db.find.call_count == 2
 
-    assert mf.tags.add.mock_calls == [
-        call('grp:ae')
-    ]
-    assert mf.frozen.call_count == 1
-    assert mf1.tags.add.mock_calls == [
-        call('grp:ae')
-    ]
-    assert mf1.frozen.call_count == 1
+                response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
+                assert response.status_code == 200
+                assert db.find.call_count == 3
 
+    assert len(os.listdir(tmp_path / "kukulkan" / "thumbnails")) == 1
 
-def test_attachment_no_attachment(setup):
+
+def test_attachment_image_no_resize_default(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.path = "test/mails/simple.eml"
+    mf.path = "test/mails/attachment-image.eml"
 
     db.config = {}
     db.find = MagicMock(return_value=mf)
 
     with app.test_client() as test_client:
         response = test_client.get('/api/attachment/?message=foo&num=0')
-        assert response.status_code == 404
+        assert response.status_code == 200
+        assert 94590 == len(response.data)
+        assert type(response.data) is bytes
+        assert "image/png" == response.mimetype
+        assert "inline; filename=filename.png" == response.headers['Content-Disposition']
+        img = Image.open(io.BytesIO(response.data))
+        assert (1584, 1274) == img.size
 
     db.find.assert_called_once_with("foo")
 
 
-def test_attachment_invalid_index(setup):
+def test_attachment_image_no_resize(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.path = "test/mails/attachment.eml"
+    mf.path = "test/mails/attachment-image.eml"
 
     db.config = {}
     db.find = MagicMock(return_value=mf)
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/attachment/?message=foo&num=1')
-        assert response.status_code == 404
+        response = test_client.get('/api/attachment/?message=foo&num=0&scale=0')
+        assert response.status_code == 200
+        assert 94590 == len(response.data)
+        assert type(response.data) is bytes
+        assert "image/png" == response.mimetype
+        assert "inline; filename=filename.png" == response.headers['Content-Disposition']
+        img = Image.open(io.BytesIO(response.data))
+        assert (1584, 1274) == img.size
 
     db.find.assert_called_once_with("foo")
 
 
-def test_attachment_single(setup):
+def test_message_simple(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.path = "test/mails/attachment.eml"
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.tags = ["foo", "bar"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
 
     db.config = {}
     db.find = MagicMock(return_value=mf)
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/attachment/?message=foo&num=0')
+        response = test_client.get('/api/message/?message=foo')
         assert response.status_code == 200
-        assert 5368 == len(response.data)
-        assert type(response.data) is bytes
-        assert "application/x-gtar-compressed" == response.mimetype
-        assert "inline; filename=zendesk-email-loop2.tgz" == response.headers['Content-Disposition']
+        msg = json.loads(response.data.decode())
+        assert msg["from"] == "foo@bar"
+        assert msg["to"] == ["foo@bar"]
+        assert msg["cc"] == ["foo@bar"]
+        assert msg["bcc"] == ["foo@bar"]
+        assert msg["date"] == "foo@bar"
+        assert msg["subject"] == "foo@bar"
+        assert msg["message_id"] == "foo@bar"
+        assert msg["in_reply_to"] == "foo@bar"
+        assert msg["reply_to"] == ["foo@bar"]
+        assert msg["delivered_to"] == "foo@bar"
+        assert msg["forwarded_to"] == "foo@bar"
+
+        assert "With the new notmuch_message_get_flags() function" in msg["body"]["text/plain"]
+        assert msg["body"]["text/html"] == False
+
+        assert msg["notmuch_id"] == "foo"
+        assert msg["tags"] == ["foo", "bar"]
+        assert msg["attachments"] == []
+        assert msg["signature"] is None
 
+    assert mf.header.call_count == 11
     db.find.assert_called_once_with("foo")
 
 
-def test_attachment_multiple(setup):
+def test_message_etag(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.path = "test/mails/attachments.eml"
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.tags = ["foo", "bar"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
 
     db.config = {}
-    db.find = MagicMock()
-    db.find.side_effect = [mf, mf, mf]
+    db.find = MagicMock(return_value=mf)
 
     with app.test_client() as test_client:
-        response = test_client.get('/api/attachment/?message=foo&num=0')
+        response = test_client.get('/api/message/?message=foo')
         assert response.status_code == 200
-        assert 445 == len(response.data)
-        assert type(response.data) is bytes
-        assert "text/plain" == response.mimetype
-        assert "inline; filename=text.txt" == response.headers['Content-Disposition']
+        etag = response.headers["ETag"]
 
-        response = test_client.get('/api/attachment/?message=foo&num=1')
-        assert response.status_code == 200
-        assert 7392 == len(response.data)
-        assert type(response.data) is bytes
-        assert "application/pdf" == response.mimetype
-        assert "inline; filename=document.pdf" == response.headers['Content-Disposition']
+        response = test_client.get('/api/message/?message=foo', headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert mf.header.call_count == 11
 
-        response = test_client.get('/api/attachment/?message=foo&num=2')
+        # tags changed
+        mf.tags = ["foo"]
+        response = test_client.get('/api/message/?message=foo', headers={"If-None-Match": etag})
         assert response.status_code == 200
-        assert 2391 == len(response.data)
-        assert type(response.data) is bytes
-        assert "text/plain" == response.mimetype
-        assert "inline; filename=test.csv" == response.headers['Content-Disposition']
-
-    assert db.find.mock_calls == [
-        call('foo'),
-        call('foo'),
-        call('foo')
-    ]
+        assert json.loads(response.data.decode())["tags"] == ["foo"]
 
 
-def test_attachment_image_resize(setup):
+def test_message_store(setup, tmp_path):
     app, db = setup
+    app.config.custom["message-store"] = "true"
 
     mf = lambda: None
-    mf.path = "test/mails/attachment-image.eml"
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.tags = ["foo", "bar"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
 
     db.config = {}
     db.find = MagicMock(return_value=mf)
 
-    with app.test_client() as test_client:
-        response = test_client.get('/api/attachment/?message=foo&num=0&scale=1')
-        assert response.status_code == 200
-        assert 25053 == len(response.data)
-        assert type(response.data) is bytes
-        assert "image/png" == response.mimetype
-        assert "inline; filename=filename.png" == response.headers['Content-Disposition']
-        img = Image.open(io.BytesIO(response.data))
-        assert (499, 402) == img.size
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("src.kukulkan.render_message", wraps=k.render_message) as rm:
+            with app.test_client() as test_client:
+                response = test_client.get('/api/message/?message=foo')
+                assert response.status_code == 200
+                first = json.loads(response.data.decode())
 
-    db.find.assert_called_once_with("foo")
+                mf.tags = ["foo"]
+                response = test_client.get('/api/message/?message=foo')
+                assert response.status_code == 200
+                msg = json.loads(response.data.decode())
+                assert msg["tags"] == ["foo"]
+                assert msg["body"] == first["body"]
+                assert msg["attachments"] == first["attachments"]
+
+                # configuration changed
+                app.config.custom["filter"] = {"remove-safelinks": "false"}
+                response = test_client.get('/api/message/?message=foo')
+                assert response.status_code == 200
+            assert rm.call_count == 2
+
+    assert os.path.exists(tmp_path / "kukulkan" / "messages.sqlite")
 
 
-def test_attachment_image_no_resize_default(setup):
+def test_message_store_renamed(setup, tmp_path):
     app, db = setup
+    app.config.custom["message-store"] = "true"
+
+    path = tmp_path / "mail" / "cur" / "simple.eml:2,"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(open("test/mails/simple.eml", "rb").read())
 
     mf = lambda: None
-    mf.path = "test/mails/attachment-image.eml"
+    mf.path = str(path)
+    mf.messageid = "foo"
+    mf.tags = ["foo", "unread"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
 
     db.config = {}
     db.find = MagicMock(return_value=mf)
 
-    with app.test_client() as test_client:
-        response = test_client.get('/api/attachment/?message=foo&num=0')
-        assert response.status_code == 200
-        assert 94590 == len(response.data)
-        assert type(response.data) is bytes
-        assert "image/png" == response.mimetype
-        assert "inline; filename=filename.png" == response.headers['Content-Disposition']
-        img = Image.open(io.BytesIO(response.data))
-        assert (1584, 1274) == img.size
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("src.kukulkan.render_message", wraps=k.render_message) as rm:
+            with app.test_client() as test_client:
+                response = test_client.get('/api/message/?message=foo')
+                assert response.status_code == 200
 
-    db.find.assert_called_once_with("foo")
+                # maildir flags changed with the tags, same mtime
+                mf.tags = ["foo"]
+                mf.path = str(path.parent / "simple.eml:2,S")
+                os.rename(path, mf.path)
+                response = test_client.get('/api/message/?message=foo')
+                assert response.status_code == 200
+            assert rm.call_count == 1
 
+        with sqlite3.connect(tmp_path / "kukulkan" / "messages.sqlite") as store:
+            assert store.execute("SELECT id FROM rendered").fetchall() == [("foo",)]
 
-def test_attachment_image_no_resize(setup):
+
+def test_message_store_size(setup, tmp_path):
     app, db = setup
+    app.config.custom["message-store"] = "true"
 
-    mf = lambda: None
-    mf.path = "test/mails/attachment-image.eml"
+    def mock_message(mid):
+        mf = lambda: None
+        mf.path = "test/mails/simple.eml"
+        mf.messageid = mid
+        mf.tags = ["foo"]
+        mf.header = MagicMock(return_value="  foo@bar  ")
+        return mf
 
+    msgs = {mid: mock_message(mid) for mid in ["foo", "bar", "baz"]}
     db.config = {}
-    db.find = MagicMock(return_value=mf)
+    db.find = MagicMock(side_effect=lambda mid: msgs[mid])
 
-    with app.test_client() as test_client:
-        response = test_client.get('/api/attachment/?message=foo&num=0&scale=0')
-        assert response.status_code == 200
-        assert 94590 == len(response.data)
-        assert type(response.data) is bytes
-        assert "image/png" == response.mimetype
-        assert "inline; filename=filename.png" == response.headers['Content-Disposition']
-        img = Image.open(io.BytesIO(response.data))
-        assert (1584, 1274) == img.size
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with app.test_client() as test_client:
+            response = test_client.get('/api/message/?message=foo')
+            assert response.status_code == 200
+            with sqlite3.connect(tmp_path / "kukulkan" / "messages.sqlite") as store:
+                size = store.execute("SELECT size FROM rendered").fetchone()[0]
+
+            # room for two
+            with patch("src.kukulkan.get_message_store_size", return_value=2 * size):
+                for mid in ["bar", "foo", "baz"]:
+                    time.sleep(0.01)
+                    response = test_client.get(f'/api/message/?message={mid}')
+                    assert response.status_code == 200
 
-    db.find.assert_called_once_with("foo")
+        with sqlite3.connect(tmp_path / "kukulkan" / "messages.sqlite") as store:
+            # least recently viewed one removed
+            assert sorted(store.execute("SELECT id FROM rendered").fetchall()) == [("baz",), ("foo",)]
 
 
-def test_message_simple(setup):
+def test_message_walked_once(setup):
     app, db = setup
 
     mf = lambda: None
-    mf.path = "test/mails/simple.eml"
+    mf.path = "test/mails/html-only.eml"
     mf.messageid = "foo"
     mf.tags = ["foo", "bar"]
     mf.header = MagicMock(return_value="  foo@bar  ")
@@ -1172,32 +2817,12 @@ def test_message_simple(setup):
     db.config = {}
     db.find = MagicMock(return_value=mf)
 
-    with app.test_client() as test_client:
-        response = test_client.get('/api/message/?message=foo')
-        assert response.status_code == 200
-        msg = json.loads(response.data.decode())
-        assert msg["from"] == "foo@bar"
-        assert msg["to"] == ["foo@bar"]
-        assert msg["cc"] == ["foo@bar"]
-        assert msg["bcc"] == ["foo@bar"]
-        assert msg["date"] == "foo@bar"
-        assert msg["subject"] == "foo@bar"
-        assert msg["message_id"] == "foo@bar"
-        assert msg["in_reply_to"] == "foo@bar"
-        assert msg["reply_to"] == ["foo@bar"]
-        assert msg["delivered_to"] == "foo@bar"
-        assert msg["forwarded_to"] == "foo@bar"
-
-        assert "With the new notmuch_message_get_flags() function" in msg["body"]["text/plain"]
-        assert msg["body"]["text/html"] == False
-
-        assert msg["notmuch_id"] == "foo"
-        assert msg["tags"] == ["foo", "bar"]
-        assert msg["attachments"] == []
-        assert msg["signature"] is None
-
-    assert mf.header.call_count == 11
-    db.find.assert_called_once_with("foo")
+    with patch("src.kukulkan.walk_message", wraps=k.walk_message) as wm:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/message/?message=foo')
+            assert response.status_code == 200
+            assert "hunter2" in json.loads(response.data.decode())["body"]["text/plain"]
+        wm.assert_called_once()
 
 
 def test_message_simple_multiple_reply_to(setup):
@@ -1240,6 +2865,16 @@ def test_message_simple_multiple_reply_to(setup):
     db.find.assert_called_once_with("foo")
 
 
+def test_parse_headers_stops_at_body(setup):
+    with open("test/mails/simple.eml", "rb") as f:
+        data = f.read()
+    fp = io.BytesIO(data)
+    headers = k.parse_headers(fp)
+    assert headers["To"] == "notmuch@notmuchmail.org"
+    assert headers.get_payload() == ""
+    assert fp.tell() == data.index(b"\n\n") + 2
+
+
 def test_message_simple_deleted(setup):
     app, db = setup
 
@@ -1310,6 +2945,44 @@ def test_message_forwarded(setup):
     db.find.assert_called_once_with("foo")
 
 
+def test_email_from_notmuch_cached(setup, tmp_path):
+    app, db = setup
+
+    path = tmp_path / "simple.eml"
+    with open("test/mails/simple.eml", "rb") as f:
+        path.write_bytes(f.read())
+
+    mf = lambda: None
+    mf.path = str(path)
+
+    with patch("src.kukulkan.email.message_from_binary_file", wraps=email.message_from_binary_file) as mfbf:
+        first = k.email_from_notmuch(mf)
+        assert k.email_from_notmuch(mf) is first
+        assert mfbf.call_count == 1
+        assert app.message_cache["size"] == path.stat().st_size
+
+        # file changed
+        os.utime(path, ns=(0, 0))
+        assert k.email_from_notmuch(mf) is not first
+        assert mfbf.call_count == 2
+        assert len(app.message_cache["messages"]) == 1
+        assert app.message_cache["size"] == path.stat().st_size
+
+
+def test_email_from_notmuch_cache_size(setup):
+    app, db = setup
+    app.config.custom["message-cache-size"] = "0"
+
+    mf = lambda: None
+    mf.path = "test/mails/simple.eml"
+
+    with patch("src.kukulkan.email.message_from_binary_file", wraps=email.message_from_binary_file) as mfbf:
+        first = k.email_from_notmuch(mf)
+        assert k.email_from_notmuch(mf) is not first
+        assert mfbf.call_count == 2
+        assert app.message_cache["size"] == 0
+
+
 def test_message_attachments(setup):
     app, db = setup
 
@@ -1957,6 +3630,29 @@ def test_message_attachment_mail(setup):
     db.find.assert_called_once_with("foo")
 
 
+def test_message_attachment_mail_headers(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/mail_nested.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with patch("src.kukulkan.get_nested_body") as gnb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/message_attachment/?message=foo&num=0&body=false')
+            assert response.status_code == 200
+            msg = json.loads(response.data.decode())
+            assert msg["from"] == "POSTBAN͟K͟ <gxnwgddl@carcarry.de>"
+            assert msg["subject"] == "BsetSign App : Y7P32-HTXU2-FRDG7"
+            assert msg["message_id"] == "<1M3lHZ-1jyAPt0pTn-000u1I@mrelayeu.kundenserver.de>"
+            assert msg["body"] is None
+        gnb.assert_not_called()
+
+    db.find.assert_called_once_with("foo")
+
+
 @pytest.mark.skipif(IN_GITHUB_ACTIONS, reason="For some reason parsed differently on Github (different lib versions?).")
 def test_message_html_simple(setup):
     app, db = setup
@@ -1975,6 +3671,28 @@ def test_message_html_simple(setup):
     db.find.assert_called_once_with("foo")
 
 
+def test_message_html_etag(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/html-only.eml"
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/message_html/?message=foo')
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+
+        response = test_client.get('/api/message_html/?message=foo', headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        response = test_client.get('/api/message_html/?message=bar', headers={"If-None-Match": etag})
+        assert response.status_code == 200
+
+
 def test_message_html_none(setup):
     app, db = setup
 
@@ -2190,6 +3908,338 @@ def test_thread_none(setup):
                                         sort=notmuch2.Database.SORT.OLDEST_FIRST)
 
 
+def test_thread_etag(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.tags = ["foo", "bar"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/thread/?thread=foo')
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+
+        response = test_client.get('/api/thread/?thread=foo', headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+    db.messages.assert_called_once_with("thread:foo", exclude_tags=[],
+                                        sort=notmuch2.Database.SORT.OLDEST_FIRST)
+
+
+def test_thread_lazy(setup):
+    app, db = setup
+
+    def mock_message(mid, tags):
+        mf = lambda: None
+        mf.path = "test/mails/attachment.eml"
+        mf.messageid = mid
+        mf.tags = tags
+        mf.header = MagicMock(return_value="  foo@bar  ")
+        return mf
+
+    mf1 = mock_message("foo", ["foo"])
+    mf2 = mock_message("bar", ["unread"])
+    mf3 = mock_message("foobar", ["foo"])
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf1, mf2, mf3]))
+
+    with patch("src.kukulkan.get_nested_body", wraps=k.get_nested_body) as gnb:
+        with app.test_client() as test_client:
+            response = test_client.get('/api/thread/?thread=foo&lazy=true&bodies=foobar')
+            assert response.status_code == 200
+            msgs = json.loads(response.data.decode())
+            assert len(msgs) == 3
+            assert msgs[0]["body"] is None
+            assert len(msgs[0]["attachments"]) == 1
+            assert msgs[0]["attachments"][0]["filename"] == "zendesk-email-loop2.tgz"
+            assert msgs[0]["tags"] == ["foo"]
+            assert msgs[1]["body"]["text/plain"] is not None
+            assert msgs[2]["body"]["text/plain"] is not None
+        assert gnb.call_count == 2
+
+    db.messages.assert_called_once_with("thread:foo", exclude_tags=[],
+                                        sort=notmuch2.Database.SORT.OLDEST_FIRST)
+
+
+def test_thread_tree(setup):
+    app, db = setup
+
+    def mock_message(mid, replies):
+        mf = lambda: None
+        mf.path = "test/mails/simple.eml"
+        mf.messageid = mid
+        mf.tags = ["foo"]
+        mf.header = MagicMock(return_value="  foo@bar  ")
+        mf.replies = MagicMock(return_value=iter(replies))
+        return mf
+
+    # foo <- bar <- foobar
+    #     <- barfoo
+    mf3 = mock_message("foobar", [])
+    mf2 = mock_message("bar", [mf3])
+    mf4 = mock_message("barfoo", [])
+    mf1 = mock_message("foo", [mf2, mf4])
+
+    mt = lambda: None
+    mt.toplevel = MagicMock(return_value=iter([mf1]))
+
+    db.config = {}
+    db.messages = MagicMock(side_effect=lambda *args, **kwargs: iter([mf1, mf2, mf3, mf4]))
+    db.threads = MagicMock(return_value=iter([mt]))
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/thread/?thread=foo&tree=true')
+        assert response.status_code == 200
+        thread = json.loads(response.data.decode())
+        assert [msg["notmuch_id"] for msg in thread["messages"]] == ["foo", "bar", "foobar", "barfoo"]
+        assert thread["parents"] == {"foo": None, "bar": "foo", "foobar": "bar", "barfoo": "foo"}
+        assert thread["replies"] == {"foo": ["bar", "barfoo"], "bar": ["foobar"], "foobar": [], "barfoo": []}
+        assert thread["fibers"] == [["foo", "bar", "foobar"], ["foo", "barfoo"]]
+
+        # cached
+        response = test_client.get('/api/thread/?thread=foo&tree=true')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())["fibers"] == thread["fibers"]
+        db.threads.assert_called_once_with("thread:foo")
+
+        # database changed
+        db.revision.return_value = 2
+        db.threads.return_value = iter([mt])
+        mt.toplevel.return_value = iter([mf4])
+        response = test_client.get('/api/thread/?thread=foo&tree=true')
+        assert response.status_code == 200
+        assert json.loads(response.data.decode())["fibers"] == [["barfoo"]]
+        assert db.threads.call_count == 2
+
+        response = test_client.get('/api/thread/?thread=foo')
+        assert response.status_code == 200
+        assert len(json.loads(response.data.decode())) == 4
+
+
+def test_thread_tree_evicted(setup):
+    app, db = setup
+    app.config.custom["query-cache-size"] = "1"
+
+    mf = lambda: None
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.tags = ["foo"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
+    mf.replies = MagicMock(side_effect=lambda: iter([]))
+
+    mt = lambda: None
+    mt.toplevel = MagicMock(side_effect=lambda: iter([mf]))
+
+    db.config = {}
+    db.messages = MagicMock(side_effect=lambda *args, **kwargs: iter([mf]))
+    db.threads = MagicMock(side_effect=lambda *args, **kwargs: iter([mt]))
+
+    with app.test_client() as test_client:
+        for tid in ["foo", "bar", "bar", "foo"]:
+            response = test_client.get(f'/api/thread/?thread={tid}&tree=true')
+            assert response.status_code == 200
+            assert json.loads(response.data.decode())["fibers"] == [["foo"]]
+
+    assert db.threads.mock_calls == [call("thread:foo"), call("thread:bar"), call("thread:foo")]
+
+
+def test_message_bodies(setup):
+    app, db = setup
+
+    mf = lambda: None
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.tags = ["foo", "bar"]
+    mf.header = MagicMock(return_value="  foo@bar  ")
+
+    db.config = {}
+    db.find = MagicMock(return_value=mf)
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/message_bodies/?ids=foo bar')
+        assert response.status_code == 200
+        bodies = json.loads(response.data.decode())
+        assert sorted(bodies.keys()) == ["bar", "foo"]
+        assert "With the new notmuch_message_get_flags() function" in bodies["foo"]["body"]["text/plain"]
+        assert bodies["foo"]["body"]["text/html"] == False
+        assert bodies["foo"]["signature"] is None
+
+        response = test_client.get('/api/message_bodies/')
+        assert response.status_code == 404
+
+    assert db.find.mock_calls == [call("foo"), call("bar")]
+
+
+def test_thread_render_processes(setup):
+    app, db = setup
+    app.config.custom["render-processes"] = "2"
+    app.config.custom["render-threshold"] = "2"
+
+    def mock_message(mid, tags):
+        mf = lambda: None
+        mf.path = "test/mails/simple.eml"
+        mf.messageid = mid
+        mf.tags = tags
+        mf.header = MagicMock(return_value="  foo@bar  ")
+        return mf
+
+    db.config = {}
+    db.messages = MagicMock()
+    db.messages.side_effect = [iter([mock_message("foo", ["foo"]), mock_message("bar", ["bar"])]),
+                               iter([mock_message("foo", ["foo"])])]
+
+    with app.test_client() as test_client:
+        response = test_client.get('/api/thread/?thread=foo')
+        assert response.status_code == 200
+        msgs = json.loads(response.data.decode())
+        assert [msg["notmuch_id"] for msg in msgs] == ["foo", "bar"]
+        for msg in msgs:
+            assert "With the new notmuch_message_get_flags() function" in msg["body"]["text/plain"]
+            assert msg["body"]["text/html"] == False
+            assert msg["attachments"] == []
+            assert msg["signature"] is None
+
+        # rendered in worker processes
+        db.messages.side_effect = [iter([mock_message("foo", ["foo"]), mock_message("bar", ["bar"])]),
+                                   iter([mock_message("foo", ["foo"])])]
+        submit_orig = concurrent.futures.ProcessPoolExecutor.submit
+        with patch("concurrent.futures.ProcessPoolExecutor.submit", side_effect=submit_orig, autospec=True) as submit:
+            response = test_client.get('/api/thread/?thread=foo')
+            assert response.status_code == 200
+        assert [c.args[1].__name__ for c in submit.call_args_list] == ["render_in_worker", "render_in_worker"]
+        assert [c.args[3] for c in submit.call_args_list] == ["foo", "bar"]
+
+        # too small for worker processes
+        with patch("src.kukulkan.render_in_worker") as riw:
+            response = test_client.get('/api/thread/?thread=foo')
+            assert response.status_code == 200
+            msgs = json.loads(response.data.decode())
+            assert "With the new notmuch_message_get_flags() function" in msgs[0]["body"]["text/plain"]
+        riw.assert_not_called()
+
+
+def test_thread_render_processes_broken(setup):
+    app, db = setup
+    app.config.custom["render-processes"] = "2"
+    app.config.custom["render-threshold"] = "2"
+
+    def mock_message(mid, tags):
+        mf = lambda: None
+        mf.path = "test/mails/simple.eml"
+        mf.messageid = mid
+        mf.tags = tags
+        mf.header = MagicMock(return_value="  foo@bar  ")
+        return mf
+
+    db.config = {}
+    db.messages = MagicMock()
+    db.messages.side_effect = [iter([mock_message("foo", ["foo"]), mock_message("bar", ["bar"])]),
+                               iter([mock_message("foo", ["foo"]), mock_message("bar", ["bar"])])]
+
+    pool = MagicMock()
+    pool.submit.return_value.result.side_effect = concurrent.futures.process.BrokenProcessPool("worker died")
+    with app.test_client() as test_client:
+        with patch("concurrent.futures.ProcessPoolExecutor", return_value=pool) as ppe:
+            response = test_client.get('/api/thread/?thread=foo')
+            assert response.status_code == 200
+            msgs = json.loads(response.data.decode())
+            assert [msg["notmuch_id"] for msg in msgs] == ["foo", "bar"]
+            for msg in msgs:
+                assert "With the new notmuch_message_get_flags() function" in msg["body"]["text/plain"]
+            pool.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+
+            # a new pool for the next request
+            response = test_client.get('/api/thread/?thread=foo')
+            assert response.status_code == 200
+            assert ppe.call_count == 2
+
+
+def test_warmup(setup, tmp_path):
+    app, db = setup
+    app.config.custom["message-store"] = "true"
+    app.config.custom["thumbnail-cache-size"] = "1"
+
+    mf = lambda: None
+    mf.path = "test/mails/attachment-image.eml"
+    mf.messageid = "foo"
+    mf.header = MagicMock(return_value="foo@bar")
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf]))
+
+    runner = app.test_cli_runner()
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("notmuch2.Database", return_value=db):
+            # nothing to start from
+            result = runner.invoke(args=["warmup"])
+            assert result.exit_code == 0
+            db.messages.assert_not_called()
+
+            db.revision.return_value.rev = 3
+            result = runner.invoke(args=["warmup", "--since", "0", "--processes", "0", "--pause", "0"])
+            assert result.exit_code == 0
+            assert "Warmed up 1 messages up to revision 3" in result.output
+            db.messages.assert_called_once_with("lastmod:0..3")
+
+            assert k.load_rendered_message(mf)["attachments"][0]["filename"] == "filename.png"
+            assert len(os.listdir(tmp_path / "kukulkan" / "thumbnails")) == 1
+
+            # continues where the last run stopped
+            db.revision.return_value.rev = 5
+            db.messages.return_value = iter([])
+            result = runner.invoke(args=["warmup"])
+            assert result.exit_code == 0
+            db.messages.assert_called_with("lastmod:4..5")
+
+        # served from the cache
+        with app.test_client() as test_client:
+            with patch("src.kukulkan.render_message") as rm:
+                db.find = MagicMock(return_value=mf)
+                mf.tags = ["foo"]
+                response = test_client.get('/api/message/?message=foo')
+                assert response.status_code == 200
+                rm.assert_not_called()
+
+
+def test_warmup_processes(setup, tmp_path):
+    app, db = setup
+    app.config.custom["message-store"] = "true"
+
+    mf = lambda: None
+    mf.path = "test/mails/simple.eml"
+    mf.messageid = "foo"
+    mf.header = MagicMock(return_value="foo@bar")
+
+    db.config = {}
+    db.messages = MagicMock(return_value=iter([mf]))
+
+    runner = app.test_cli_runner()
+    with patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path)}):
+        with patch("notmuch2.Database", return_value=db):
+            result = runner.invoke(args=["warmup", "--since", "0", "--processes", "1", "--pause", "0"])
+            assert result.exit_code == 0
+            assert "Warmed up 1 messages" in result.output
+            assert "With the new notmuch_message_get_flags() function" in k.load_rendered_message(mf)["body"]
+
+
+def test_warmup_disabled(setup):
+    app, db = setup
+
+    runner = app.test_cli_runner()
+    with patch("notmuch2.Database", return_value=db):
+        result = runner.invoke(args=["warmup"])
+        assert result.exit_code == 0
+        assert "nothing to do" in result.output
+
+
 def test_external_editor(setup):
     app, db = setup
 
@@ -77,6 +77,28 @@ def test_query(setup):
         assert thrds[1]["total_messages"] == 1
 
 
+def test_query_messages(setup):
+    app = setup
+    app.config.custom["query-engine"] = "messages"
+    with app.test_client() as test_client:
+        response = test_client.get('/api/query/?query=to:notmuch')
+        assert response.status_code == 200
+        thrds = json.loads(response.data.decode())
+        assert len(thrds) == 2
+        assert thrds[0]["authors"] == ["Antoine Beaupré <anarcat@orangeseeds.org>"]
+        assert thrds[0]["newest_date"] == 1521482214
+        assert thrds[0]["oldest_date"] == 1521482214
+        assert thrds[0]["subject"] == 'Re: bug: "no top level messages" crash on Zen email loops'
+        assert thrds[0]["tags"] == ["attachment", "inbox", "unread"]
+        assert thrds[0]["total_messages"] == 1
+        assert thrds[1]["authors"] == ["Stefan Schmidt <stefan@datenfreihafen.org>"]
+        assert thrds[1]["newest_date"] == 1258848661
+        assert thrds[1]["oldest_date"] == 1258848661
+        assert thrds[1]["subject"] == "[notmuch] [PATCH 2/2] notmuch-new: Tag mails not as unread when the seen flag in the maildir is set."
+        assert thrds[1]["tags"] == ["inbox", "unread"]
+        assert thrds[1]["total_messages"] == 1
+
+
 @pytest.mark.skipif(IN_GITHUB_ACTIONS, reason="Github runner doesn't seem to pick up notmuch config.")
 def test_query_deleted(setup_deleted):
     app = setup_deleted